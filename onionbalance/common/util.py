@@ -1,3 +1,4 @@
+import multiprocessing
 import sys
 import time
 import os
@@ -25,6 +26,23 @@ def read_config_data_from_file(config_path):
     return config_data
 
 
+def get_worker_process_context():
+    """
+    Return the multiprocessing context that worker processes should be started
+    with.
+
+    By the time we need worker processes, onionbalance already runs several
+    threads (stem's event thread, our worker threads, ...). Forking then can
+    leave the child with a lock (e.g. a logging lock) that another thread held
+    and that no one will ever release. So we start workers out of a fresh
+    forkserver process where we can, and spawn them otherwise.
+    """
+    if 'forkserver' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('forkserver')
+
+    return multiprocessing.get_context('spawn')
+
+
 def connect_to_control_port(tor_socket=None, tor_address=None, tor_port=0, control_password=None):
     controller = None
 
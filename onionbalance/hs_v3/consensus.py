@@ -1,14 +1,22 @@
 import datetime
 import base64
+import collections
 import hashlib
+import threading
+from concurrent.futures.process import BrokenProcessPool
 
 import stem
 import stem.util
 import stem.descriptor.remote
-from stem.descriptor.networkstatus import NetworkStatusDocumentV3
 
 from onionbalance.common import log
 from onionbalance.hs_v3 import tor_node
+from onionbalance.hs_v3 import consensus_parser
+from onionbalance.hs_v3 import data_directory
+from onionbalance.hs_v3 import hashring
+from onionbalance.hs_v3 import microdescriptor_cache
+from onionbalance.hs_v3 import params
+from onionbalance.hs_v3 import shared_consensus
 
 logger = log.get_logger()
 
@@ -19,41 +27,289 @@ class Consensus(object):
 
     It's initialized once in startup and refreshed during the runtime using the
     refresh() method to get the latest consensus.
+
+    A new consensus and the state derived from it get built on the side, and
+    are swapped in under 'lock' once they are ready. Readers that need a
+    consistent view of the consensus, its hash rings and HSDir table across
+    several calls should hold 'lock' as well.
     """
 
-    def __init__(self, do_refresh_consensus=True):
+    def __init__(self, do_refresh_consensus=True, is_testnet=None, staged_by=None):
+        """
+        If 'staged_by' is a Consensus, this is a new consensus it builds on
+        the side: it shares its microdescriptor cache, DataDirectory and shared
+        consensus file instead of setting up its own.
+        """
+        # Whether this is the consensus of a test network. If it's None we
+        # follow the setting of the running onionbalance.
+        self._is_testnet = is_testnet
         # A list of tor_node:Node objects contained in the current consensus
         self.nodes = None
-        # A stem NetworkStatusDocumentV3 object representing the current consensus
+        # The microdescriptors of the nodes. They are kept across consensuses
+        # so that we only fetch the ones that changed.
+        self.microdescriptor_cache = None
+        # The DataDirectory of our Tor, if we can read the consensus and
+        # microdescriptors straight from its files
+        self.data_directory = None
+        # The file we share our consensus state through with the other
+        # onionbalance processes of this host, if we do
+        self.shared_consensus_file = None
+        # The Consensus that stages us, if it does
+        self._staged_by = staged_by
+        if staged_by:
+            self.microdescriptor_cache = staged_by.microdescriptor_cache
+            self.data_directory = staged_by.data_directory
+            self.shared_consensus_file = staged_by.shared_consensus_file
+        else:
+            self.microdescriptor_cache = microdescriptor_cache.MicrodescriptorCache()
+            if params.TOR_DATA_DIRECTORY:
+                self.data_directory = data_directory.TorDataDirectory(params.TOR_DATA_DIRECTORY)
+            if params.SHARED_CONSENSUS_FILE:
+                self.shared_consensus_file = shared_consensus.SharedConsensusFile(params.SHARED_CONSENSUS_FILE,
+                                                                                  params.SHARED_CONSENSUS_MODE)
+        # True if the current consensus was loaded from the shared consensus
+        # file
+        self.is_shared = False
+        # A consensus_parser.MicrodescConsensus object representing the current consensus
         self.consensus = None
+        # A dictionary { (srv, time_period_num) : hashring.HashRing , ...}
+        # with the hash rings built from the current consensus
+        self.hash_rings = {}
+        # A dictionary { (identity_pubkey, is_first_descriptor) : hashring.HSDirTableEntry , ...}
+        # with the responsible HSDirs of our services for the current consensus
+        self.hsdir_table = {}
+        # The hash rings and HSDir table of the previous consensus. We use them
+        # to find the services whose HSDirs did not change with the new
+        # consensus.
+        self.previous_hash_rings = {}
+        self.previous_hsdir_table = {}
+        # When we replaced the previous consensus with the current one
+        self.previous_consensus_replaced_ts = None
+        # The TimeContext of the current consensus, and the consensus document
+        # it was computed from
+        self._time_context = None
+        self._time_context_source = None
+        # Protects the swap of the current consensus and its derived state
+        self.lock = threading.RLock()
+        # The SHA256 digest of the last consensus document we fully ingested,
+        # and how many times we were handed that same document again and
+        # skipped it
+        self.consensus_digest = None
+        self.n_skipped_refreshes = 0
 
         if not do_refresh_consensus:
             return
 
-        # Set self.consensus to a NetworkStatusDocumentV3 object
+        # Set self.consensus to a MicrodescConsensus object
         # and initialize the nodelist
         self.refresh()
 
-    def refresh(self):
+    def refresh(self, identity_pubkeys=None):
         """
         Attempt to refresh the consensus with the latest one available.
+
+        The responsible HSDirs of the services with 'identity_pubkeys' are
+        computed along with a new consensus, before it gets swapped in.
         """
         from onionbalance.hs_v3.onionbalance import my_onionbalance
 
+        if self.shared_consensus_file and not self.shared_consensus_file.is_publisher():
+            if self._attach_shared_consensus():
+                return
+
+        if self.data_directory:
+            md_consensus_map = self._read_consensus_from_data_directory()
+            if md_consensus_map is not None:
+                with md_consensus_map:
+                    self.load(md_consensus_map, identity_pubkeys=identity_pubkeys)
+                return
+
         # Fetch the current md consensus from the control port
         md_consensus_str = my_onionbalance.controller.get_md_consensus().encode()
+        self.load(md_consensus_str, identity_pubkeys=identity_pubkeys)
+
+    def _attach_shared_consensus(self):
+        """
+        Load the consensus, nodes and hash rings that another onionbalance
+        process published to the shared consensus file.
+
+        Return False if there is no fresh consensus in there, so that we
+        should load our own consensus instead (e.g. if the publisher is not
+        running).
+        """
+        try:
+            shared = self.shared_consensus_file.load()
+        except (OSError, ValueError) as e:
+            logger.warning("Can't load the shared consensus from %s (%s). Loading our own consensus instead.",
+                           self.shared_consensus_file.path, e)
+            return False
+
+        if shared is None:
+            if not self.is_shared or not _is_fresh(self.consensus):
+                logger.info("No new shared consensus. Loading our own consensus instead.")
+                return False
+
+            self.n_skipped_refreshes += 1
+            logger.info("The shared consensus did not change since we last loaded it. Skipping it "
+                        "(%d skipped so far).", self.n_skipped_refreshes)
+            return True
+
+        if not _is_fresh(shared.consensus):
+            logger.warning("The shared consensus in %s is not fresh. Loading our own consensus instead.",
+                           self.shared_consensus_file.path)
+            return False
+
+        with self.lock:
+            self._reset_derived_state()
+            self.consensus = shared.consensus
+            self.nodes = shared.nodes
+            self.hash_rings = shared.hash_rings
+            self.is_shared = True
+            self.consensus_digest = None
+
+        return True
+
+    def _publish_shared_consensus(self):
+        """
+        Publish the current consensus, nodes and the hash rings of both
+        descriptors to the shared consensus file.
+        """
+        with self.lock:
+            # Build the rings the other processes are going to need
+            for is_first_descriptor in (True, False):
+                self.get_hash_ring(*hashring.get_srv_and_time_period(is_first_descriptor, self))
+
+            md_consensus = self.consensus
+            nodes = self.nodes
+            hash_rings = dict(self.hash_rings)
+
         try:
-            self.consensus = NetworkStatusDocumentV3(md_consensus_str)
+            self.shared_consensus_file.publish(md_consensus, nodes, hash_rings)
+        except OSError as e:
+            logger.warning("Can't publish the consensus to %s (%s).", self.shared_consensus_file.path, e)
+
+    def _read_consensus_from_data_directory(self):
+        """
+        Return an mmap of the consensus file of the Tor DataDirectory, or None
+        if we should fetch the consensus from the control port instead.
+        """
+        try:
+            md_consensus_map = self.data_directory.get_consensus()
+        except OSError as e:
+            logger.warning("Can't read the consensus from the Tor DataDirectory (%s). "
+                           "Fetching it from the control port instead.", e)
+            return None
+
+        if md_consensus_map is None:
+            # Tor did not write the new consensus to disk yet
+            logger.info("The consensus file of the Tor DataDirectory did not change. "
+                        "Fetching the consensus from the control port instead.")
+
+        return md_consensus_map
+
+    def load(self, md_consensus_str, microdescriptors=None, identity_pubkeys=None):
+        """
+        Load the md consensus in 'md_consensus_str' (bytes or an mmap) and
+        initialize the nodelist from it.
+
+        'microdescriptors' is a list of stem Microdescriptor objects to match
+        with the routerstatuses. If it's None, they are fetched from the
+        control port.
+
+        The hash rings of both descriptors, and the HSDir table entries of the
+        services with 'identity_pubkeys', are built before the new consensus
+        is swapped in, so that readers never wait for them.
+
+        If it's the same document we last loaded, there is nothing new to
+        derive from it and it's skipped.
+        """
+        consensus_digest = hashlib.sha256(md_consensus_str).digest()
+        if consensus_digest == self.consensus_digest:
+            self.n_skipped_refreshes += 1
+            logger.info("Consensus did not change since we last loaded it. Skipping it (%d skipped so far).",
+                        self.n_skipped_refreshes)
+            return
+
+        try:
+            md_consensus = consensus_parser.parse_md_consensus(md_consensus_str)
         except ValueError:
             logger.warning("No valid consensus received. Waiting for one...")
             return
 
+        staged = self._build_staged_consensus(md_consensus, microdescriptors, identity_pubkeys)
+
+        # Swap in the new consensus and everything derived from it at once
+        with self.lock:
+            self._reset_derived_state()
+            self.consensus = staged.consensus
+            self._time_context = staged._time_context
+            self._time_context_source = staged._time_context_source
+            self.hash_rings = staged.hash_rings
+            self.hsdir_table = staged.hsdir_table
+            if staged.is_live():
+                self.nodes = staged.nodes
+            self.is_shared = False
+
+            # Only skip this document in the future if we got everything we
+            # need out of it, so that we retry otherwise
+            self.consensus_digest = consensus_digest if staged.nodes is not None else None
+
+        if self.shared_consensus_file and self.shared_consensus_file.is_publisher() and staged.nodes:
+            self._publish_shared_consensus()
+
+    def _build_staged_consensus(self, md_consensus, microdescriptors, identity_pubkeys):
+        """
+        Return a Consensus for 'md_consensus' with its time context, nodes,
+        hash rings and the HSDir table entries of 'identity_pubkeys' built,
+        while this one keeps serving the current consensus.
+        """
+        staged = Consensus(do_refresh_consensus=False, is_testnet=self._is_testnet, staged_by=self)
+        staged.consensus = md_consensus
+        # So that the new rings and HSDir table entries can be made out of the
+        # current ones
+        staged.previous_hash_rings = self.hash_rings
+        staged.previous_hsdir_table = self.hsdir_table
+
         # Check if it's live
-        if not self.is_live():
+        if not staged.is_live():
             logger.info("Loaded consensus is not live. Waiting for a live one.")
-            return
+            return staged
+
+        # All the time periods and SRVs we need follow from this consensus, so
+        # work them out once now
+        staged.get_time_context()
+
+        staged.nodes = staged._initialize_nodes(microdescriptors)
+
+        if not staged.nodes:
+            return staged
+
+        if params.HASH_RING_WORKERS:
+            staged._build_hash_rings_in_workers(params.HASH_RING_WORKERS)
+        # Build the rings that the workers did not
+        for is_first_descriptor in (True, False):
+            staged.get_hash_ring(*hashring.get_srv_and_time_period(is_first_descriptor, staged))
+
+        if identity_pubkeys:
+            staged.precompute_responsible_hsdirs(identity_pubkeys)
 
-        self.nodes = self._initialize_nodes()
+        return staged
+
+    def _reset_derived_state(self):
+        """
+        Drop the state we derived from the previous consensus when a new one
+        gets loaded.
+        """
+        # Hash rings and HSDirs of the old consensus are only useful to spot
+        # what changed, and to keep serving clients that still use the old
+        # consensus, from now on
+        self.previous_hash_rings = self.hash_rings
+        self.previous_hsdir_table = self.hsdir_table
+        self.previous_consensus_replaced_ts = datetime.datetime.utcnow()
+        self.hash_rings = {}
+        self.hsdir_table = {}
+        self._time_context = None
+        self._time_context_source = None
 
     def get_routerstatuses(self):
         """Give access to the routerstatus entries in this consensus"""
@@ -80,46 +336,319 @@ class Consensus(object):
         return now >= self.consensus.valid_after - datetime.timedelta(seconds=REASONABLY_LIVE_TIME) and \
             now <= self.consensus.valid_until + datetime.timedelta(seconds=REASONABLY_LIVE_TIME)
 
-    def _initialize_nodes(self):
+    def _initialize_nodes(self, microdescriptors_list=None):
         """
         Initialize self.nodes with the list of current nodes.
-        """
-        from onionbalance.hs_v3.onionbalance import my_onionbalance
 
+        Only the relays that can be HSDirs can end up in a hash ring, so those
+        are the only ones we make nodes for, and the only ones whose
+        microdescriptors we fetch and keep.
+
+        If 'microdescriptors_list' is None, the microdescriptors that are
+        missing from our cache are fetched from Tor.
+        """
         nodes = []
 
-        try:
-            microdescriptors_list = list(my_onionbalance.controller.controller.get_microdescriptors())
-        except stem.DescriptorUnavailable:
-            logger.warning("Can't get microdescriptors from Tor. Delaying...")
-            return
+        routerstatuses = self.get_routerstatuses()
+        hsdir_routerstatuses = [routerstatus for routerstatus in routerstatuses.values()
+                                if tor_node.can_be_hsdir(routerstatus)]
+        digests = [routerstatus.microdescriptor_digest for routerstatus in hsdir_routerstatuses]
 
-        # Turn the mds into a dictionary indexed by the digest as an
-        # optimization while matching them with routerstatuses.
-        microdescriptors_dict = {}
-        for md in microdescriptors_list:
-            microdescriptors_dict[md.digest()] = md
+        if microdescriptors_list is not None:
+            self.microdescriptor_cache.add_microdescriptors(microdescriptors_list)
+        elif not self._update_microdescriptor_cache(digests):
+            return None
 
         # Go through the routerstatuses and match them up with
         # microdescriptors, and create a Node object for each match. If there
         # is no match we don't register it as a node.
-        for relay_fpr, relay_routerstatus in self.get_routerstatuses().items():
-            logger.debug("Checking routerstatus with md digest %s", relay_routerstatus.microdescriptor_digest)
-
+        n_missing = 0
+        for relay_routerstatus in hsdir_routerstatuses:
             # Skip routerstatuses for which we cannot find a microdescriptor
-            if relay_routerstatus.microdescriptor_digest not in microdescriptors_dict:
-                logger.debug("Could not find microdesc for rs with fpr %s", relay_fpr)
+            if relay_routerstatus.microdescriptor_digest not in self.microdescriptor_cache:
+                n_missing += 1
                 continue
 
-            node_microdescriptor = microdescriptors_dict[relay_routerstatus.microdescriptor_digest]
-            node = tor_node.Node(node_microdescriptor, relay_routerstatus)
+            ed25519_identity = self.microdescriptor_cache.get_ed25519_identity(relay_routerstatus.microdescriptor_digest)
+            node = tor_node.Node.from_routerstatus(relay_routerstatus, ed25519_identity)
             nodes.append(node)
 
-        logger.debug("Initialized %d nodes (%d routerstatuses / %d microdescriptors)",
-                     len(nodes), len(self.get_routerstatuses()), len(microdescriptors_list))
+        # Forget the microdescriptors of the nodes that left the consensus, or
+        # that can't be HSDirs anymore
+        n_evicted = self.microdescriptor_cache.evict(digests)
+
+        logger.debug("Initialized %d nodes (%d routerstatuses / %d HSDirs / %d without microdescriptor / "
+                     "%d microdescriptors, %d evicted)",
+                     len(nodes), len(routerstatuses), len(hsdir_routerstatuses), n_missing,
+                     len(self.microdescriptor_cache), n_evicted)
 
         return nodes
 
+    def _update_microdescriptor_cache(self, digests):
+        """
+        Fetch the microdescriptors with 'digests' that are missing from our
+        cache from Tor. Return False if Tor can't give them to us.
+
+        If we can read the Tor DataDirectory, the microdescriptors are looked
+        up in its files first, and we only ask the control port for the ones
+        that are not there.
+
+        A staged consensus leaves this to the consensus that stages it, whose
+        cache it shares.
+        """
+        from onionbalance.hs_v3.onionbalance import my_onionbalance
+
+        if self._staged_by:
+            return self._staged_by._update_microdescriptor_cache(digests)
+
+        if self.data_directory:
+            self._read_microdescriptors_from_data_directory(digests)
+
+        try:
+            n_fetched = self.microdescriptor_cache.update(my_onionbalance.controller, digests)
+        except stem.DescriptorUnavailable:
+            logger.warning("Can't get microdescriptors from Tor. Delaying...")
+            return False
+
+        logger.info("Fetched %d microdescriptors from Tor (%d cached)",
+                    n_fetched, len(self.microdescriptor_cache))
+        return True
+
+    def _read_microdescriptors_from_data_directory(self, digests):
+        """
+        Add the microdescriptors with 'digests' that are missing from our cache
+        out of the files of the Tor DataDirectory.
+        """
+        try:
+            microdescriptor_maps = self.data_directory.get_microdescriptor_maps()
+        except OSError as e:
+            logger.warning("Can't read microdescriptors from the Tor DataDirectory (%s).", e)
+            return
+
+        n_added = 0
+        for microdescriptor_map in microdescriptor_maps:
+            with microdescriptor_map:
+                n_added += self.microdescriptor_cache.update_from_file(microdescriptor_map, digests)
+
+        logger.info("Read %d microdescriptors from the Tor DataDirectory", n_added)
+
+    def is_testnet(self):
+        """
+        Return True if this is the consensus of a test network.
+        """
+        if self._is_testnet is not None:
+            return self._is_testnet
+
+        from onionbalance.hs_v3.onionbalance import my_onionbalance
+        return my_onionbalance.is_testnet
+
+    def get_time_context(self):
+        """
+        Return the TimeContext of the current consensus.
+
+        It's computed once per consensus document and then reused by everyone
+        who needs a time period, an SRV or an SRV run start time.
+        """
+        if self._time_context is None or self._time_context_source is not self.consensus:
+            self._time_context = self._compute_time_context()
+            self._time_context_source = self.consensus
+
+        return self._time_context
+
+    def _compute_time_context(self):
+        """
+        Compute the TimeContext of the current consensus.
+        """
+        first_descriptor_srv_and_tp = hashring.compute_srv_and_time_period(True, self)
+        second_descriptor_srv_and_tp = hashring.compute_srv_and_time_period(False, self)
+
+        time_context = TimeContext(valid_after=self.consensus.valid_after,
+                                   time_period_length=self.get_time_period_length(),
+                                   time_period_num=self.get_time_period_num(),
+                                   current_srv_run_start=self.get_start_time_of_current_srv_run(),
+                                   previous_srv_run_start=self.get_start_time_of_previous_srv_run(),
+                                   first_descriptor_srv_and_tp=first_descriptor_srv_and_tp,
+                                   second_descriptor_srv_and_tp=second_descriptor_srv_and_tp)
+
+        logger.debug("Time context for valid_after %s: TP#%s, first descriptor TP#%s, second descriptor TP#%s",
+                     time_context.valid_after, time_context.time_period_num,
+                     first_descriptor_srv_and_tp[1], second_descriptor_srv_and_tp[1])
+
+        return time_context
+
+    def get_hash_ring(self, srv, time_period_num):
+        """
+        Return the hashring.HashRing for this 'srv' and 'time_period_num'.
+
+        The ring is built the first time it's asked for and then cached until
+        the next consensus arrives. If the previous consensus had a ring for
+        the same SRV and time period, the new ring is made out of it.
+        """
+        with self.lock:
+            key = (srv, time_period_num)
+            if key not in self.hash_rings:
+                self.hash_rings[key] = self._build_hash_ring(srv, time_period_num)
+
+            return self.hash_rings[key]
+
+    def _build_hash_ring(self, srv, time_period_num):
+        period_length = self.get_time_period_length()
+
+        previous_ring = self.previous_hash_rings.get((srv, time_period_num))
+        if previous_ring:
+            hash_ring = hashring.HashRing.from_previous(previous_ring, self.nodes, period_length)
+            if hash_ring is not None:
+                return hash_ring
+
+        return hashring.HashRing(self.nodes, srv, time_period_num, period_length=period_length)
+
+    def _build_hash_rings_in_workers(self, n_workers):
+        """
+        Build the hash rings of both descriptors with the node indices computed
+        by 'n_workers' worker processes, so that the main thread does not have
+        to hash every node itself.
+        """
+        srv_and_time_periods = set(hashring.get_srv_and_time_period(is_first_descriptor, self)
+                                   for is_first_descriptor in (True, False))
+
+        # Rings that can be made out of the previous ones don't need workers
+        for srv, time_period_num in list(srv_and_time_periods):
+            if (srv, time_period_num) in self.previous_hash_rings:
+                self.get_hash_ring(srv, time_period_num)
+                srv_and_time_periods.discard((srv, time_period_num))
+
+        if not srv_and_time_periods:
+            return
+
+        try:
+            all_indices = hashring.compute_hsdir_indices(self.nodes, srv_and_time_periods,
+                                                         self.get_time_period_length(), n_workers)
+        except (OSError, BrokenProcessPool) as e:
+            logger.warning("Could not compute hsdir indices in worker processes (%s). "
+                           "Computing them in the main process instead.", e)
+            return
+
+        for (srv, time_period_num), hsdir_indices in all_indices.items():
+            self.hash_rings[(srv, time_period_num)] = hashring.HashRing(self.nodes, srv, time_period_num,
+                                                                        hsdir_indices,
+                                                                        self.get_time_period_length())
+
+    def precompute_responsible_hsdirs(self, identity_pubkeys):
+        """
+        Fill the HSDir table with the responsible HSDirs of the first and
+        second descriptor of the services with 'identity_pubkeys'.
+
+        This is done in one batch per descriptor when a new consensus arrives,
+        so that later lookups are just a dictionary access. Services that
+        already have an entry for the current consensus are skipped.
+        """
+        with self.lock:
+            for is_first_descriptor in (True, False):
+                identity_pubkeys_to_compute = [identity_pubkey for identity_pubkey in identity_pubkeys
+                                               if (identity_pubkey, is_first_descriptor) not in self.hsdir_table]
+                if not identity_pubkeys_to_compute:
+                    continue
+
+                try:
+                    entries = self._get_hsdir_table_entries(identity_pubkeys_to_compute, is_first_descriptor)
+                except hashring.EmptyHashRing:
+                    logger.warning("Can't compute responsible HSDirs with no hash ring. Delaying...")
+                    return
+
+                for identity_pubkey, entry in zip(identity_pubkeys_to_compute, entries):
+                    if entry:
+                        self.hsdir_table[(identity_pubkey, is_first_descriptor)] = entry
+
+    def get_hsdir_table_entry(self, identity_pubkey, is_first_descriptor):
+        """
+        Return the hashring.HSDirTableEntry of the first or second descriptor of
+        the service with 'identity_pubkey'.
+
+        If the entry was not precomputed, it gets computed and stored now.
+
+        Raise hashring.EmptyHashRing if the HSDirs can't be computed.
+        """
+        with self.lock:
+            key = (identity_pubkey, is_first_descriptor)
+            if key not in self.hsdir_table:
+                entry, = self._get_hsdir_table_entries([identity_pubkey], is_first_descriptor)
+                if not entry:
+                    raise hashring.EmptyHashRing
+
+                self.hsdir_table[key] = entry
+
+            return self.hsdir_table[key]
+
+    def get_previous_only_hsdirs(self, identity_pubkey, is_first_descriptor):
+        """
+        Return the HSDirs that were responsible for the first or second
+        descriptor of the service with 'identity_pubkey' in the previous
+        consensus, but are not anymore.
+
+        Clients that still use the previous consensus will fetch the
+        descriptor from them, so we keep uploading to them for
+        HSDIR_SET_OVERLAP_WINDOW seconds after a new consensus arrives. Outside
+        of that window, or if that mode is disabled, return an empty list.
+        """
+        with self.lock:
+            if not params.HSDIR_SET_OVERLAP_WINDOW or not self.previous_consensus_replaced_ts:
+                return []
+
+            time_since_replaced = datetime.datetime.utcnow() - self.previous_consensus_replaced_ts
+            if time_since_replaced.total_seconds() > params.HSDIR_SET_OVERLAP_WINDOW:
+                return []
+
+            key = (identity_pubkey, is_first_descriptor)
+            entry = self.hsdir_table.get(key)
+            previous_entry = self.previous_hsdir_table.get(key)
+
+            # The HSDirs of a different time period are for a different blinded
+            # key, so they don't help clients to find this descriptor
+            if not entry or not previous_entry or previous_entry.time_period_num != entry.time_period_num:
+                return []
+
+            return [hsdir for hsdir in previous_entry.responsible_hsdirs
+                    if hsdir not in entry.responsible_hsdirs]
+
+    def _get_hsdir_table_entries(self, identity_pubkeys, is_first_descriptor):
+        """
+        Return the HSDir table entries of the services with 'identity_pubkeys'.
+
+        If the ring arcs of a service in the previous consensus did not gain or
+        lose any node, its HSDirs are the same as before and we reuse its
+        previous entry. Only the rest of the services are looked up in the
+        hash ring.
+        """
+        srv, time_period_num = hashring.get_srv_and_time_period(is_first_descriptor, self)
+
+        entries = {}
+
+        previous_ring = self.previous_hash_rings.get((srv, time_period_num))
+        if previous_ring:
+            changed_indices = self.get_hash_ring(srv, time_period_num).get_changed_indices(previous_ring)
+
+            for identity_pubkey in identity_pubkeys:
+                previous_entry = self.previous_hsdir_table.get((identity_pubkey, is_first_descriptor))
+                if not previous_entry or \
+                   (previous_entry.srv, previous_entry.time_period_num) != (srv, time_period_num):
+                    continue
+
+                if not hashring.arcs_have_changes(previous_entry.arcs, changed_indices):
+                    entries[identity_pubkey] = previous_entry
+
+            logger.info("Reusing HSDirs of %d/%d services for the %s descriptor (%d ring nodes changed)",
+                        len(entries), len(identity_pubkeys),
+                        "first" if is_first_descriptor else "second", len(changed_indices))
+
+        identity_pubkeys_to_compute = [identity_pubkey for identity_pubkey in identity_pubkeys
+                                       if identity_pubkey not in entries]
+        if identity_pubkeys_to_compute:
+            computed_entries = hashring.get_hsdir_table_entries(identity_pubkeys_to_compute,
+                                                                is_first_descriptor, self)
+            entries.update(zip(identity_pubkeys_to_compute, computed_entries))
+
+        return [entries[identity_pubkey] for identity_pubkey in identity_pubkeys]
+
     def _get_disaster_srv(self, time_period_num):
         """
         Return disaster SRV for 'time_period_num'.
@@ -155,8 +684,7 @@ class Consensus(object):
         # Each SRV phase takes 12 rounds. But the duration of the round depends
         # on how big the voting rounds are which differs between live and
         # testing network:
-        from onionbalance.hs_v3.onionbalance import my_onionbalance
-        if my_onionbalance.is_testnet:
+        if self.is_testnet():
             return (12 * 20) // 60
         else:
             return 12 * 60
@@ -165,8 +693,7 @@ class Consensus(object):
         """
         Get the HSv3 time period length in minutes
         """
-        from onionbalance.hs_v3.onionbalance import my_onionbalance
-        if my_onionbalance.is_testnet:
+        if self.is_testnet():
             # This is a chutney network! Use hs_common.c:get_time_period_length()
             # logic to calculate time period length
             return (24 * 20) // 60
@@ -234,14 +761,12 @@ class Consensus(object):
 
         TODO: unittest
         """
-        from onionbalance.hs_v3.onionbalance import my_onionbalance
-
         assert (self.is_live())
 
         beginning_of_current_round = stem.util.datetime_to_unix(self.consensus.valid_after)
 
         # Voting interval is 20 secs in chutney and one hour in real network
-        if my_onionbalance.is_testnet:
+        if self.is_testnet():
             voting_interval_secs = 20
         else:
             voting_interval_secs = 60 * 60
@@ -257,10 +782,8 @@ class Consensus(object):
         return int(beginning_of_current_round - time_elapsed_since_start_of_run)
 
     def get_start_time_of_previous_srv_run(self):
-        from onionbalance.hs_v3.onionbalance import my_onionbalance
-
         start_time_of_current_run = self.get_start_time_of_current_srv_run()
-        if my_onionbalance.is_testnet:
+        if self.is_testnet():
             return start_time_of_current_run - 24 * 20
         else:
             return start_time_of_current_run - 24 * 3600
@@ -282,5 +805,32 @@ class Consensus(object):
         return (start_of_next_tp_in_mins + time_period_rotation_offset) * 60
 
 
+class TimeContext(collections.namedtuple('TimeContext',
+                                         ['valid_after', 'time_period_length', 'time_period_num',
+                                          'current_srv_run_start', 'previous_srv_run_start',
+                                          'first_descriptor_srv_and_tp', 'second_descriptor_srv_and_tp'])):
+    """
+    The time periods and SRVs that follow from the valid-after time of a
+    consensus: the time period length (in minutes) and current time period
+    number, the start times of the current and previous SR protocol runs (unix
+    timestamps), and the (SRV, time period) pair of the first and second
+    descriptor.
+    """
+    __slots__ = ()
+
+    def get_srv_and_time_period(self, is_first_descriptor):
+        if is_first_descriptor:
+            return self.first_descriptor_srv_and_tp
+
+        return self.second_descriptor_srv_and_tp
+
+
+def _is_fresh(md_consensus):
+    """
+    Return True if 'md_consensus' is still valid.
+    """
+    return md_consensus is not None and datetime.datetime.utcnow() <= md_consensus.valid_until
+
+
 class NoLiveConsensus(Exception):
     pass
@@ -0,0 +1,175 @@
+"""
+A streaming parser for microdesc consensuses.
+
+stem's NetworkStatusDocumentV3 builds a full router status object for every
+relay of the consensus, but onionbalance only needs a handful of fields out of
+the document. This parser walks the document line by line and only keeps:
+
+- the valid-after, fresh-until and valid-until times,
+- the current and previous shared random values,
+- the fingerprint, flags, HSDir protocol versions and microdescriptor digest
+  of each relay.
+
+The results use the same attribute names as the stem objects, so they can be
+used in their place by the rest of the code.
+
+The document can be given as bytes or as any other buffer that supports
+find() and slicing, like an mmap.
+"""
+import base64
+import collections
+import datetime
+
+# The fields we keep out of the routerstatus entry of a relay. 'protocols' only
+# has the 'HSDir' entry (if the relay has one), e.g. { 'HSDir' : [1, 2] }.
+RouterStatusEntry = collections.namedtuple('RouterStatusEntry',
+                                           ['fingerprint', 'flags', 'protocols', 'microdescriptor_digest'])
+
+
+class MicrodescConsensus(object):
+    """
+    The fields of a microdesc consensus that onionbalance needs.
+    """
+
+    __slots__ = ('valid_after', 'fresh_until', 'valid_until',
+                 'shared_randomness_current_value', 'shared_randomness_previous_value',
+                 'routers')
+
+    def __init__(self):
+        # datetime objects
+        self.valid_after = None
+        self.fresh_until = None
+        self.valid_until = None
+        # The shared random values as base64 strings (None if the consensus
+        # does not have them)
+        self.shared_randomness_current_value = None
+        self.shared_randomness_previous_value = None
+        # dictionary { <hex fingerprint> : RouterStatusEntry , ... }
+        self.routers = {}
+
+
+def parse_md_consensus(document):
+    """
+    Parse the microdesc consensus in 'document' and return a
+    MicrodescConsensus.
+
+    Raise ValueError if 'document' is not a valid microdesc consensus.
+    """
+    lines = _iter_lines(document)
+
+    first_line = next(lines, b"").split()
+    if first_line[:2] != [b"network-status-version", b"3"] or first_line[2:] != [b"microdesc"]:
+        raise ValueError("Not a microdesc consensus")
+
+    consensus = MicrodescConsensus()
+    routers = consensus.routers
+
+    # The fields of the routerstatus entry we are currently parsing
+    fingerprint = None
+    flags = []
+    protocols = {}
+    microdescriptor_digest = None
+
+    for line in lines:
+        keyword, _, arguments = line.partition(b" ")
+
+        if keyword == b"r":
+            if fingerprint:
+                routers[fingerprint] = RouterStatusEntry(fingerprint, flags, protocols, microdescriptor_digest)
+
+            fingerprint = _parse_fingerprint(arguments)
+            flags = []
+            protocols = {}
+            microdescriptor_digest = None
+        elif keyword == b"m":
+            microdescriptor_digest = arguments.strip().decode('ascii')
+        elif keyword == b"s":
+            flags = arguments.decode('ascii').split()
+        elif keyword == b"pr":
+            protocols = _parse_hsdir_protocol(arguments)
+        elif keyword == b"directory-footer":
+            break
+        elif keyword == b"valid-after":
+            consensus.valid_after = _parse_timestamp(arguments)
+        elif keyword == b"fresh-until":
+            consensus.fresh_until = _parse_timestamp(arguments)
+        elif keyword == b"valid-until":
+            consensus.valid_until = _parse_timestamp(arguments)
+        elif keyword == b"shared-rand-current-value":
+            consensus.shared_randomness_current_value = _parse_shared_random_value(arguments)
+        elif keyword == b"shared-rand-previous-value":
+            consensus.shared_randomness_previous_value = _parse_shared_random_value(arguments)
+
+    if fingerprint:
+        routers[fingerprint] = RouterStatusEntry(fingerprint, flags, protocols, microdescriptor_digest)
+
+    if not consensus.valid_after or not consensus.valid_until:
+        raise ValueError("Consensus is missing its valid-after or valid-until time")
+
+    return consensus
+
+
+def _iter_lines(document):
+    """
+    Yield the lines of 'document' one at a time, without the newlines.
+    """
+    position = 0
+    length = len(document)
+
+    while position < length:
+        end = document.find(b"\n", position)
+        if end == -1:
+            end = length
+
+        yield document[position:end]
+        position = end + 1
+
+
+def _parse_fingerprint(arguments):
+    """
+    Return the hex fingerprint of an 'r' line (the identity is its second
+    field, in base64 without padding).
+    """
+    fields = arguments.split()
+    if len(fields) < 7:
+        raise ValueError("Malformed routerstatus line: r %s" % arguments)
+
+    try:
+        return base64.b64decode(fields[1] + b"=" * (-len(fields[1]) % 4)).hex().upper()
+    except ValueError:
+        raise ValueError("Malformed relay identity: %s" % fields[1])
+
+
+def _parse_hsdir_protocol(arguments):
+    """
+    Return { 'HSDir' : [<versions>] } out of a 'pr' line, or an empty
+    dictionary if it does not have an HSDir entry.
+    """
+    for entry in arguments.split():
+        if not entry.startswith(b"HSDir="):
+            continue
+
+        versions = []
+        for version_range in entry[len(b"HSDir="):].split(b","):
+            low, _, high = version_range.partition(b"-")
+            versions.extend(range(int(low), int(high or low) + 1))
+
+        return {'HSDir': versions}
+
+    return {}
+
+
+def _parse_timestamp(arguments):
+    return datetime.datetime.strptime(arguments.strip().decode('ascii'), "%Y-%m-%d %H:%M:%S")
+
+
+def _parse_shared_random_value(arguments):
+    """
+    Return the base64 shared random value of a 'shared-rand-*-value' line
+    (its fields are the number of reveals and the value).
+    """
+    fields = arguments.split()
+    if len(fields) != 2:
+        raise ValueError("Malformed shared random value: %s" % arguments)
+
+    return fields[1].decode('ascii')
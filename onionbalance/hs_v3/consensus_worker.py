@@ -0,0 +1,77 @@
+import threading
+import time
+
+from onionbalance.common import log
+from onionbalance.hs_v3 import params
+
+logger = log.get_logger()
+
+
+class ConsensusIngestWorker(object):
+    """
+    Ingests new consensuses on a dedicated thread.
+
+    Consensus arrival events come from the stem event thread. Handling them
+    there would hold back all the other control port events (e.g. the
+    descriptors we fetch) while we parse the consensus and rebuild everything
+    derived from it. Instead, the event handler just calls request_ingest(),
+    and the worker thread runs 'ingest' on its own.
+
+    Events that arrive while a consensus gets ingested, or within
+    CONSENSUS_INGEST_COALESCE_DELAY seconds of each other, are collapsed into
+    a single ingest.
+    """
+
+    def __init__(self, ingest):
+        # The function that ingests the latest consensus
+        self.ingest = ingest
+
+        # Set when there is a consensus to ingest
+        self._pending = threading.Event()
+        self._stopped = False
+
+        # Counters, so that we can tell how much coalescing happens
+        self.n_requests = 0
+        self.n_ingests = 0
+
+        self._thread = threading.Thread(target=self._run, name="consensus-ingest")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the worker once it's done with what it's doing.
+        """
+        self._stopped = True
+        self._pending.set()
+
+    def request_ingest(self):
+        """
+        Ask the worker to ingest the latest consensus. Return immediately.
+        """
+        self.n_requests += 1
+        self._pending.set()
+
+    def _run(self):
+        while True:
+            self._pending.wait()
+            if self._stopped:
+                return
+
+            # Let a burst of arrival events settle, so that it's ingested once
+            time.sleep(params.CONSENSUS_INGEST_COALESCE_DELAY)
+            self._pending.clear()
+            if self._stopped:
+                return
+
+            self.n_ingests += 1
+            logger.info("Ingesting new consensus (%d arrival events, %d ingests so far)",
+                        self.n_requests, self.n_ingests)
+
+            try:
+                self.ingest()
+            except Exception:
+                # Keep the worker alive for the next consensus
+                logger.exception("Failed to ingest new consensus")
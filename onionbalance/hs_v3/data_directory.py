@@ -0,0 +1,83 @@
+import mmap
+import os
+
+from onionbalance.common import log
+
+logger = log.get_logger()
+
+# The files where Tor caches the current microdesc consensus and the
+# microdescriptors (the '.new' file is the journal of the latter)
+CONSENSUS_FILENAME = "cached-microdesc-consensus"
+MICRODESCRIPTOR_FILENAMES = ["cached-microdescs", "cached-microdescs.new"]
+
+
+class TorDataDirectory(object):
+    """
+    Gives access to the consensus and microdescriptors that our Tor caches in
+    its DataDirectory.
+
+    When onionbalance runs next to its Tor, reading these files saves us from
+    transferring them over the control port. The files are memory-mapped so
+    they can be parsed without copying them around.
+
+    Tor replaces the consensus file when it gets a new consensus, so we keep
+    track of the identity of the file we last read, to know if there is a new
+    one to read.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # (device, inode, mtime, size) of the consensus file we last read
+        self._consensus_file_id = None
+
+    def get_consensus(self):
+        """
+        Return an mmap of the consensus file if it has been replaced since the
+        last time we read it, or None if it's still the same file.
+
+        Raise OSError if the file can't be read.
+        """
+        consensus_path = os.path.join(self.path, CONSENSUS_FILENAME)
+
+        with open(consensus_path, 'rb') as consensus_file:
+            file_stat = os.fstat(consensus_file.fileno())
+            file_id = (file_stat.st_dev, file_stat.st_ino, file_stat.st_mtime_ns, file_stat.st_size)
+            if file_id == self._consensus_file_id:
+                return None
+
+            consensus_map = _map_file(consensus_file)
+
+        self._consensus_file_id = file_id
+        return consensus_map
+
+    def get_microdescriptor_maps(self):
+        """
+        Return a list with an mmap of each of the microdescriptor files that
+        exist and are not empty.
+
+        Raise OSError if a file exists but can't be read.
+        """
+        microdescriptor_maps = []
+
+        for filename in MICRODESCRIPTOR_FILENAMES:
+            try:
+                with open(os.path.join(self.path, filename), 'rb') as microdescriptor_file:
+                    microdescriptor_map = _map_file(microdescriptor_file)
+            except FileNotFoundError:
+                continue
+
+            if microdescriptor_map is not None:
+                microdescriptor_maps.append(microdescriptor_map)
+
+        return microdescriptor_maps
+
+
+def _map_file(open_file):
+    """
+    Return a read-only mmap of 'open_file', or None if it's empty (empty
+    files can't be mapped).
+    """
+    if os.fstat(open_file.fileno()).st_size == 0:
+        return None
+
+    return mmap.mmap(open_file.fileno(), 0, access=mmap.ACCESS_READ)
@@ -1,9 +1,14 @@
+import array
+import collections
 import datetime
 import hashlib
 import itertools
+import random
+import sys
+import threading
 
 import stem.util
-from stem.descriptor.hidden_service import HiddenServiceDescriptorV3, InnerLayer
+from stem.descriptor.hidden_service import HiddenServiceDescriptorV3, InnerLayer, OuterLayer
 from stem.descriptor.certificate import Ed25519CertificateV1, Ed25519Extension, ExtensionType
 
 from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
@@ -65,6 +70,97 @@ class IntroductionPointSetV3(intro_point_set.IntroductionPointSet):
         # TODO: unittests
         return intro_set_1 == intro_set_2
 
+    def choose_within_size(self, count, max_size):
+        """
+        Like choose() but only return the intro points that fit in a descriptor
+        of at most 'max_size' bytes.
+
+        The intro points are taken breadth first across the instances, so that
+        when some of them don't fit, the ones that are dropped come from the
+        instances that contribute the most intro points.
+        """
+        candidate_ips = self.choose(count, shuffle=False)
+
+        # The descriptor size doesn't always grow with the intro points (see
+        # estimate_descriptor_size()), so look at all of them
+        n_fitting_ips = 0
+        intro_points_size = 0
+        for n_ips, intro_point in enumerate(candidate_ips, 1):
+            intro_points_size += get_intro_point_size(intro_point)
+            if estimate_descriptor_size(intro_points_size) <= max_size:
+                n_fitting_ips = n_ips
+
+        chosen_ips = candidate_ips[:n_fitting_ips]
+        random.shuffle(chosen_ips)
+        return chosen_ips
+
+
+def get_intro_point_size(intro_point):
+    """
+    Return the size of 'intro_point' in the inner layer of a descriptor, with
+    its link specifiers and certificates.
+
+    The certificates of our descriptors are the recertified ones, but those
+    have the same size.
+    """
+    # Intro points are separated by a newline
+    return len(intro_point.encode()) + 1
+
+
+def estimate_descriptor_size(intro_points_size):
+    """
+    Return the size of a descriptor whose intro points take
+    'intro_points_size' bytes (see get_intro_point_size()), without encoding
+    it.
+
+    This is an upper bound: only the revision counter of the descriptor may
+    take less room.
+    """
+    inner_layer_size = INNER_LAYER_BASE_SIZE + intro_points_size
+    outer_layer_size = OUTER_LAYER_BASE_SIZE + _get_encrypted_message_size(inner_layer_size)
+    # stem pads the outer layer with as many NUL bytes as its size modulo
+    # 10000 before encrypting it
+    outer_layer_size += outer_layer_size % 10000
+    return DESCRIPTOR_BASE_SIZE + _get_encrypted_message_size(outer_layer_size)
+
+
+def _get_encrypted_message_size(plaintext_size):
+    """
+    Return the size of the MESSAGE block with the encryption of
+    'plaintext_size' bytes: the salt, ciphertext and MAC in base64 lines of 64
+    characters, within the BEGIN and END lines.
+    """
+    # salt + ciphertext + MAC
+    n_bytes = 16 + plaintext_size + 32
+    base64_size = 4 * ((n_bytes + 2) // 3)
+    n_lines = (base64_size + 63) // 64
+    return len("-----BEGIN MESSAGE-----\n") + base64_size + n_lines - 1 + len("\n-----END MESSAGE-----")
+
+
+def _get_base_sizes():
+    """
+    Return the sizes of the parts of a descriptor that don't depend on its
+    intro points, as the installed stem encodes them: the inner layer without
+    intro points, the outer layer without its 'encrypted' message (stem adds
+    fake 'auth-client' lines to it), and the descriptor without its
+    'superencrypted' message (with the longest revision counter).
+
+    They are measured on an empty descriptor that stem encodes for us.
+    """
+    inner_layer = InnerLayer.create(introduction_points=[])
+    outer_layer = OuterLayer.create(inner_layer=inner_layer)
+    inner_layer_size = len(inner_layer.get_bytes())
+    outer_layer_size = len(outer_layer.get_bytes())
+    desc = HiddenServiceDescriptorV3.content(outer_layer=outer_layer, revision_counter=2**64 - 1)
+
+    inner_layer_base_size = inner_layer_size
+    outer_layer_base_size = outer_layer_size - _get_encrypted_message_size(inner_layer_size)
+    descriptor_base_size = len(desc) - _get_encrypted_message_size(outer_layer_size + outer_layer_size % 10000)
+    return inner_layer_base_size, outer_layer_base_size, descriptor_base_size
+
+
+INNER_LAYER_BASE_SIZE, OUTER_LAYER_BASE_SIZE, DESCRIPTOR_BASE_SIZE = _get_base_sizes()
+
 
 class V3Descriptor(object):
     """
@@ -74,13 +170,16 @@ class V3Descriptor(object):
     implement more specific functionalities.
     """
 
-    def __init__(self, onion_address, v3_desc):
+    def __init__(self, onion_address, v3_desc, intro_points=None):
         self.onion_address = onion_address
 
         self.v3_desc = v3_desc
 
+        if intro_points is None:
+            intro_points = self.v3_desc._inner_layer.introduction_points
+
         # An IntroductionPointSetV3 object with the intros of this descriptor
-        self.intro_set = IntroductionPointSetV3([self.v3_desc._inner_layer.introduction_points])
+        self.intro_set = IntroductionPointSetV3([intro_points])
 
     def get_intro_points(self):
         """
@@ -97,12 +196,6 @@ class V3Descriptor(object):
         # the blinded key. So the signing key should be the one we want here.
         return self.v3_desc.signing_cert.signing_key()
 
-    def get_size(self):
-        """
-        Return size of v3 descriptor in bytes
-        """
-        return len(str(self.v3_desc))
-
 
 class OBDescriptor(V3Descriptor):
     """
@@ -115,7 +208,8 @@ class OBDescriptor(V3Descriptor):
     """
 
     def __init__(self, onion_address, identity_priv_key,
-                 blinding_param, intro_points, is_first_desc):
+                 blinding_param, intro_points, is_first_desc, revision_counter=None,
+                 recertifier=None):
         # Timestamp of the last attempt to assemble this descriptor
         self.last_publish_attempt_ts = None
         # Timestamp we last uploaded this descriptor
@@ -123,39 +217,57 @@ class OBDescriptor(V3Descriptor):
         # Set of responsible HSDirs for last time we uploaded this descriptor
         self.responsible_hsdirs = None
 
-        # Start generating descriptor
-        desc_signing_key = Ed25519PrivateKey.generate()
+        # Get the signing key for this descriptor and the intro points
+        # recertified with it. Without a recertifier kept by the service, we
+        # start from scratch.
+        if recertifier is None:
+            recertifier = IntroPointRecertifier()
+        desc_signing_key, recertified_intro_points = recertifier.recertify_intro_points(intro_points, blinding_param)
 
-        # Get the intro points for this descriptor and recertify them!
-        recertified_intro_points = []
-        for ip in intro_points:
-            recertified_intro_points.append(self._recertify_intro_point(ip, desc_signing_key))
-
-        rev_counter = self._get_revision_counter(identity_priv_key, is_first_desc)
+        rev_counter = self._get_revision_counter(identity_priv_key, is_first_desc, revision_counter)
 
         v3_desc_inner_layer = InnerLayer.create(introduction_points=recertified_intro_points)
-        v3_desc = HiddenServiceDescriptorV3.create(
+        # Encode the descriptor once. These are the bytes that get checked,
+        # logged and uploaded.
+        self.descriptor_bytes = HiddenServiceDescriptorV3.content(
             blinding_nonce=blinding_param,
             identity_key=identity_priv_key,
             signing_key=desc_signing_key,
             inner_layer=v3_desc_inner_layer,
             revision_counter=int(rev_counter),
         )
+        # We just encoded it ourselves, so there is no need to validate it.
+        # Its fields get parsed if they are ever needed.
+        v3_desc = HiddenServiceDescriptorV3(self.descriptor_bytes, validate=False)
 
         # TODO stem should probably initialize it itself so that it has balance
         # between descriptor creation (where this is not inted) and descriptor
         # parsing (where this is inited)
         v3_desc._inner_layer = v3_desc_inner_layer
 
-        # Check max size is within range
-        if len(str(v3_desc)) > params.MAX_DESCRIPTOR_SIZE:
-            logger.error("Created descriptor is too big (%d intros). Consider "
+        # Check max size is within range. The intro points were picked to fit
+        # (see IntroductionPointSetV3.choose_within_size()), so this is where
+        # we confirm it.
+        if len(self.descriptor_bytes) > params.MAX_DESCRIPTOR_SIZE:
+            logger.error("Created descriptor is too big (%d bytes, %d intros). Consider "
                          "relaxing number of instances or intro points per instance "
-                         "(see N_INTROS_PER_INSTANCE)", len(recertified_intro_points))
+                         "(see N_INTROS_PER_INSTANCE)", len(self.descriptor_bytes), len(recertified_intro_points))
             raise BadDescriptor
 
         super().__init__(onion_address, v3_desc)
 
+    def get_size(self):
+        """
+        Return size of v3 descriptor in bytes
+        """
+        return len(self.descriptor_bytes)
+
+    def get_text(self):
+        """
+        Return the descriptor as we upload it.
+        """
+        return self.descriptor_bytes.decode('utf-8')
+
     def set_last_publish_attempt_ts(self, last_publish_attempt_ts):
         self.last_publish_attempt_ts = last_publish_attempt_ts
 
@@ -165,81 +277,32 @@ class OBDescriptor(V3Descriptor):
     def set_responsible_hsdirs(self, responsible_hsdirs):
         self.responsible_hsdirs = responsible_hsdirs
 
-    def _recertify_intro_point(self, intro_point, descriptor_signing_key):
-        """
-        Given an IntroductionPointV3 object, re-certify it using the
-        'descriptor_signing_key' for this new descriptor.
-
-        Return the recertified intro point.
-        """
-        original_auth_key_cert = intro_point.auth_key_cert
-        original_enc_key_cert = intro_point.enc_key_cert
-
-        # We have already removed all the intros with legacy keys. Make sure that
-        # no legacy intros sneaks up on us, becausey they would result in
-        # unparseable descriptors if we don't recertify them (and we won't).
-        assert (not intro_point.legacy_key_cert)
-
-        # Get all the certs we need to recertify
-        # [we need to use the _replace method of namedtuples because there is no
-        # setter for those attributes due to the way stem sets those fields. If we
-        # attempt to normally replace the attributes we get the following
-        # exception: AttributeError: can't set attribute]
-        recertified_intro_point = intro_point._replace(auth_key_cert=self._recertify_ed_certificate(original_auth_key_cert,
-                                                                                                    descriptor_signing_key),
-                                                       enc_key_cert=self._recertify_ed_certificate(original_enc_key_cert,
-                                                                                                   descriptor_signing_key))
-
-        return recertified_intro_point
-
-    def _recertify_ed_certificate(self, ed_cert, descriptor_signing_key):
-        """
-        Recertify an HSv3 intro point certificate using the new descriptor signing
-        key so that it can be accepted as part of a new descriptor.
-
-        "Recertifying" means taking the certified key and signing it with a new
-        key.
-
-        Return the new certificate.
-        """
-        # pylint: disable=no-member
-        extensions = [Ed25519Extension(ExtensionType.HAS_SIGNING_KEY, None, stem.util._pubkey_bytes(descriptor_signing_key))]
-        new_cert = Ed25519CertificateV1(cert_type=ed_cert.type,
-                                        expiration=ed_cert.expiration,
-                                        key_type=ed_cert.key_type,
-                                        key=ed_cert.key,
-                                        extensions=extensions,
-                                        signing_key=descriptor_signing_key)
-
-        return new_cert
-
-    def _get_revision_counter(self, identity_priv_key, is_first_desc):
+    def _get_revision_counter(self, identity_priv_key, is_first_desc, revision_counter=None):
         """
         Get the revision counter using the order-preserving-encryption scheme from
         rend-spec-v3.txt section F.2.
+
+        'revision_counter' is the RevisionCounter of the service, if it keeps
+        one across descriptors.
         """
         from onionbalance.hs_v3.onionbalance import my_onionbalance
         now = int(stem.util.datetime_to_unix(datetime.datetime.utcnow()))
 
-        # TODO: Mention that this is done with the private key instead of the blinded priv key
-        # this means that this won't cooperate with normal tor
-        privkey_bytes = identity_priv_key.private_bytes(encoding=serialization.Encoding.Raw,
-                                                        format=serialization.PrivateFormat.Raw,
-                                                        encryption_algorithm=serialization.NoEncryption())
-        cipher_key = hashlib.sha3_256(b"rev-counter-generation" + privkey_bytes).digest()
+        if revision_counter is None:
+            revision_counter = RevisionCounter(identity_priv_key)
 
+        time_context = my_onionbalance.consensus.get_time_context()
         if is_first_desc:
-            srv_start = my_onionbalance.consensus.get_start_time_of_previous_srv_run()
+            srv_start = time_context.previous_srv_run_start
         else:
-            srv_start = my_onionbalance.consensus.get_start_time_of_current_srv_run()
+            srv_start = time_context.current_srv_run_start
         srv_start = int(srv_start)
 
         seconds_since_srv_start = now - srv_start
         # This must be strictly positive
         seconds_since_srv_start += 1
 
-        ope_result = sum(w for w, _ in zip(self._get_ope_scheme_words(cipher_key),
-                                           range(seconds_since_srv_start)))
+        ope_result = revision_counter.get(srv_start, seconds_since_srv_start)
 
         logger.debug("Rev counter for %s descriptor (SRV secs %s, OPE %s)",
                      "first" if is_first_desc else "second",
@@ -247,14 +310,195 @@ class OBDescriptor(V3Descriptor):
 
         return ope_result
 
-    def _get_ope_scheme_words(self, cipher_key):
+
+class IntroPointRecertifier(object):
+    """
+    Keeps the descriptor signing keys of a service, and the intro point
+    certificates recertified with them.
+
+    A descriptor signing key is kept for as long as its time period lasts
+    (i.e. per blinding parameter), so that the intro points of the next
+    descriptors of the same time period don't need to be recertified again.
+    Only the intro points that are new since the last descriptor get new
+    certificates.
+    """
+
+    # How many time periods to keep signing keys for (the ones of the first
+    # and second descriptors)
+    N_SIGNING_KEYS = 2
+
+    def __init__(self):
+        # dictionary { <blinding param> : <descriptor signing key> , ... }
+        # with the oldest time period first
+        self.signing_keys = collections.OrderedDict()
+        # dictionary { <blinding param> : { <certificate id> : <recertified certificate> , ... } , ... }
+        # with the certificates of the last descriptor of each time period
+        self.certificates = {}
+        # Descriptors can be built from more than one thread
+        self.lock = threading.RLock()
+
+    def get_signing_key(self, blinding_param):
+        """
+        Return the descriptor signing key of the time period of
+        'blinding_param'.
+        """
+        with self.lock:
+            if blinding_param not in self.signing_keys:
+                self.signing_keys[blinding_param] = Ed25519PrivateKey.generate()
+
+                while len(self.signing_keys) > self.N_SIGNING_KEYS:
+                    old_blinding_param, _ = self.signing_keys.popitem(last=False)
+                    self.certificates.pop(old_blinding_param, None)
+
+            return self.signing_keys[blinding_param]
+
+    def recertify_intro_points(self, intro_points, blinding_param):
+        """
+        Recertify the 'intro_points' of a descriptor with the signing key of
+        the time period of 'blinding_param'.
+
+        Return the signing key and the recertified intro points.
+        """
+        with self.lock:
+            signing_key = self.get_signing_key(blinding_param)
+            previous_certificates = self.certificates.get(blinding_param, {})
+            certificates = {}
+
+            recertified_intro_points = []
+            for intro_point in intro_points:
+                # We have already removed all the intros with legacy keys. Make
+                # sure that no legacy intros sneaks up on us, becausey they
+                # would result in unparseable descriptors if we don't
+                # recertify them (and we won't).
+                assert (not intro_point.legacy_key_cert)
+
+                # [we need to use the _replace method of namedtuples because
+                # there is no setter for those attributes due to the way stem
+                # sets those fields. If we attempt to normally replace the
+                # attributes we get the following exception: AttributeError:
+                # can't set attribute]
+                recertified_intro_points.append(intro_point._replace(
+                    auth_key_cert=self._recertify(intro_point.auth_key_cert, signing_key,
+                                                  previous_certificates, certificates),
+                    enc_key_cert=self._recertify(intro_point.enc_key_cert, signing_key,
+                                                 previous_certificates, certificates)))
+
+            # Only keep the certificates of the intro points still in use
+            self.certificates[blinding_param] = certificates
+
+        logger.debug("Recertified %d intro points (%d certificates reused)",
+                     len(recertified_intro_points),
+                     len(set(certificates).intersection(previous_certificates)))
+
+        return signing_key, recertified_intro_points
+
+    def _recertify(self, ed_cert, signing_key, previous_certificates, certificates):
+        """
+        Return 'ed_cert' recertified with 'signing_key', reusing the one in
+        'previous_certificates' if there is one, and add it to 'certificates'.
+        """
+        certificate_id = (ed_cert.type, ed_cert.key_type, ed_cert.key, ed_cert.expiration)
+
+        new_cert = previous_certificates.get(certificate_id)
+        if new_cert is None:
+            new_cert = _recertify_ed_certificate(ed_cert, signing_key)
+
+        certificates[certificate_id] = new_cert
+        return new_cert
+
+
+def _recertify_ed_certificate(ed_cert, descriptor_signing_key):
+    """
+    Recertify an HSv3 intro point certificate using the new descriptor signing
+    key so that it can be accepted as part of a new descriptor.
+
+    "Recertifying" means taking the certified key and signing it with a new
+    key.
+
+    Return the new certificate.
+    """
+    # pylint: disable=no-member
+    extensions = [Ed25519Extension(ExtensionType.HAS_SIGNING_KEY, None, stem.util._pubkey_bytes(descriptor_signing_key))]
+    new_cert = Ed25519CertificateV1(cert_type=ed_cert.type,
+                                    expiration=ed_cert.expiration,
+                                    key_type=ed_cert.key_type,
+                                    key=ed_cert.key,
+                                    extensions=extensions,
+                                    signing_key=descriptor_signing_key)
+
+    return new_cert
+
+
+class RevisionCounter(object):
+    """
+    Computes the revision counters of the descriptors of a service, with the
+    order-preserving encryption scheme of rend-spec-v3.txt section F.2.
+
+    The revision counter for the 'n'th second of an SRV run is the sum of the
+    first 'n' words of an AES-CTR keystream (plus one each). Since it only grows
+    within an SRV run, we keep a checkpoint of where we stopped for the latest
+    SRV runs, and the next revision counter of the same run only needs the
+    words of the seconds that passed since.
+    """
+
+    # How many SRV runs to keep checkpoints for (the runs of the first and
+    # second descriptors)
+    N_CHECKPOINTS = 2
+
+    def __init__(self, identity_priv_key):
+        # TODO: Mention that this is done with the private key instead of the blinded priv key
+        # this means that this won't cooperate with normal tor
+        privkey_bytes = identity_priv_key.private_bytes(encoding=serialization.Encoding.Raw,
+                                                        format=serialization.PrivateFormat.Raw,
+                                                        encryption_algorithm=serialization.NoEncryption())
+        self.cipher_key = hashlib.sha3_256(b"rev-counter-generation" + privkey_bytes).digest()
+
+        # dictionary { <SRV run start> : [<number of words>, <sum of words>, <keystream encryptor>] , ... }
+        self.checkpoints = {}
+        # Descriptors can be built from more than one thread
+        self.lock = threading.Lock()
+
+    def get(self, srv_start, n_words):
+        """
+        Return the OPE of 'n_words' (the seconds since the start of the SRV run
+        that started at 'srv_start', plus one).
+        """
+        with self.lock:
+            checkpoint = self.checkpoints.get(srv_start)
+            if checkpoint is None or checkpoint[0] > n_words:
+                # The clock may go backwards, in which case we start over
+                checkpoint = [0, 0, self._get_encryptor()]
+                self.checkpoints[srv_start] = checkpoint
+
+                # Forget the SRV runs that we don't need anymore
+                for old_srv_start in sorted(self.checkpoints)[:-self.N_CHECKPOINTS]:
+                    del self.checkpoints[old_srv_start]
+
+            checkpoint[1] += _sum_ope_words(checkpoint[2], n_words - checkpoint[0])
+            checkpoint[0] = n_words
+
+            return checkpoint[1]
+
+    def _get_encryptor(self):
         IV = b'\x00' * 16
 
-        cipher = Cipher(algorithms.AES(cipher_key), modes.CTR(IV), backend=backend)
-        e = cipher.encryptor()
-        while True:
-            v = e.update(b'\x00\x00')
-            yield v[0] + 256 * v[1] + 1
+        cipher = Cipher(algorithms.AES(self.cipher_key), modes.CTR(IV), backend=backend)
+        return cipher.encryptor()
+
+
+def _sum_ope_words(encryptor, n_words):
+    """
+    Return the sum of the next 'n_words' OPE words out of the keystream of
+    'encryptor'.
+
+    Each word is a little-endian 16-bit keystream value plus one. The whole
+    keystream is generated with a single call and summed in C.
+    """
+    words = array.array('H', encryptor.update(b'\x00\x00' * n_words))
+    if sys.byteorder == 'big':
+        words.byteswap()
+
+    return sum(words) + n_words
 
 
 class ReceivedDescriptor(V3Descriptor):
@@ -264,24 +508,31 @@ class ReceivedDescriptor(V3Descriptor):
     This class supports parsing descriptors.
     """
 
-    def __init__(self, desc_text, onion_address):
+    def __init__(self, desc_text, onion_address, record=None):
         """
         Parse a descriptor in 'desc_text' and return an ReceivedDescriptor object.
 
+        If 'record' is set, it's the ReceivedDescriptorRecord that a descriptor
+        worker already made out of 'desc_text' (see
+        parse_received_descriptor()), and 'desc_text' is not parsed again.
+
         Raises BadDescriptor if the descriptor cannot be used.
         """
-        try:
-            v3_desc = HiddenServiceDescriptorV3.from_str(desc_text)
-            v3_desc.decrypt(onion_address)
-        except ValueError as err:
-            logger.warning("Descriptor is corrupted (%s).", err)
-            raise BadDescriptor
+        if record is None:
+            record = parse_received_descriptor(desc_text, onion_address)
 
         self.received_ts = datetime.datetime.utcnow()
 
-        logger.debug("Successfuly decrypted descriptor for %s!", onion_address)
+        # The (revision counter, signing certificate) of this descriptor, to
+        # recognize it when we receive it again
+        self.header = record.header
+        self.blinded_key = record.blinded_key
 
-        super().__init__(onion_address, v3_desc)
+        # We only keep the intro points of the parsed descriptor
+        super().__init__(onion_address, None, record.intro_points)
+
+    def get_blinded_key(self):
+        return self.blinded_key
 
     def is_old(self):
         """
@@ -303,6 +554,77 @@ class ReceivedDescriptor(V3Descriptor):
 
         return False
 
+    def set_received_ts(self, received_ts):
+        self.received_ts = received_ts
+
+
+class ReceivedDescriptorRecord(object):
+    """
+    What we keep of a received descriptor once it's parsed and decrypted.
+
+    It's small enough to be sent back from a descriptor worker process.
+    """
+
+    __slots__ = ('header', 'blinded_key', 'intro_points')
+
+    def __init__(self, header, blinded_key, intro_points):
+        # The header of the descriptor (see get_descriptor_header())
+        self.header = header
+        self.blinded_key = blinded_key
+        # A list of stem.descriptor.hidden_service.IntroductionPointV3 objects
+        self.intro_points = intro_points
+
+
+def parse_received_descriptor(desc_text, onion_address):
+    """
+    Parse and decrypt the descriptor of 'onion_address' in 'desc_text' and
+    return its ReceivedDescriptorRecord.
+
+    This may run in a descriptor worker process.
+
+    Raises BadDescriptor if the descriptor cannot be used.
+    """
+    try:
+        v3_desc = HiddenServiceDescriptorV3.from_str(desc_text)
+        inner_layer = v3_desc.decrypt(onion_address)
+    except ValueError as err:
+        logger.warning("Descriptor is corrupted (%s).", err)
+        raise BadDescriptor
+
+    logger.debug("Successfuly decrypted descriptor for %s!", onion_address)
+
+    return ReceivedDescriptorRecord(get_descriptor_header(desc_text), v3_desc.signing_cert.signing_key(),
+                                    inner_layer.introduction_points)
+
+
+def get_descriptor_header(desc_text):
+    """
+    Return the (revision counter, descriptor signing certificate) of the
+    descriptor in 'desc_text' (bytes), read out of its plaintext header
+    without parsing the rest of it. Together, they tell apart the
+    descriptors of an instance.
+
+    Return None if the header is not what we expect.
+    """
+    header_end = desc_text.find(b"\nsuperencrypted\n")
+    if header_end < 0:
+        return None
+    header = desc_text[:header_end + 1]
+
+    cert_start = header.find(b"\ndescriptor-signing-key-cert\n")
+    cert_end = header.find(b"-----END ED25519 CERT-----\n", cert_start)
+    counter_start = header.find(b"\nrevision-counter ")
+    if cert_start < 0 or cert_end < 0 or counter_start < 0:
+        return None
+
+    counter_start += len(b"\nrevision-counter ")
+    try:
+        revision_counter = int(header[counter_start:header.index(b"\n", counter_start)])
+    except ValueError:
+        return None
+
+    return revision_counter, header[cert_start:cert_end]
+
 
 class BadDescriptor(Exception):
     pass
@@ -0,0 +1,184 @@
+import concurrent.futures
+import queue
+import threading
+
+from onionbalance.common import log
+from onionbalance.common import util
+from onionbalance.hs_v3 import descriptor
+from onionbalance.hs_v3 import params
+
+logger = log.get_logger()
+
+
+class DescriptorParseWorker(object):
+    """
+    Parses and decrypts the instance descriptors we receive, off the stem
+    event thread.
+
+    Descriptors arrive in bursts on each fetch round (tor asks several HSDirs
+    for the descriptor of each instance). Parsing them on the stem event
+    thread would hold back all the other control port events. Instead, the
+    event handler just calls submit() to queue them, and a single worker
+    thread takes them out of the queue in the order they arrived and calls
+    'register' with each of them. Instances are only updated from that
+    thread.
+
+    With DESCRIPTOR_PARSE_WORKERS worker processes, submit() also hands each
+    descriptor to them, so that they get parsed and decrypted in parallel
+    while they wait in the queue. The worker thread then gets their
+    ReceivedDescriptorRecord instead of parsing them itself. A descriptor that
+    is already being parsed is not parsed again.
+
+    The queue holds at most DESCRIPTOR_PARSE_QUEUE_SIZE descriptors. When it's
+    full, submit() blocks until there is room again, which also stops stem
+    from reading more events off the control port.
+    """
+
+    def __init__(self, register):
+        # The function that registers a received descriptor to our instances:
+        # register(onion_address, descriptor_text, record) where 'record' is
+        # None if the descriptor was not parsed by a worker process
+        self.register = register
+
+        self._queue = queue.Queue(maxsize=params.DESCRIPTOR_PARSE_QUEUE_SIZE)
+        self._stopped = False
+
+        self._executor = None
+        if params.DESCRIPTOR_PARSE_WORKERS:
+            self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=params.DESCRIPTOR_PARSE_WORKERS,
+                                                                    mp_context=util.get_worker_process_context())
+        # dictionary { <onion address> : <header of the last descriptor handed to the workers> , ... }
+        self._parsed_headers = {}
+
+        # Counters, so that we can tell how busy the queue gets
+        self.n_submitted = 0
+        self.n_handled = 0
+        self.n_parsed_in_workers = 0
+        self.n_duplicates = 0
+        self.n_blocked = 0
+        self.max_queue_depth = 0
+
+        self._thread = threading.Thread(target=self._run, name="descriptor-parse")
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop the worker, dropping the descriptors that wait in the queue, and
+        wait until it's done with the descriptor it's handling.
+        """
+        self._stopped = True
+
+        # Make room for the wake up call, and don't parse what we drop
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if item and item[2]:
+                item[2].cancel()
+            self._queue.task_done()
+        try:
+            self._queue.put_nowait(None)
+        except queue.Full:
+            # A late submit() filled it again: the worker thread will see that
+            # we stopped after the next descriptor
+            pass
+
+        if self._executor:
+            self._executor.shutdown(wait=True)
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def get_queue_depth(self):
+        """
+        Return how many descriptors wait to be handled.
+        """
+        return self._queue.qsize()
+
+    def wait(self):
+        """
+        Block until all the queued descriptors are handled.
+        """
+        self._queue.join()
+
+    def submit(self, onion_address, descriptor_text):
+        """
+        Queue 'descriptor_text', a descriptor we received for 'onion_address'.
+        Block while the queue is full.
+        """
+        if self._stopped:
+            return
+
+        future = None
+        if self._executor:
+            header = descriptor.get_descriptor_header(descriptor_text)
+            if header is not None and self._parsed_headers.get(onion_address) == header:
+                # The worker thread will recognize it when it registers it
+                self.n_duplicates += 1
+            else:
+                self._parsed_headers[onion_address] = header
+                future = self._submit_parse(onion_address, descriptor_text)
+
+        if self._queue.full():
+            self.n_blocked += 1
+            logger.info("Descriptor queue is full (%d descriptors). Waiting...", self._queue.maxsize)
+
+        self._queue.put((onion_address, descriptor_text, future))
+        self.n_submitted += 1
+        self.max_queue_depth = max(self.max_queue_depth, self._queue.qsize())
+
+    def _submit_parse(self, onion_address, descriptor_text):
+        """
+        Hand 'descriptor_text' to the worker processes and return the future of
+        its ReceivedDescriptorRecord, or None if they can't take it.
+        """
+        try:
+            return self._executor.submit(descriptor.parse_received_descriptor, descriptor_text, onion_address)
+        except RuntimeError as e:
+            # The pool broke (e.g. a worker process was killed) or got shut
+            # down: parse on the worker thread from now on
+            logger.warning("Descriptor worker processes are not available (%s). Parsing descriptors "
+                           "on the descriptor worker thread instead.", e)
+            self._executor = None
+            return None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if self._stopped or item is None:
+                    return
+
+                self._handle(*item)
+            finally:
+                self._queue.task_done()
+
+            if self._queue.empty():
+                logger.info("Handled all received descriptors (%d so far, %d parsed in worker processes, "
+                            "%d duplicates, max queue depth %d, %d full queue waits)",
+                            self.n_handled, self.n_parsed_in_workers, self.n_duplicates,
+                            self.max_queue_depth, self.n_blocked)
+
+    def _handle(self, onion_address, descriptor_text, future):
+        self.n_handled += 1
+
+        record = None
+        if future:
+            try:
+                record = future.result()
+                self.n_parsed_in_workers += 1
+            except descriptor.BadDescriptor:
+                logger.warning("Received bad descriptor for %s. Ignoring.", onion_address)
+                return
+            except Exception:
+                # Parse it on this thread instead
+                logger.exception("Descriptor worker failed to parse descriptor for %s", onion_address)
+
+        try:
+            self.register(onion_address, descriptor_text, record)
+        except Exception:
+            # Keep the worker alive for the next descriptors
+            logger.exception("Failed to register descriptor for %s", onion_address)
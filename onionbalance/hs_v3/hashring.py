@@ -1,18 +1,45 @@
 import base64
 import bisect
+import collections
+import concurrent.futures
 import hashlib
+import weakref
 
 import stem.util
+import stem.descriptor.hidden_service
 
 from onionbalance.common import log
+from onionbalance.common import util
 
 from onionbalance.hs_v3 import tor_node
 from onionbalance.hs_v3 import params
 
 logger = log.get_logger()
 
+# Length of a node or hidden service index in the hash ring (SHA3-256 digest)
+HSDIR_INDEX_LEN = 32
+# Length of a raw relay fingerprint
+FINGERPRINT_LEN = 20
+# Length of a raw ed25519 node identity
+ED25519_IDENTITY_LEN = 32
 
-def _time_between_tp_and_srv(valid_after):
+
+def _get_consensus(consensus):
+    """
+    Return 'consensus', or the consensus of the running onionbalance if it's
+    None.
+
+    Passing a consensus explicitly allows using this module without the global
+    onionbalance object (e.g. from the offline HSDir calculator).
+    """
+    if consensus is not None:
+        return consensus
+
+    from onionbalance.hs_v3.onionbalance import my_onionbalance
+    return my_onionbalance.consensus
+
+
+def _time_between_tp_and_srv(valid_after, consensus=None):
     """
      Return True if we are currently in the time segment between a new time
      period and a new SRV (in the real network that happens between 12:00 and
@@ -28,10 +55,10 @@ def _time_between_tp_and_srv(valid_after):
         |                                                                  |
         +------------------------------------------------------------------+
     """
-    from onionbalance.hs_v3.onionbalance import my_onionbalance
+    consensus = _get_consensus(consensus)
 
-    srv_start_time = my_onionbalance.consensus.get_start_time_of_current_srv_run()
-    tp_start_time = my_onionbalance.consensus.get_start_time_of_next_time_period(srv_start_time)
+    srv_start_time = consensus.get_start_time_of_current_srv_run()
+    tp_start_time = consensus.get_start_time_of_next_time_period(srv_start_time)
     valid_after = stem.util.datetime_to_unix(valid_after)
 
     if valid_after >= srv_start_time and valid_after < tp_start_time:
@@ -43,36 +70,51 @@ def _time_between_tp_and_srv(valid_after):
     return True
 
 
-def get_srv_and_time_period(is_first_descriptor):
+def get_srv_and_time_period(is_first_descriptor, consensus=None):
     """
     Return SRV and time period based on current consensus time
+
+    They are read from the time context of the consensus, so they are only
+    computed once per consensus (see consensus.TimeContext).
     """
-    from onionbalance.hs_v3.onionbalance import my_onionbalance
+    consensus = _get_consensus(consensus)
 
-    valid_after = my_onionbalance.consensus.consensus.valid_after
+    return consensus.get_time_context().get_srv_and_time_period(is_first_descriptor)
+
+
+def compute_srv_and_time_period(is_first_descriptor, consensus=None):
+    """
+    Compute SRV and time period based on current consensus time.
 
-    current_tp = my_onionbalance.consensus.get_time_period_num()
+    This does the actual work for get_srv_and_time_period() when the time
+    context of a consensus gets built.
+    """
+    consensus = _get_consensus(consensus)
+
+    valid_after = consensus.consensus.valid_after
+
+    current_tp = consensus.get_time_period_num()
     previous_tp = current_tp - 1
     next_tp = current_tp + 1
     assert (previous_tp > 0)
 
     # Get the right TP/SRV
     if is_first_descriptor:
-        if _time_between_tp_and_srv(valid_after):
-            srv = my_onionbalance.consensus.get_previous_srv(previous_tp)
+        if _time_between_tp_and_srv(valid_after, consensus):
+            srv = consensus.get_previous_srv(previous_tp)
             tp = previous_tp
             _case = 1  # just for debugging
         else:
-            srv = my_onionbalance.consensus.get_previous_srv(current_tp)
+            srv = consensus.get_previous_srv(current_tp)
             tp = current_tp
             _case = 2  # just for debugging
     else:
-        if _time_between_tp_and_srv(valid_after):
-            srv = my_onionbalance.consensus.get_current_srv(current_tp)
+        if _time_between_tp_and_srv(valid_after, consensus):
+            srv = consensus.get_current_srv(current_tp)
             tp = current_tp
             _case = 3  # just for debugging
         else:
-            srv = my_onionbalance.consensus.get_current_srv(next_tp)
+            srv = consensus.get_current_srv(next_tp)
             tp = next_tp
             _case = 4  # just for debugging
 
@@ -83,33 +125,22 @@ def get_srv_and_time_period(is_first_descriptor):
     return srv, tp
 
 
-def _get_hash_ring_for_descriptor(is_first_descriptor):
-    """
-    Return a dictionary { <node hsdir index> : Node , .... }
+def _get_hash_ring_for_descriptor(is_first_descriptor, consensus=None):
     """
-    from onionbalance.hs_v3.onionbalance import my_onionbalance
-
-    node_hash_ring = {}
-
-    srv, time_period_num = get_srv_and_time_period(is_first_descriptor)
-    logger.info("Using srv %s and TP#%s (%s descriptor)",
-                srv.hex(), time_period_num,
-                "first" if is_first_descriptor else "second")
+    Return the HashRing that should be used for the first or second descriptor.
 
-    for node in my_onionbalance.consensus.nodes:
-        try:
-            hsdir_index = node.get_hsdir_index(srv, time_period_num)
-        except (tor_node.NoEd25519Identity, tor_node.NoHSDir) as e:
-            logger.debug("Could not find ed25519 for node %s (%s)", node.routerstatus.fingerprint, e)
-            continue
+    Rings are cached by the consensus object per (SRV, time period) pair, so
+    the ring is only built once per consensus and then shared by all services
+    and both descriptors.
+    """
+    consensus = _get_consensus(consensus)
 
-        logger.debug("%s: Node: %s,  index: %s", is_first_descriptor, node.get_hex_fingerprint(), hsdir_index.hex())
-        node_hash_ring[hsdir_index] = node
+    srv, time_period_num = get_srv_and_time_period(is_first_descriptor, consensus)
 
-    return node_hash_ring
+    return consensus.get_hash_ring(srv, time_period_num)
 
 
-def _get_hidden_service_index(blinded_pubkey, replica_num, is_first_descriptor):
+def _get_hidden_service_index(blinded_pubkey, replica_num, is_first_descriptor, consensus=None):
     """
         hs_index(replicanum) = H("store-at-idx" |
                                  blinded_public_key |
@@ -117,16 +148,24 @@ def _get_hidden_service_index(blinded_pubkey, replica_num, is_first_descriptor):
                                  INT_8(period_length) |
                                  INT_8(period_num) )
     """
-    from onionbalance.hs_v3.onionbalance import my_onionbalance
-    period_length = my_onionbalance.consensus.get_time_period_length()
-
-    replica_num_int_8 = replica_num.to_bytes(8, 'big')
-    period_length_int_8 = (period_length).to_bytes(8, 'big')
+    time_context = _get_consensus(consensus).get_time_context()
+    period_length = time_context.time_period_length
 
-    _, time_period_num = get_srv_and_time_period(is_first_descriptor)
+    _, time_period_num = time_context.get_srv_and_time_period(is_first_descriptor)
     logger.info("Getting HS index with TP#%s for %s descriptor (%d replica) ",
                 time_period_num,
                 "first" if is_first_descriptor else "second", replica_num)
+
+    return _compute_hidden_service_index(blinded_pubkey, replica_num, period_length, time_period_num)
+
+
+def _compute_hidden_service_index(blinded_pubkey, replica_num, period_length, time_period_num):
+    """
+    Compute the hs_index of _get_hidden_service_index() for an already known
+    period length and time period number.
+    """
+    replica_num_int_8 = replica_num.to_bytes(8, 'big')
+    period_length_int_8 = (period_length).to_bytes(8, 'big')
     period_num_int_8 = time_period_num.to_bytes(8, 'big')
 
     hash_body = b"%s%s%s%s%s" % (b"store-at-idx",
@@ -135,89 +174,565 @@ def _get_hidden_service_index(blinded_pubkey, replica_num, is_first_descriptor):
                                  period_length_int_8,
                                  period_num_int_8)
 
-    hs_index = hashlib.sha3_256(hash_body).digest()
+    return hashlib.sha3_256(hash_body).digest()
 
-    return hs_index
 
-
-def get_responsible_hsdirs(blinded_pubkey, is_first_descriptor):
+def get_responsible_hsdirs(blinded_pubkey, is_first_descriptor, consensus=None):
     """
     Return a list with the responsible HSDirs for a service with 'blinded_pubkey'.
 
     The returned list is a list of fingerprints.
     """
-    from onionbalance.hs_v3.onionbalance import my_onionbalance
+    consensus = _get_consensus(consensus)
 
     # Always use a live consensus when calculating responsible HSDirs
-    assert (my_onionbalance.consensus.is_live())
+    assert (consensus.is_live())
+
+    hash_ring = _get_hash_ring_for_descriptor(is_first_descriptor, consensus)
+    if not hash_ring:
+        raise EmptyHashRing
 
-    responsible_hsdirs = []
+    logger.info("Using hash ring of size %d (blinded key: %s)",
+                len(hash_ring), base64.b64encode(blinded_pubkey))
 
-    # TODO: Improve representation of hash ring here... No need to go
-    # between list and dictionary...
+    hs_indices = [_get_hidden_service_index(blinded_pubkey, replica_num, is_first_descriptor, consensus)
+                  for replica_num in range(1, params.HSDIR_N_REPLICAS + 1)]
 
-    # dictionary { <node hsdir index> : Node , .... }
-    node_hash_ring = _get_hash_ring_for_descriptor(is_first_descriptor)
-    if not node_hash_ring:
+    responsible_hsdirs = hash_ring.get_responsible_hsdirs(hs_indices)
+
+    if not _has_right_number_of_hsdirs(responsible_hsdirs, consensus):
         raise EmptyHashRing
 
-    sorted_hash_ring_list = sorted(list(node_hash_ring.keys()))
+    return responsible_hsdirs
 
-    logger.info("Initialized hash ring of size %d (blinded key: %s)",
-                len(node_hash_ring), base64.b64encode(blinded_pubkey))
 
-    for replica_num in range(1, params.HSDIR_N_REPLICAS + 1):
-        # The HSDirs that we are gonna store this replica in
-        replica_store_hsdirs = []
+def get_hsdir_table_entries(identity_pubkeys, is_first_descriptor, consensus=None):
+    """
+    Compute the HSDirTableEntry of the first or second descriptor of each
+    service in 'identity_pubkeys' in a single pass over the hash ring.
 
-        hidden_service_index = _get_hidden_service_index(blinded_pubkey, replica_num, is_first_descriptor)
+    Return a list with an entry for each service, in the same order. The entry
+    is None for services whose responsible HSDirs could not be computed.
 
-        # Find position of descriptor ID in the HSDir list
-        index = bisect.bisect_left(sorted_hash_ring_list, hidden_service_index)
+    Raise EmptyHashRing if there is no hash ring to work with.
+    """
+    consensus = _get_consensus(consensus)
 
-        logger.info("\t Tried with HS index %s got position %d", hidden_service_index.hex(), index)
+    # Always use a live consensus when calculating responsible HSDirs
+    assert (consensus.is_live())
 
-        while len(replica_store_hsdirs) < params.HSDIR_SPREAD_STORE:
-            try:
-                hsdir_key = sorted_hash_ring_list[index]
-                index += 1
-            except IndexError:
-                # Wrap around when we reach the end of the HSDir list
-                index = 0
-                hsdir_key = sorted_hash_ring_list[index]
+    hash_ring = _get_hash_ring_for_descriptor(is_first_descriptor, consensus)
+    if not hash_ring:
+        raise EmptyHashRing
+
+    # The ring knows its own TP, and the period length is the same for all
+    # services, so compute the hs indices directly instead of looking them up
+    # again for every service and replica.
+    time_period_num = hash_ring.time_period_num
+    period_length = consensus.get_time_context().time_period_length
+
+    blinding_params = []
+    blinded_keys = []
+    for identity_pubkey in identity_pubkeys:
+        blinding_param = consensus.get_blinding_param(identity_pubkey, time_period_num)
+        # TODO: hoho! this is dirty we are poking into internal stem API. We
+        #       should ask atagar to make it public for us! :)
+        blinded_key = stem.descriptor.hidden_service._blinded_pubkey(identity_pubkey, blinding_param)
+
+        blinding_params.append(blinding_param)
+        blinded_keys.append(blinded_key)
+
+    hs_indices_list = [[_compute_hidden_service_index(blinded_key, replica_num, period_length, time_period_num)
+                        for replica_num in range(1, params.HSDIR_N_REPLICAS + 1)]
+                       for blinded_key in blinded_keys]
+
+    lookup_results = hash_ring.lookup_many(hs_indices_list)
+
+    logger.info("Computed responsible HSDirs of %d services for the %s descriptor (ring size %d)",
+                len(identity_pubkeys), "first" if is_first_descriptor else "second", len(hash_ring))
+
+    entries = []
+    for blinding_param, blinded_key, (responsible_hsdirs, arcs) in zip(blinding_params, blinded_keys,
+                                                                       lookup_results):
+        if not _has_right_number_of_hsdirs(responsible_hsdirs, consensus):
+            entries.append(None)
+            continue
 
-            hsdir_node = node_hash_ring[hsdir_key]
+        entries.append(HSDirTableEntry(blinding_param, blinded_key, responsible_hsdirs,
+                                       hash_ring.srv, hash_ring.time_period_num, arcs))
 
-            # Check if we have already added this node to this
-            # replica. This should never happen on the real network but
-            # might happen in small testnets like chutney!
-            if hsdir_node.get_hex_fingerprint() in replica_store_hsdirs:
-                logger.debug("Ignoring already added HSDir to this replica!")
+    return entries
+
+
+def _has_right_number_of_hsdirs(responsible_hsdirs, consensus=None):
+    """
+    Sanity check the number of responsible HSDirs we found for a service.
+    """
+    consensus = _get_consensus(consensus)
+
+    if consensus.is_testnet():
+        # If we are on chutney it's normal to not have enough nodes to populate the hashring
+        assert (len(responsible_hsdirs) <= params.HSDIR_N_REPLICAS * params.HSDIR_SPREAD_STORE)
+    else:
+        if (len(responsible_hsdirs) != params.HSDIR_N_REPLICAS * params.HSDIR_SPREAD_STORE):
+            logger.critical("Got the wrong number of responsible HSDirs: %d. Aborting", len(responsible_hsdirs))
+            return False
+
+    return True
+
+
+def compute_hsdir_indices(nodes, srv_and_time_periods, period_length, n_workers):
+    """
+    Compute the HSDir indices of all the 'nodes' for each (SRV, time period)
+    pair of 'srv_and_time_periods', splitting the nodes in ranges over
+    'n_workers' worker processes.
+
+    Return a dictionary { (srv, time_period_num) : [<hsdir index of each node>] }
+    that can be passed to HashRing().
+    """
+    ed25519_identities = [node.get_ring_identity() for node in nodes]
+    srv_and_time_periods = list(srv_and_time_periods)
+
+    chunk_size = max(1, -(-len(ed25519_identities) // n_workers))
+    chunks = [ed25519_identities[start:start + chunk_size]
+              for start in range(0, len(ed25519_identities), chunk_size)]
+
+    all_indices = {srv_and_time_period: [] for srv_and_time_period in srv_and_time_periods}
+
+    # This runs on the consensus ingest thread, so the workers must not be
+    # forked (see util.get_worker_process_context())
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers,
+                                                mp_context=util.get_worker_process_context()) as executor:
+        futures = [executor.submit(tor_node.compute_hsdir_indices, chunk, srv_and_time_periods, period_length)
+                   for chunk in chunks]
+
+        # Merge the chunks back in node order
+        for future in futures:
+            for srv_and_time_period, chunk_indices in zip(srv_and_time_periods, future.result()):
+                all_indices[srv_and_time_period].extend(chunk_indices)
+
+    logger.info("Computed hsdir indices of %d nodes for %d rings using %d workers",
+                len(ed25519_identities), len(srv_and_time_periods), n_workers)
+
+    return all_indices
+
+
+# The responsible HSDirs of a service descriptor for the current consensus,
+# along with the blinding parameter and blinded key they were derived from,
+# the SRV and TP of the ring they were picked from, and the ring arcs that
+# were walked to pick them (see HashRing.lookup_many()).
+HSDirTableEntry = collections.namedtuple('HSDirTableEntry',
+                                         ['blinding_param', 'blinded_key', 'responsible_hsdirs',
+                                          'srv', 'time_period_num', 'arcs'])
+
+
+class _PackedIndices(object):
+    """
+    Read-only sequence view over a buffer of packed fixed-size entries.
+
+    This is what allows bisect to search the ring buffer directly, without
+    having to split it into a list of small bytes objects first.
+    """
+
+    __slots__ = ('buf', 'item_len')
+
+    def __init__(self, buf, item_len):
+        self.buf = buf
+        self.item_len = item_len
+
+    def __len__(self):
+        return len(self.buf) // self.item_len
+
+    def __getitem__(self, position):
+        offset = position * self.item_len
+        return self.buf[offset:offset + self.item_len]
+
+
+class HashRing(object):
+    """
+    The HSDir hash ring for a single (SRV, time period) pair.
+
+    The ring only depends on the consensus nodes, the SRV and the time period,
+    so it gets built once and is then reused for every lookup until a new
+    consensus arrives.
+
+    The ring is stored as parallel buffers: the sorted 32-byte node indices
+    packed into a single bytes object, and the 20-byte fingerprints and 32-byte
+    ed25519 identities of the corresponding nodes packed in the same order.
+
+    Within a time period, most nodes of a ring are still there in the ring of
+    the next consensus, with the same indices. So the ring of a new consensus
+    is usually made out of the previous one (see from_previous()).
+    """
+
+    def __init__(self, nodes, srv, time_period_num, hsdir_indices=None, period_length=None):
+        """
+        Build the ring for 'srv' and 'time_period_num' out of 'nodes'.
+
+        If 'hsdir_indices' is set, it has the already computed index of each
+        node of 'nodes' in the same order (see compute_hsdir_indices()), and
+        nodes are not hashed again.
+
+        'period_length' is the time period length used to hash the nodes. If
+        it's None, it's taken from the consensus of the running onionbalance.
+        """
+        self.srv = srv
+        self.time_period_num = time_period_num
+
+        # dictionary { <node hsdir index> : (<node fingerprint>, <node ed25519 identity>) , .... }
+        node_hash_ring = {}
+
+        if hsdir_indices is None:
+            hsdir_indices = [None] * len(nodes)
+
+        for node, hsdir_index in zip(nodes, hsdir_indices):
+            if hsdir_index is None:
+                try:
+                    hsdir_index = node.get_hsdir_index(srv, time_period_num, period_length)
+                except (tor_node.NoEd25519Identity, tor_node.NoHSDir) as e:
+                    logger.debug("Could not find ed25519 for node %s (%s)", node.get_hex_fingerprint(), e)
+                    continue
+
+            logger.debug("TP#%s: Node: %s,  index: %s", time_period_num, node.get_hex_fingerprint(), hsdir_index.hex())
+            node_hash_ring[hsdir_index] = (bytes.fromhex(node.get_hex_fingerprint()), node.ed25519_identity)
+
+        sorted_indices = sorted(node_hash_ring)
+
+        # The node indices in ring order, packed into a single buffer
+        self.indices = b"".join(sorted_indices)
+        # The node fingerprints, packed in the same order as the indices
+        self.fingerprints = b"".join(node_hash_ring[hsdir_index][0] for hsdir_index in sorted_indices)
+        # The node ed25519 identities, packed in the same order as the indices
+        self.identities = b"".join(node_hash_ring[hsdir_index][1] for hsdir_index in sorted_indices)
+
+        self._indices_view = _PackedIndices(self.indices, HSDIR_INDEX_LEN)
+        self._set_changes(None, None)
+
+        logger.info("Initialized hash ring of size %d (srv %s, TP#%s)",
+                    len(self), srv.hex(), time_period_num)
+
+    @classmethod
+    def from_packed(cls, srv, time_period_num, indices, fingerprints, identities=None):
+        """
+        Create a ring straight from its already sorted and packed 'indices'
+        and 'fingerprints' buffers (e.g. from another onionbalance process, see
+        shared_consensus).
+
+        Without the 'identities' buffer, the ring can't be used by
+        from_previous().
+        """
+        ring = cls.__new__(cls)
+        ring.srv = srv
+        ring.time_period_num = time_period_num
+        ring.indices = indices
+        ring.fingerprints = fingerprints
+        ring.identities = identities
+        ring._indices_view = _PackedIndices(ring.indices, HSDIR_INDEX_LEN)
+        ring._set_changes(None, None)
+
+        return ring
+
+    @classmethod
+    def from_previous(cls, previous_ring, nodes, period_length=None):
+        """
+        Build the ring of 'nodes' for the SRV and time period of
+        'previous_ring', by carrying its nodes forward.
+
+        Only the nodes that joined the ring (or whose ed25519 identity
+        changed) get hashed. They are merged into the previous ring, from
+        which the nodes that left are dropped, without sorting the ring again.
+
+        Return None if the ring has to be built from scratch instead (the
+        previous ring does not have the node identities, or two nodes end up
+        with the same index).
+        """
+        if previous_ring.identities is None:
+            return None
+
+        srv = previous_ring.srv
+        time_period_num = previous_ring.time_period_num
+
+        # dictionary { (<node fingerprint>, <node ed25519 identity>) : <ring position> , ... }
+        previous_members = {}
+        for position in range(len(previous_ring)):
+            fingerprint_offset = position * FINGERPRINT_LEN
+            identity_offset = position * ED25519_IDENTITY_LEN
+            member = (previous_ring.fingerprints[fingerprint_offset:fingerprint_offset + FINGERPRINT_LEN],
+                      previous_ring.identities[identity_offset:identity_offset + ED25519_IDENTITY_LEN])
+            previous_members[member] = position
+
+        members = set()
+        added_entries = []
+        for node in nodes:
+            ed25519_identity = node.get_ring_identity()
+            if ed25519_identity is None:
+                continue
+
+            member = (bytes.fromhex(node.get_hex_fingerprint()), ed25519_identity)
+            members.add(member)
+            if member not in previous_members:
+                hsdir_index = node.get_hsdir_index(srv, time_period_num, period_length)
+                added_entries.append((hsdir_index, member[0], ed25519_identity))
+
+        added_entries.sort()
+        removed_positions = sorted(position for member, position in previous_members.items()
+                                   if member not in members)
+
+        # Find where each node joins or leaves the previous ring. Nodes that
+        # join go before the node they replace at the same position.
+        removed_position_set = set(removed_positions)
+        changes = [(position, True, None) for position in removed_positions]
+        previous_hsdir_index = None
+        for entry in added_entries:
+            position = bisect.bisect_left(previous_ring._indices_view, entry[0])
+            is_taken = position < len(previous_ring) and position not in removed_position_set and \
+                previous_ring.get_index(position) == entry[0]
+            if is_taken or entry[0] == previous_hsdir_index:
+                logger.info("Node %s has the same index as another node. Rebuilding the ring.", entry[1].hex())
+                return None
+
+            changes.append((position, False, entry))
+            previous_hsdir_index = entry[0]
+        changes.sort(key=lambda change: (change[0], change[1]))
+
+        # Walk the previous ring once, copying over the runs of nodes between
+        # the changes
+
+        indices, fingerprints, identities = [], [], []
+        start = 0
+        for position, is_removal, entry in changes:
+            indices.append(previous_ring.indices[start * HSDIR_INDEX_LEN:position * HSDIR_INDEX_LEN])
+            fingerprints.append(previous_ring.fingerprints[start * FINGERPRINT_LEN:position * FINGERPRINT_LEN])
+            identities.append(previous_ring.identities[start * ED25519_IDENTITY_LEN:
+                                                       position * ED25519_IDENTITY_LEN])
+            if is_removal:
+                start = position + 1
+            else:
+                indices.append(entry[0])
+                fingerprints.append(entry[1])
+                identities.append(entry[2])
+                start = position
+
+        indices.append(previous_ring.indices[start * HSDIR_INDEX_LEN:])
+        fingerprints.append(previous_ring.fingerprints[start * FINGERPRINT_LEN:])
+        identities.append(previous_ring.identities[start * ED25519_IDENTITY_LEN:])
+
+        ring = cls.from_packed(srv, time_period_num, b"".join(indices), b"".join(fingerprints), b"".join(identities))
+        # A node that replaces another one at the same index is both added
+        # and removed
+        changed_indices = set(entry[0] for entry in added_entries)
+        changed_indices.update(previous_ring.get_index(position) for position in removed_positions)
+        ring._set_changes(previous_ring, sorted(changed_indices))
+
+        logger.info("Updated hash ring of size %d (srv %s, TP#%s): %d nodes joined, %d left",
+                    len(ring), srv.hex(), time_period_num, len(added_entries), len(removed_positions))
+
+        return ring
+
+    def __len__(self):
+        return len(self.indices) // HSDIR_INDEX_LEN
+
+    def get_index(self, position):
+        """
+        Return the node index at ring 'position'.
+        """
+        return self._indices_view[position]
+
+    def get_fingerprint(self, position):
+        """
+        Return the hex fingerprint of the node at ring 'position'.
+        """
+        offset = position * FINGERPRINT_LEN
+        return self.fingerprints[offset:offset + FINGERPRINT_LEN].hex().upper()
+
+    def find_positions(self, hs_indices):
+        """
+        Return the ring position of each of the 'hs_indices'. That's the
+        position of the first node whose index is not smaller than it, wrapping
+        around to 0 past the end of the ring.
+
+        The lookups happen in a single ascending pass, so that each search only
+        has to look at the part of the ring after the previous match.
+        """
+        n_nodes = len(self)
+        positions = [0] * len(hs_indices)
+
+        low = 0
+        for i in sorted(range(len(hs_indices)), key=hs_indices.__getitem__):
+            low = bisect.bisect_left(self._indices_view, hs_indices[i], low)
+            positions[i] = low % n_nodes if n_nodes else 0
+
+        return positions
+
+    def get_fingerprints_from(self, position, count):
+        """
+        Return the hex fingerprints of the 'count' nodes starting at ring
+        'position', wrapping around the end of the ring.
+        """
+        count = min(count, len(self))
+        start = position * FINGERPRINT_LEN
+        end = start + count * FINGERPRINT_LEN
+
+        packed = self.fingerprints[start:end]
+        if end > len(self.fingerprints):
+            packed += self.fingerprints[:end - len(self.fingerprints)]
+
+        return [packed[offset:offset + FINGERPRINT_LEN].hex().upper()
+                for offset in range(0, len(packed), FINGERPRINT_LEN)]
+
+    def get_responsible_hsdirs(self, hs_indices):
+        """
+        Return the responsible HSDir fingerprints for a service whose replica
+        indices are 'hs_indices'.
+        """
+        return self.get_responsible_hsdirs_many([hs_indices])[0]
+
+    def get_responsible_hsdirs_many(self, hs_indices_list):
+        """
+        Return the responsible HSDirs of many services at once.
+
+        'hs_indices_list' contains the replica indices of each service, and the
+        result contains a list of responsible HSDir fingerprints for each one,
+        in the same order.
+        """
+        return [responsible_hsdirs for responsible_hsdirs, _ in self.lookup_many(hs_indices_list)]
+
+    def lookup_many(self, hs_indices_list):
+        """
+        Like get_responsible_hsdirs_many() but return a (responsible_hsdirs,
+        arcs) tuple for each service.
+
+        'arcs' has a (first index, last index) tuple for each replica, with the
+        part of the ring that was walked to pick the HSDirs of that replica. An
+        arc is None if the whole ring had to be walked.
+        """
+        flat_hs_indices = [hs_index for hs_indices in hs_indices_list for hs_index in hs_indices]
+        flat_positions = iter(self.find_positions(flat_hs_indices))
+
+        results = []
+        for hs_indices in hs_indices_list:
+            responsible_hsdirs = []
+            arcs = []
+
+            for hs_index in hs_indices:
+                position = next(flat_positions)
+                logger.info("\t Tried with HS index %s got position %d", hs_index.hex(), position)
+
+                replica_store_hsdirs, n_walked = self._walk_replica(position, responsible_hsdirs)
+                responsible_hsdirs.extend(replica_store_hsdirs)
+
+                if n_walked >= len(self):
+                    arcs.append(None)
+                else:
+                    arcs.append((hs_index, self.get_index((position + n_walked - 1) % len(self))))
+
+            results.append((responsible_hsdirs, tuple(arcs)))
+
+        return results
+
+    def _walk_replica(self, position, responsible_hsdirs):
+        """
+        Walk the ring from 'position' and pick the HSDirs that a replica should
+        be stored in, skipping the ones already in 'responsible_hsdirs'.
+
+        Return the picked HSDirs and the number of nodes that were walked.
+        """
+        # The HSDirs that we are gonna store this replica in
+        replica_store_hsdirs = []
+        n_walked = 0
+
+        # We can skip at most as many nodes as we already picked, so this is
+        # enough nodes to fill the replica. It's capped to the ring size, so
+        # that small testnets like chutney never get the same node twice.
+        n_candidates = params.HSDIR_SPREAD_STORE + len(responsible_hsdirs)
+
+        for fingerprint in self.get_fingerprints_from(position, n_candidates):
+            if len(replica_store_hsdirs) >= params.HSDIR_SPREAD_STORE:
                 break
 
+            n_walked += 1
+
             # Check if we have already added this node to the responsible
             # HSDirs. This can happen in the second replica and we should
             # skip the node
-            if hsdir_node.get_hex_fingerprint() in responsible_hsdirs:
+            if fingerprint in responsible_hsdirs:
                 logger.debug("Ignoring already added HSDir!")
                 continue
 
-            logger.debug("%d: %s: %s", index, hsdir_node.get_hex_fingerprint(), hsdir_key.hex())
-
-            replica_store_hsdirs.append(hsdir_node.get_hex_fingerprint())
+            logger.debug("Picked HSDir %s for replica at position %d", fingerprint, position)
+            replica_store_hsdirs.append(fingerprint)
+
+        return replica_store_hsdirs, n_walked
+
+    def _set_changes(self, previous_ring, changed_indices):
+        """
+        Remember that this ring was made out of 'previous_ring', with the
+        'changed_indices' nodes joining or leaving it.
+        """
+        # A weak reference, so that rings don't keep all their predecessors
+        # alive
+        self._previous_ring_ref = weakref.ref(previous_ring) if previous_ring is not None else None
+        self._changed_indices = changed_indices
+
+    def get_changed_indices(self, other_ring):
+        """
+        Return a sorted list with the node indices that are only in one of
+        this ring and 'other_ring', or that belong to a different node in each
+        of them. These are the nodes that joined or left the ring between the
+        two.
+
+        If this ring was made out of 'other_ring' (see from_previous()), we
+        already know them. Otherwise, both rings are walked once side by side.
+        """
+        if self._previous_ring_ref is not None and self._previous_ring_ref() is other_ring:
+            return self._changed_indices
+
+        changed_indices = []
+        position = other_position = 0
+        while position < len(self) and other_position < len(other_ring):
+            hsdir_index = self.get_index(position)
+            other_hsdir_index = other_ring.get_index(other_position)
+
+            if hsdir_index < other_hsdir_index:
+                changed_indices.append(hsdir_index)
+                position += 1
+            elif hsdir_index > other_hsdir_index:
+                changed_indices.append(other_hsdir_index)
+                other_position += 1
+            else:
+                if self.get_fingerprint(position) != other_ring.get_fingerprint(other_position):
+                    changed_indices.append(hsdir_index)
+                position += 1
+                other_position += 1
+
+        changed_indices.extend(self.get_index(i) for i in range(position, len(self)))
+        changed_indices.extend(other_ring.get_index(i) for i in range(other_position, len(other_ring)))
+
+        return changed_indices
+
+
+def arcs_have_changes(arcs, changed_indices):
+    """
+    Return True if any of the 'changed_indices' (as returned by
+    HashRing.get_changed_indices()) falls inside one of the ring 'arcs' of a
+    service, which means that its responsible HSDirs might have changed.
+    """
+    for arc in arcs:
+        if arc is None:
+            return True
 
-        responsible_hsdirs.extend(replica_store_hsdirs)
+        first_index, last_index = arc
+        position = bisect.bisect_left(changed_indices, first_index)
 
-    # Do a sanity check
-    if my_onionbalance.is_testnet:
-        # If we are on chutney it's normal to not have enough nodes to populate the hashring
-        assert (len(responsible_hsdirs) <= params.HSDIR_N_REPLICAS * params.HSDIR_SPREAD_STORE)
-    else:
-        if (len(responsible_hsdirs) != params.HSDIR_N_REPLICAS * params.HSDIR_SPREAD_STORE):
-            logger.critical("Got the wrong number of responsible HSDirs: %d. Aborting", len(responsible_hsdirs))
-            raise EmptyHashRing
+        if first_index <= last_index:
+            if position < len(changed_indices) and changed_indices[position] <= last_index:
+                return True
+        else:
+            # This arc wraps around the end of the ring
+            if position < len(changed_indices) or (changed_indices and changed_indices[0] <= last_index):
+                return True
 
-    return responsible_hsdirs
+    return False
 
 
 class EmptyHashRing(Exception):
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+"""
+Offline HSDir calculator.
+
+Compute the responsible HSDirs of many onion addresses from a cached microdesc
+consensus and cached microdescriptors (e.g. the 'cached-microdesc-consensus'
+and 'cached-microdescs' files of a Tor DataDirectory), without a running Tor
+or onionbalance.
+
+The hash ring of each (SRV, time period) is built once, and the addresses are
+looked up against it in batches. The HSDir assignments are streamed out as one
+JSON object per line and per descriptor.
+
+Only the time periods of the first and second descriptors of the consensus are
+covered: the HSDirs of later time periods depend on shared random values that
+the directory authorities have not agreed on yet. To look further ahead, run
+the calculator again on a later consensus.
+"""
+import argparse
+import itertools
+import json
+import logging
+import sys
+
+from stem.descriptor.hidden_service import HiddenServiceDescriptorV3
+
+import onionbalance
+from onionbalance.common import log
+from onionbalance.hs_v3 import consensus as hs_consensus
+from onionbalance.hs_v3 import hashring
+
+logger = log.get_logger()
+
+# How many addresses we read and look up at once
+DEFAULT_BATCH_SIZE = 1000
+
+
+class OfflineConsensus(hs_consensus.Consensus):
+    """
+    A consensus that takes the microdescriptors of its nodes from the Tor
+    microdescriptor files in 'microdescriptor_paths', instead of asking a
+    running Tor for them.
+    """
+
+    def __init__(self, microdescriptor_paths, is_testnet=False):
+        super().__init__(do_refresh_consensus=False, is_testnet=is_testnet)
+        self.microdescriptor_paths = microdescriptor_paths
+        # This consensus is only ours: it must not be read from the
+        # DataDirectory of a Tor, nor overwrite the consensus that running
+        # onionbalance processes share (see ONIONBALANCE_SHARED_CONSENSUS_FILE)
+        self.data_directory = None
+        self.shared_consensus_file = None
+
+    def _update_microdescriptor_cache(self, digests):
+        """
+        Add the microdescriptors with 'digests' out of our microdescriptor
+        files, the same way they are read from a Tor DataDirectory.
+        """
+        n_added = 0
+        for microdescriptor_path in self.microdescriptor_paths:
+            with open(microdescriptor_path, 'rb') as microdescriptor_file:
+                n_added += self.microdescriptor_cache.update_from_file(microdescriptor_file.read(), digests)
+
+        logger.info("Read %d microdescriptors from %s", n_added, ", ".join(self.microdescriptor_paths))
+        return True
+
+
+def load_consensus(consensus_path, microdescriptor_paths, is_testnet=False):
+    """
+    Return an OfflineConsensus loaded from the md consensus file in
+    'consensus_path' and the microdescriptor files in 'microdescriptor_paths'.
+
+    Raise hs_consensus.NoLiveConsensus if the consensus could not be loaded or
+    is not live.
+    """
+    with open(consensus_path, 'rb') as consensus_file:
+        md_consensus_str = consensus_file.read()
+
+    offline_consensus = OfflineConsensus(microdescriptor_paths, is_testnet)
+    offline_consensus.load(md_consensus_str)
+
+    if not offline_consensus.is_live() or not offline_consensus.nodes:
+        raise hs_consensus.NoLiveConsensus
+
+    return offline_consensus
+
+
+def read_addresses(address_file):
+    """
+    Yield the onion addresses of 'address_file', one per line. Empty lines and
+    lines starting with '#' are skipped, and the '.onion' suffix is optional.
+    """
+    for line in address_file:
+        address = line.strip()
+        if not address or address.startswith('#'):
+            continue
+
+        if address.endswith('.onion'):
+            address = address[:-len('.onion')]
+
+        yield address
+
+
+def get_hsdir_assignments(offline_consensus, addresses):
+    """
+    Yield a dictionary with the responsible HSDirs of the first and second
+    descriptor of each onion address in 'addresses' (a list).
+
+    Addresses that are not valid v3 onion addresses are logged and skipped.
+    """
+    valid_addresses = []
+    identity_pubkeys = []
+    for address in addresses:
+        try:
+            identity_pubkeys.append(HiddenServiceDescriptorV3.identity_key_from_address(address))
+        except ValueError as e:
+            logger.warning("Skipping invalid onion address %s: %s", address, e)
+            continue
+
+        valid_addresses.append(address)
+
+    if not valid_addresses:
+        return
+
+    for is_first_descriptor in (True, False):
+        entries = hashring.get_hsdir_table_entries(identity_pubkeys, is_first_descriptor, offline_consensus)
+
+        for address, entry in zip(valid_addresses, entries):
+            if not entry:
+                logger.warning("Could not compute the responsible HSDirs of %s", address)
+                continue
+
+            yield {'address': address,
+                   'descriptor': "first" if is_first_descriptor else "second",
+                   'time_period': entry.time_period_num,
+                   'srv': entry.srv.hex(),
+                   'responsible_hsdirs': entry.responsible_hsdirs}
+
+
+def write_hsdir_assignments(offline_consensus, address_file, output, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Look up the addresses of 'address_file' in batches of 'batch_size' and
+    write their HSDir assignments as JSON lines to 'output'.
+
+    Return the number of assignments written.
+    """
+    addresses = read_addresses(address_file)
+    n_assignments = 0
+
+    while True:
+        batch = list(itertools.islice(addresses, batch_size))
+        if not batch:
+            break
+
+        for assignment in get_hsdir_assignments(offline_consensus, batch):
+            output.write(json.dumps(assignment) + "\n")
+            n_assignments += 1
+
+        output.flush()
+
+    return n_assignments
+
+
+def parse_cmd_args():
+    """
+    Parses and returns command line arguments for the HSDir calculator
+    """
+    parser = argparse.ArgumentParser(
+        prog="onionbalance-hsdirs",
+        description="Compute the responsible HSDirs of onion addresses from a "
+        "cached microdesc consensus and microdescriptors, for the time periods "
+        "of the first and second descriptors of that consensus. The results "
+        "are written as one JSON object per line and per descriptor.")
+
+    parser.add_argument("-c", "--consensus", type=str, required=True,
+                        help="Microdesc consensus file (e.g. "
+                        "<DataDirectory>/cached-microdesc-consensus).")
+
+    parser.add_argument("-m", "--microdescriptors", type=str, nargs='+', required=True,
+                        help="Microdescriptor files (e.g. "
+                        "<DataDirectory>/cached-microdescs and "
+                        "<DataDirectory>/cached-microdescs.new).")
+
+    parser.add_argument("-a", "--addresses", type=argparse.FileType('r'), default=sys.stdin,
+                        help="File with one onion address per line (default: "
+                        "standard input).")
+
+    parser.add_argument("-o", "--output", type=argparse.FileType('w'), default=sys.stdout,
+                        help="Where to write the results (default: standard "
+                        "output).")
+
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="How many addresses to look up at once (default: "
+                        "%(default)s).")
+
+    parser.add_argument("--is-testnet", action='store_true',
+                        help="The consensus is from a test network (e.g. chutney).")
+
+    parser.add_argument("-v", type=str, default="warning", dest='verbosity',
+                        help="Minimum verbosity level for logging. Available "
+                        "in ascending order: debug, info, warning, error, "
+                        "critical) (default: %(default)s).")
+
+    parser.add_argument('--version', action='version',
+                        version='onionbalance %s' % onionbalance.__version__)
+
+    return parser
+
+
+def main():
+    """
+    Entry point of the offline HSDir calculator.
+    """
+    args = parse_cmd_args().parse_args()
+
+    logger.setLevel(logging.__dict__[args.verbosity.upper()])
+
+    try:
+        offline_consensus = load_consensus(args.consensus, args.microdescriptors, args.is_testnet)
+    except hs_consensus.NoLiveConsensus:
+        logger.error("Could not load a live consensus from %s.", args.consensus)
+        return 1
+
+    logger.info("Loaded consensus with %d nodes.", len(offline_consensus.nodes))
+
+    n_assignments = write_hsdir_assignments(offline_consensus, args.addresses, args.output, args.batch_size)
+
+    logger.info("Wrote %d HSDir assignments.", n_assignments)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
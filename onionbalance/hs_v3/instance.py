@@ -41,20 +41,32 @@ class InstanceV3(onionbalance.common.instance.Instance):
 
         return my_onion_address == their_onion_address
 
-    def register_descriptor(self, descriptor_text, onion_address):
+    def register_descriptor(self, descriptor_text, onion_address, record=None):
         """
         We received a descriptor (with 'descriptor_text') for 'onion_address'.
         Register it to this instance.
+
+        'record' is the ReceivedDescriptorRecord of the descriptor if a
+        descriptor worker already parsed it.
         """
         logger.info("Found instance %s for this new descriptor!", self.onion_address)
 
         assert (onion_address == self.onion_address)
 
+        # The HSDirs of the instance mostly send us the descriptor we already
+        # have: recognize it from its header, without parsing and decrypting
+        # it again. It's still a sign that the instance is alive.
+        if self.descriptor and self.descriptor.header is not None:
+            if ob_descriptor.get_descriptor_header(descriptor_text) == self.descriptor.header:
+                logger.info("We got the same descriptor for instance %s again.", self.onion_address)
+                self.descriptor.set_received_ts(datetime.datetime.utcnow())
+                return
+
         # Parse descriptor. If it parsed correctly, we know that this
         # descriptor is truly for this instance (since the onion address
         # matches)
         try:
-            new_descriptor = ob_descriptor.ReceivedDescriptor(descriptor_text, onion_address)
+            new_descriptor = ob_descriptor.ReceivedDescriptor(descriptor_text, onion_address, record)
         except ob_descriptor.BadDescriptor:
             logger.warning("Received bad descriptor for %s. Ignoring.", self.onion_address)
             return
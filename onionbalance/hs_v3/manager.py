@@ -65,5 +65,10 @@ def init_scheduler(my_onionbalance):
         scheduler.add_job(params.FETCH_DESCRIPTOR_FREQUENCY, my_onionbalance.fetch_instance_descriptors)
         scheduler.add_job(params.PUBLISH_DESCRIPTOR_CHECK_FREQUENCY, my_onionbalance.publish_all_descriptors)
 
+    # Pick up the consensuses that another onionbalance process publishes
+    shared_consensus_file = my_onionbalance.consensus.shared_consensus_file
+    if shared_consensus_file and not shared_consensus_file.is_publisher():
+        scheduler.add_job(params.SHARED_CONSENSUS_CHECK_FREQUENCY, my_onionbalance.check_shared_consensus)
+
     # Run initial fetch of HS instance descriptors
     scheduler.run_all(delay_seconds=params.INITIAL_CALLBACK_DELAY)
@@ -0,0 +1,208 @@
+import base64
+import hashlib
+
+import stem
+from stem.descriptor.microdescriptor import Microdescriptor
+
+from onionbalance.common import log
+from onionbalance.hs_v3 import tor_node
+from onionbalance.hs_v3 import params
+
+logger = log.get_logger()
+
+
+class MicrodescriptorCache(object):
+    """
+    Keeps what we need out of the microdescriptors of the network across
+    consensuses.
+
+    Only a small fraction of the microdescriptors changes from one consensus to
+    the next, so instead of fetching all of them from Tor whenever a new
+    consensus arrives, we only ask for the ones we don't know yet and we drop
+    the ones that the consensus does not reference anymore.
+
+    The only thing we need from a microdescriptor is the ed25519 identity of
+    its node, so that's all we keep.
+    """
+
+    def __init__(self):
+        # dictionary { <md digest> : <raw ed25519 identity or None> , ... }
+        self.ed25519_identities = {}
+
+    def __len__(self):
+        return len(self.ed25519_identities)
+
+    def __contains__(self, digest):
+        return digest in self.ed25519_identities
+
+    def get_ed25519_identity(self, digest):
+        """
+        Return the ed25519 identity of the node of the microdescriptor with
+        'digest', or None if it does not have one.
+        """
+        return self.ed25519_identities[digest]
+
+    def add_microdescriptors(self, microdescriptors):
+        """
+        Add a list of stem Microdescriptor objects to the cache.
+        """
+        for microdescriptor in microdescriptors:
+            self.ed25519_identities[microdescriptor.digest()] = tor_node.get_ed25519_identity(microdescriptor)
+
+    def update_from_file(self, data, digests):
+        """
+        Add the microdescriptors with 'digests' that are missing from the cache
+        out of 'data', the contents of a Tor microdescriptor cache file (bytes
+        or an mmap).
+
+        Microdescriptors are picked by hashing their text, so only the ones
+        we are missing get parsed. Return the number of microdescriptors that
+        were added.
+        """
+        missing_digests = set(digest for digest in digests if digest not in self.ed25519_identities)
+        n_added = 0
+
+        for start, end in _iter_microdescriptor_spans(data):
+            if not missing_digests:
+                break
+
+            microdescriptor = data[start:end]
+            digest = base64.b64encode(hashlib.sha256(microdescriptor).digest()).decode('ascii').rstrip('=')
+            if digest not in missing_digests:
+                continue
+
+            self.ed25519_identities[digest] = _get_ed25519_identity_from_text(microdescriptor)
+            missing_digests.discard(digest)
+            n_added += 1
+
+        return n_added
+
+    def update(self, controller, digests):
+        """
+        Make sure that the cache has the microdescriptors with 'digests', by
+        fetching the ones it's missing through 'controller' (a StemController).
+
+        If most of them are missing (e.g. when we start up), they are all
+        fetched at once. Otherwise they are fetched in batches of
+        MICRODESCRIPTOR_FETCH_BATCH_SIZE. Microdescriptors that Tor does not
+        have are skipped, and only the ones with 'digests' are kept.
+
+        Return the number of microdescriptors that were fetched.
+
+        Raise stem.DescriptorUnavailable if we need all the microdescriptors
+        and Tor can't give them to us.
+        """
+        # Keep the order of the consensus, without duplicates
+        missing_digests = [digest for digest in dict.fromkeys(digests) if digest not in self.ed25519_identities]
+        if not missing_digests:
+            return 0
+
+        if len(missing_digests) > len(digests) * params.MICRODESCRIPTOR_FULL_FETCH_RATIO:
+            wanted_digests = set(missing_digests)
+            microdescriptors = [microdescriptor for microdescriptor in controller.controller.get_microdescriptors()
+                                if microdescriptor.digest() in wanted_digests]
+            self.add_microdescriptors(microdescriptors)
+            return len(microdescriptors)
+
+        n_fetched = 0
+        batch_size = params.MICRODESCRIPTOR_FETCH_BATCH_SIZE
+        for start in range(0, len(missing_digests), batch_size):
+            n_fetched += self._fetch_batch(controller, missing_digests[start:start + batch_size])
+
+        return n_fetched
+
+    def _fetch_batch(self, controller, digests):
+        """
+        Fetch the microdescriptors with 'digests' and add them to the cache.
+
+        Return the number of microdescriptors that were fetched.
+        """
+        try:
+            contents = controller.get_microdescriptors_by_digest(digests)
+        except stem.OperationFailed:
+            # The whole GETINFO fails if Tor does not have one of the
+            # microdescriptors, so split the batch to still get the rest
+            if len(digests) == 1:
+                logger.debug("Tor does not have microdescriptor %s", digests[0])
+                return 0
+
+            middle = len(digests) // 2
+            return self._fetch_batch(controller, digests[:middle]) + self._fetch_batch(controller, digests[middle:])
+
+        # Key them by the digest we asked for, since that's what the consensus
+        # refers to them by
+        for digest, content in contents.items():
+            self.ed25519_identities[digest] = tor_node.get_ed25519_identity(Microdescriptor(content))
+
+        return len(contents)
+
+    def evict(self, digests):
+        """
+        Drop the microdescriptors that don't have one of 'digests' (the
+        digests referenced by the current consensus).
+
+        Return the number of microdescriptors that were dropped.
+        """
+        referenced_digests = set(digests)
+        n_cached = len(self.ed25519_identities)
+
+        self.ed25519_identities = {digest: ed25519_identity
+                                   for digest, ed25519_identity in self.ed25519_identities.items()
+                                   if digest in referenced_digests}
+
+        return n_cached - len(self.ed25519_identities)
+
+
+def _iter_microdescriptor_spans(data):
+    """
+    Yield the (start, end) offsets of each microdescriptor in 'data', the
+    contents of a Tor microdescriptor cache file.
+
+    A microdescriptor starts with its 'onion-key' line and ends right before
+    the next microdescriptor, or before the annotations (lines starting with
+    '@') that Tor puts before the next one.
+    """
+    start = 0 if data[:len(b"onion-key")] == b"onion-key" else _find_line(data, b"onion-key", 0)
+
+    while start != -1:
+        next_start = _find_line(data, b"onion-key", start + 1)
+        end = next_start if next_start != -1 else len(data)
+
+        annotation_start = _find_line(data, b"@", start, end)
+        if annotation_start != -1:
+            end = annotation_start
+
+        yield start, end
+        start = next_start
+
+
+def _find_line(data, prefix, start, end=None):
+    """
+    Return the offset of the first line of 'data' that starts with 'prefix'
+    between 'start' and 'end', or -1 if there is none.
+    """
+    if end is None:
+        end = len(data)
+
+    position = data.find(b"\n" + prefix, start, end)
+    if position == -1:
+        return -1
+
+    return position + 1
+
+
+def _get_ed25519_identity_from_text(microdescriptor):
+    """
+    Return the raw ed25519 identity out of the text of a 'microdescriptor', or
+    None if it does not have one.
+    """
+    position = _find_line(microdescriptor, b"id ed25519 ", 0)
+    if position == -1:
+        return None
+
+    line_end = microdescriptor.find(b"\n", position)
+    if line_end == -1:
+        line_end = len(microdescriptor)
+
+    ed25519_identity_b64 = microdescriptor[position + len(b"id ed25519 "):line_end].strip()
+    return tor_node.decode_ed25519_identity(ed25519_identity_b64.decode('ascii'))
@@ -10,10 +10,14 @@ from onionbalance.common import log
 
 from onionbalance.common import util
 from onionbalance.hs_v3 import manager
+from onionbalance.hs_v3 import params
 
 from onionbalance.hs_v3 import stem_controller
 from onionbalance.hs_v3 import service as ob_service
 from onionbalance.hs_v3 import consensus as ob_consensus
+from onionbalance.hs_v3 import consensus_worker
+from onionbalance.hs_v3 import descriptor_worker
+from onionbalance.hs_v3 import shared_consensus
 
 logger = log.get_logger()
 
@@ -34,6 +38,11 @@ class Onionbalance(object):
         # True if this onionbalance operates in a testnet (e.g. chutney)
         self.is_testnet = False
 
+        # The worker that ingests new consensuses
+        self.consensus_worker = None
+        # The worker that parses the descriptors of our instances
+        self.descriptor_worker = None
+
     def init_subsystems(self, args):
         """
         Initialize subsystems (this is resource intensive)
@@ -41,6 +50,7 @@ class Onionbalance(object):
         self.args = args
         self.config_path = os.path.abspath(self.args.config)
         self.config_data = self.load_config_file()
+        self.check_params()
         self.is_testnet = args.is_testnet
 
         if self.is_testnet:
@@ -50,6 +60,18 @@ class Onionbalance(object):
         self.controller = stem_controller.StemController(address=args.ip, port=args.port, socket=args.socket)
         self.consensus = ob_consensus.Consensus()
 
+        # Ingest new consensuses off the stem event thread
+        if self.consensus_worker:
+            self.consensus_worker.stop()
+        self.consensus_worker = consensus_worker.ConsensusIngestWorker(self.ingest_new_consensus)
+        self.consensus_worker.start()
+
+        # Parse instance descriptors off the stem event thread
+        if self.descriptor_worker:
+            self.descriptor_worker.stop()
+        self.descriptor_worker = descriptor_worker.DescriptorParseWorker(self.register_instance_descriptor)
+        self.descriptor_worker.start()
+
         # Initialize our service
         self.services = self.initialize_services_from_config_data()
 
@@ -70,6 +92,16 @@ class Onionbalance(object):
 
         return services
 
+    def check_params(self):
+        """
+        Check the settings we take from the environment, before anything
+        gets set up with them.
+        """
+        if params.SHARED_CONSENSUS_FILE and \
+           params.SHARED_CONSENSUS_MODE not in (shared_consensus.PUBLISH, shared_consensus.ATTACH):
+            raise ConfigError("ONIONBALANCE_SHARED_CONSENSUS_MODE is bad. It must be '{}' or '{}', not '{}'.".format(
+                shared_consensus.PUBLISH, shared_consensus.ATTACH, params.SHARED_CONSENSUS_MODE))
+
     def load_config_file(self):
         config_data = util.read_config_data_from_file(self.config_path)
         logger.debug("Onionbalance config data: %s", config_data)
@@ -124,7 +156,8 @@ class Onionbalance(object):
         """
         Parse HS_DESC_CONTENT response events for descriptor content
 
-        Update the HS instance object with the data from the new descriptor.
+        Queue the new descriptor, so that the descriptor worker updates the HS
+        instance object with its data.
         """
         onion_address = desc_content_event.address
         logger.debug("Received descriptor for %s.onion from %s",
@@ -140,11 +173,41 @@ class Onionbalance(object):
             logger.debug("Empty descriptor received for %s.onion", onion_address)
             return None
 
-        # OK this descriptor seems plausible: Find the instances that this
-        # descriptor belongs to:
+        if not any(instance.onion_address == onion_address for instance in self._get_all_instances()):
+            logger.debug("Received descriptor for %s.onion is not for one of our instances", onion_address)
+            return None
+
+        # OK this descriptor seems plausible: Let the descriptor worker parse it
+        # and register it to its instances
+        self.descriptor_worker.submit(onion_address, descriptor_text)
+
+    def register_instance_descriptor(self, onion_address, descriptor_text, record=None):
+        """
+        Register a descriptor we received to the instances it belongs to. This
+        runs on the descriptor worker thread.
+
+        'record' is the ReceivedDescriptorRecord of the descriptor if a worker
+        process already parsed it.
+        """
         for instance in self._get_all_instances():
             if instance.onion_address == onion_address:
-                instance.register_descriptor(descriptor_text, onion_address)
+                instance.register_descriptor(descriptor_text, onion_address, record)
+
+    def precompute_responsible_hsdirs(self):
+        """
+        Compute the responsible HSDirs of all our services for the current
+        consensus in one go.
+        """
+        if not self.consensus.is_live():
+            return
+
+        self.consensus.precompute_responsible_hsdirs(self._get_identity_pubkeys())
+
+    def _get_identity_pubkeys(self):
+        """
+        Get the identity public keys of all our services
+        """
+        return [service.get_identity_pubkey_bytes() for service in self.services]
 
     def publish_all_descriptors(self):
         """
@@ -177,10 +240,29 @@ class Onionbalance(object):
         # pylint: disable=no-member
         if status_event.action == "CONSENSUS_ARRIVED":
             logger.info("Received new consensus!")
-            self.consensus.refresh()
-            # Call all callbacks in case we just got a live consensus
-            my_onionbalance.publish_all_descriptors()
-            my_onionbalance.fetch_instance_descriptors()
+            self.consensus_worker.request_ingest()
+
+    def ingest_new_consensus(self):
+        """
+        Load the latest consensus and act on it. This runs on the consensus
+        ingest worker thread.
+        """
+        self.consensus.refresh(self._get_identity_pubkeys())
+        # The HSDirs are usually computed along with the new consensus already,
+        # but not if we attached to a shared consensus
+        self.precompute_responsible_hsdirs()
+        # Call all callbacks in case we just got a live consensus
+        self.publish_all_descriptors()
+        self.fetch_instance_descriptors()
+
+    def check_shared_consensus(self):
+        """
+        Ingest the shared consensus if the publisher wrote a new one.
+        """
+        shared_consensus_file = self.consensus.shared_consensus_file
+        if shared_consensus_file.has_new_generation():
+            logger.info("Found new shared consensus!")
+            self.consensus_worker.request_ingest()
 
     def _address_is_instance(self, onion_address):
         """
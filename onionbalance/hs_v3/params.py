@@ -45,6 +45,54 @@ HSDIR_SPREAD_STORE = 4
 # little-t-tor)
 MAX_DESCRIPTOR_SIZE = 50000
 
+# How many worker processes should compute the hash ring node indices when a
+# new consensus arrives? If set to 0, the indices are computed in the main
+# process the first time each hash ring is needed.
+HASH_RING_WORKERS = int(os.environ.get('ONIONBALANCE_HASH_RING_WORKERS', 0))
+
+# For how long after a new consensus arrives should we also upload our
+# descriptors to the HSDirs that were responsible for them in the previous
+# consensus (in seconds)? Clients with a slightly older consensus than ours
+# still fetch descriptors from those HSDirs. If set to 0, we only upload to the
+# HSDirs of our current consensus.
+HSDIR_SET_OVERLAP_WINDOW = int(os.environ.get('ONIONBALANCE_HSDIR_SET_OVERLAP_WINDOW', 0))
+
+# How many microdescriptors should we ask Tor for in a single GETINFO when a
+# new consensus references microdescriptors that we don't have yet?
+MICRODESCRIPTOR_FETCH_BATCH_SIZE = 256
+# If we are missing more than this fraction of the microdescriptors of a
+# consensus (e.g. on startup), fetch all of them at once instead.
+MICRODESCRIPTOR_FULL_FETCH_RATIO = 0.5
+
+# The DataDirectory of the Tor that onionbalance is connected to. If it's set
+# and onionbalance can read it, the consensus and microdescriptors are read
+# from the files Tor caches there instead of being fetched from the control
+# port.
+TOR_DATA_DIRECTORY = os.environ.get('ONIONBALANCE_TOR_DATA_DIRECTORY')
+
+# How long to wait after a new consensus arrives before ingesting it (in
+# seconds). Consensus arrival events that come within that delay are handled
+# with a single ingest.
+CONSENSUS_INGEST_COALESCE_DELAY = 1
+
+# A file through which the onionbalance processes of a host share the work of
+# ingesting consensuses. In 'publish' mode, this process writes its nodes and
+# hash rings there after each new consensus. In 'attach' mode, this process
+# loads them from there instead of parsing the consensus itself.
+SHARED_CONSENSUS_FILE = os.environ.get('ONIONBALANCE_SHARED_CONSENSUS_FILE')
+SHARED_CONSENSUS_MODE = os.environ.get('ONIONBALANCE_SHARED_CONSENSUS_MODE', 'attach')
+# Every how often should attached processes check for a new shared consensus
+# (in seconds)
+SHARED_CONSENSUS_CHECK_FREQUENCY = 10
+
+# How many worker processes should parse and decrypt the instance descriptors
+# we receive? If set to 0, they are parsed on the descriptor worker thread.
+DESCRIPTOR_PARSE_WORKERS = int(os.environ.get('ONIONBALANCE_DESCRIPTOR_PARSE_WORKERS', 0))
+# How many received descriptors can wait to be registered to our instances.
+# When that many are waiting, we stop handling control port events until the
+# descriptor worker catches up.
+DESCRIPTOR_PARSE_QUEUE_SIZE = 256
+
 # Misc parameters
 
 DEFAULT_LOG_LEVEL = os.environ.get('ONIONBALANCE_LOG_LEVEL', 'warning')
@@ -59,6 +59,11 @@ class OnionbalanceService(object):
         # Second descriptor for this service (the one we uploaded last)
         self.second_descriptor = None
 
+        # Computes the revision counters of our descriptors
+        self.revision_counter = descriptor.RevisionCounter(self.identity_priv_key)
+        # Keeps the signing keys of our descriptors and our recertified intro points
+        self.recertifier = descriptor.IntroPointRecertifier()
+
     def has_onion_address(self, onion_address):
         """
         Return True if this service has this onion address
@@ -190,22 +195,15 @@ class OnionbalanceService(object):
         """
         from onionbalance.hs_v3.onionbalance import my_onionbalance
 
-        # Derive blinding parameter
-        _, time_period_number = hashring.get_srv_and_time_period(is_first_desc)
-        blinded_param = my_onionbalance.consensus.get_blinding_param(self._get_identity_pubkey_bytes(),
-                                                                     time_period_number)
-
-        # Get blinded key
-        # TODO: hoho! this is dirty we are poking into internal stem API. We
-        #       should ask atagar to make it public for us! :)
-        blinded_key = stem.descriptor.hidden_service._blinded_pubkey(self._get_identity_pubkey_bytes(), blinded_param)
-
-        # Calculate current responsible HSDirs
+        # Get current responsible HSDirs
         try:
-            responsible_hsdirs = hashring.get_responsible_hsdirs(blinded_key, is_first_desc)
+            hsdir_entry = my_onionbalance.consensus.get_hsdir_table_entry(self.get_identity_pubkey_bytes(),
+                                                                          is_first_desc)
         except hashring.EmptyHashRing:
             return False
 
+        responsible_hsdirs = hsdir_entry.responsible_hsdirs
+
         if is_first_desc:
             previous_responsible_hsdirs = self.first_descriptor.responsible_hsdirs
         else:
@@ -273,12 +271,18 @@ class OnionbalanceService(object):
         n_instances = len(all_intros.intro_points)
         n_intros_wanted = n_instances * params.N_INTROS_PER_INSTANCE
 
-        final_intros = all_intros.choose(n_intros_wanted)
+        # Only take as many intros as fit in a descriptor
+        final_intros = all_intros.choose_within_size(n_intros_wanted, params.MAX_DESCRIPTOR_SIZE)
 
         if (len(final_intros) == 0):
             logger.info("Got no usable intro points from our instances. Delaying descriptor push...")
             raise NotEnoughIntros
 
+        if len(final_intros) < min(n_intros_wanted, len(all_intros)):
+            logger.warning("Only %d of our intros fit in a descriptor of at most %d bytes. Consider "
+                           "relaxing number of instances or intro points per instance "
+                           "(see N_INTROS_PER_INSTANCE)", len(final_intros), params.MAX_DESCRIPTOR_SIZE)
+
         logger.info("We got %d intros from %d instances. We want %d intros ourselves (got: %d)",
                     len(all_intros.get_intro_points_flat()), n_instances,
                     n_intros_wanted, len(final_intros))
@@ -305,43 +309,55 @@ class OnionbalanceService(object):
         except NotEnoughIntros:
             return
 
-        # Derive blinding parameter
-        _, time_period_number = hashring.get_srv_and_time_period(is_first_desc)
-        blinding_param = my_onionbalance.consensus.get_blinding_param(self._get_identity_pubkey_bytes(),
-                                                                      time_period_number)
+        # Get the blinding parameter and responsible HSDirs for our service.
+        # When we do a v3 HSPOST on the control port, Tor decodes the
+        # descriptor and extracts the blinded pubkey to be used when uploading
+        # the descriptor. The table entry was computed from that same blinded
+        # key.
+        #
+        # Right after a consensus change, we also upload to the HSDirs that
+        # clients with the previous consensus will ask. Both sets must come
+        # from the same consensus, so hold its lock so that a new one can't
+        # get swapped in between.
+        with my_onionbalance.consensus.lock:
+            try:
+                hsdir_entry = my_onionbalance.consensus.get_hsdir_table_entry(self.get_identity_pubkey_bytes(),
+                                                                              is_first_desc)
+            except hashring.EmptyHashRing:
+                logger.warning("Can't publish desc with no hash ring. Delaying...")
+                return
+
+            previous_only_hsdirs = my_onionbalance.consensus.get_previous_only_hsdirs(self.get_identity_pubkey_bytes(),
+                                                                                      is_first_desc)
+
+        blinding_param = hsdir_entry.blinding_param
+        responsible_hsdirs = hsdir_entry.responsible_hsdirs
 
         try:
             desc = descriptor.OBDescriptor(self.onion_address, self.identity_priv_key,
-                                           blinding_param, intro_points, is_first_desc)
+                                           blinding_param, intro_points, is_first_desc,
+                                           self.revision_counter, self.recertifier)
         except descriptor.BadDescriptor:
             return
 
         logger.info("Service %s created %s descriptor (%s intro points) (blinding param: %s) (size: %s bytes). About to publish:",
                     self.onion_address, "first" if is_first_desc else "second",
-                    len(desc.intro_set), blinding_param.hex(), len(str(desc.v3_desc)))
-
-        # When we do a v3 HSPOST on the control port, Tor decodes the
-        # descriptor and extracts the blinded pubkey to be used when uploading
-        # the descriptor. So let's do the same to compute the responsible
-        # HSDirs:
-        blinded_key = desc.get_blinded_key()
-
-        # Calculate responsible HSDirs for our service
-        try:
-            responsible_hsdirs = hashring.get_responsible_hsdirs(blinded_key, is_first_desc)
-        except hashring.EmptyHashRing:
-            logger.warning("Can't publish desc with no hash ring. Delaying...")
-            return
+                    len(desc.intro_set), blinding_param.hex(), desc.get_size())
 
         desc.set_last_publish_attempt_ts(datetime.datetime.utcnow())
 
+        if previous_only_hsdirs:
+            logger.info("Also uploading %s descriptor for %s to HSDirs of the previous consensus: %s",
+                        "first" if is_first_desc else "second",
+                        self.onion_address, previous_only_hsdirs)
+
         logger.info("Uploading %s descriptor for %s to %s",
                     "first" if is_first_desc else "second",
                     self.onion_address, responsible_hsdirs)
 
         # Upload descriptor
         self._upload_descriptor(my_onionbalance.controller.controller,
-                                desc, responsible_hsdirs)
+                                desc, responsible_hsdirs + previous_only_hsdirs)
 
         # It would be better to set last_upload_ts when an upload succeeds and
         # not when an upload is just attempted. Unfortunately the HS_DESC #
@@ -367,7 +383,7 @@ class OnionbalanceService(object):
         while True:
             try:
                 onionbalance.common.descriptor.upload_descriptor(controller,
-                                                                 ob_desc.v3_desc,
+                                                                 ob_desc.get_text(),
                                                                  hsdirs=hsdirs,
                                                                  v3_onion_address=ob_desc.onion_address)
                 break
@@ -381,7 +397,7 @@ class OnionbalanceService(object):
                                  "%s.onion.", self.onion_address)
                 break
 
-    def _get_identity_pubkey_bytes(self):
+    def get_identity_pubkey_bytes(self):
         identity_pub_key = self.identity_priv_key.public_key()
         return identity_pub_key.public_bytes(encoding=serialization.Encoding.Raw,
                                              format=serialization.PublicFormat.Raw)
@@ -0,0 +1,272 @@
+"""
+Share the consensus state of one onionbalance process with the other
+onionbalance processes of the same host.
+
+When several onionbalance processes run on a host, they would all parse the
+same consensus and build the same hash rings. Instead, one of them (the
+publisher) writes its nodes and its hash rings to a file after each new
+consensus, and the others attach to that file and load them from it.
+
+The file is a header followed by the node table and the hash rings, all in
+fixed-size binary records:
+
+- header: magic, format version, generation, the valid-after, fresh-until and
+  valid-until times, the current and previous SRV, and the number of nodes and
+  rings,
+- node table: fingerprint, flags and ed25519 identity of each node,
+- each ring: SRV, time period number and number of entries, followed by the
+  sorted HSDir indices and the fingerprints in ring order (the two buffers of
+  hashring.HashRing).
+
+The generation is increased every time the publisher writes the file, so that
+the other processes can tell that there is something new to load by just
+reading the header. The file is written next to its final location and then
+renamed over it, so readers never see a partially written file.
+"""
+import base64
+import datetime
+import mmap
+import os
+import struct
+import tempfile
+
+import stem.util
+
+from onionbalance.common import log
+from onionbalance.hs_v3 import consensus_parser
+from onionbalance.hs_v3 import hashring
+from onionbalance.hs_v3 import tor_node
+
+logger = log.get_logger()
+
+# The modes of ONIONBALANCE_SHARED_CONSENSUS_MODE
+PUBLISH = "publish"
+ATTACH = "attach"
+
+MAGIC = b"OBSHCONS"
+FORMAT_VERSION = 1
+
+# magic, version, generation, valid-after, fresh-until, valid-until, SRV flags,
+# current SRV, previous SRV, number of nodes, number of rings
+_HEADER = struct.Struct(">8sIQqqqB32s32sII")
+# fingerprint, flags, ed25519 identity
+_NODE = struct.Struct(">20sB32s")
+# SRV, time period number, number of ring entries
+_RING_HEADER = struct.Struct(">32sQI")
+
+_HAS_CURRENT_SRV = 1
+_HAS_PREVIOUS_SRV = 2
+
+_NODE_IS_HSDIR = 1
+_NODE_HAS_ED25519_IDENTITY = 2
+
+
+class SharedConsensus(object):
+    """
+    The consensus state loaded out of a shared consensus file.
+    """
+
+    __slots__ = ('generation', 'consensus', 'nodes', 'hash_rings')
+
+    def __init__(self, generation, consensus, nodes, hash_rings):
+        self.generation = generation
+        # A consensus_parser.MicrodescConsensus without routerstatuses
+        self.consensus = consensus
+        # A list of tor_node.Node objects
+        self.nodes = nodes
+        # A dictionary { (srv, time_period_num) : hashring.HashRing , ...}
+        self.hash_rings = hash_rings
+
+
+class SharedConsensusFile(object):
+    """
+    A shared consensus file at 'path', that this process either publishes to
+    or attaches to depending on 'mode' (PUBLISH or ATTACH). The mode from the
+    environment is checked once at startup, by Onionbalance.check_params().
+    """
+
+    def __init__(self, path, mode):
+        self.path = path
+        self.mode = mode
+        # The generation we last published or loaded
+        self.generation = 0
+
+    def is_publisher(self):
+        return self.mode == PUBLISH
+
+    def get_generation(self):
+        """
+        Return the generation of the file on disk, or None if there is no
+        valid file there.
+        """
+        try:
+            with open(self.path, 'rb') as shared_file:
+                header = shared_file.read(_HEADER.size)
+        except FileNotFoundError:
+            return None
+
+        if len(header) < _HEADER.size:
+            return None
+
+        magic, version, generation = _HEADER.unpack(header)[:3]
+        if magic != MAGIC or version != FORMAT_VERSION:
+            return None
+
+        return generation
+
+    def has_new_generation(self):
+        """
+        Return True if the file has a generation that we did not load yet.
+        """
+        generation = self.get_generation()
+        return generation is not None and generation != self.generation
+
+    def publish(self, md_consensus, nodes, hash_rings):
+        """
+        Write the 'md_consensus' times and SRVs, the 'nodes' and the
+        'hash_rings' to the file with a new generation.
+
+        Raise OSError if the file can't be written.
+        """
+        generation = max(self.generation, self.get_generation() or 0) + 1
+
+        srv_flags = 0
+        current_srv = previous_srv = bytes(32)
+        if md_consensus.shared_randomness_current_value:
+            srv_flags |= _HAS_CURRENT_SRV
+            current_srv = base64.b64decode(md_consensus.shared_randomness_current_value)
+        if md_consensus.shared_randomness_previous_value:
+            srv_flags |= _HAS_PREVIOUS_SRV
+            previous_srv = base64.b64decode(md_consensus.shared_randomness_previous_value)
+
+        chunks = [_HEADER.pack(MAGIC, FORMAT_VERSION, generation,
+                               _datetime_to_unix(md_consensus.valid_after),
+                               _datetime_to_unix(md_consensus.fresh_until),
+                               _datetime_to_unix(md_consensus.valid_until),
+                               srv_flags, current_srv, previous_srv,
+                               len(nodes), len(hash_rings))]
+
+        for node in nodes:
+            node_flags = 0
+            if node.is_hsdir:
+                node_flags |= _NODE_IS_HSDIR
+            if node.ed25519_identity is not None:
+                node_flags |= _NODE_HAS_ED25519_IDENTITY
+
+            chunks.append(_NODE.pack(bytes.fromhex(node.fingerprint), node_flags,
+                                     node.ed25519_identity or bytes(32)))
+
+        for (srv, time_period_num), ring in hash_rings.items():
+            chunks.append(_RING_HEADER.pack(srv, time_period_num, len(ring)))
+            chunks.append(ring.indices)
+            chunks.append(ring.fingerprints)
+
+        _write_atomically(self.path, b"".join(chunks))
+        self.generation = generation
+
+        logger.info("Published consensus generation %d (%d nodes, %d hash rings) to %s",
+                    generation, len(nodes), len(hash_rings), self.path)
+
+    def load(self):
+        """
+        Return the SharedConsensus of the file, or None if we already loaded
+        its generation.
+
+        Raise OSError if the file can't be read, and ValueError if it's not a
+        valid shared consensus file.
+        """
+        with open(self.path, 'rb') as shared_file:
+            if os.fstat(shared_file.fileno()).st_size < _HEADER.size:
+                raise ValueError("Shared consensus file is truncated")
+
+            with mmap.mmap(shared_file.fileno(), 0, access=mmap.ACCESS_READ) as shared_map:
+                if _HEADER.unpack_from(shared_map)[2] == self.generation:
+                    return None
+
+                shared_consensus = _parse(shared_map)
+
+        self.generation = shared_consensus.generation
+
+        logger.info("Loaded consensus generation %d (%d nodes, %d hash rings) from %s",
+                    shared_consensus.generation, len(shared_consensus.nodes),
+                    len(shared_consensus.hash_rings), self.path)
+
+        return shared_consensus
+
+
+def _parse(data):
+    """
+    Return the SharedConsensus in 'data', the contents of a shared consensus
+    file.
+    """
+    try:
+        (magic, version, generation, valid_after, fresh_until, valid_until,
+         srv_flags, current_srv, previous_srv, n_nodes, n_rings) = _HEADER.unpack_from(data)
+    except struct.error:
+        raise ValueError("Shared consensus file is truncated")
+
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise ValueError("Not a shared consensus file (or an unsupported version of it)")
+
+    md_consensus = consensus_parser.MicrodescConsensus()
+    md_consensus.valid_after = datetime.datetime.utcfromtimestamp(valid_after)
+    md_consensus.fresh_until = datetime.datetime.utcfromtimestamp(fresh_until)
+    md_consensus.valid_until = datetime.datetime.utcfromtimestamp(valid_until)
+    if srv_flags & _HAS_CURRENT_SRV:
+        md_consensus.shared_randomness_current_value = base64.b64encode(current_srv).decode('ascii')
+    if srv_flags & _HAS_PREVIOUS_SRV:
+        md_consensus.shared_randomness_previous_value = base64.b64encode(previous_srv).decode('ascii')
+
+    try:
+        offset = _HEADER.size
+        nodes = []
+        for fingerprint, node_flags, ed25519_identity in _NODE.iter_unpack(data[offset:offset + n_nodes * _NODE.size]):
+            nodes.append(tor_node.Node.from_fields(
+                fingerprint.hex().upper(),
+                ed25519_identity if node_flags & _NODE_HAS_ED25519_IDENTITY else None,
+                bool(node_flags & _NODE_IS_HSDIR)))
+        offset += n_nodes * _NODE.size
+
+        hash_rings = {}
+        for _ in range(n_rings):
+            srv, time_period_num, n_entries = _RING_HEADER.unpack_from(data, offset)
+            offset += _RING_HEADER.size
+
+            indices = data[offset:offset + n_entries * hashring.HSDIR_INDEX_LEN]
+            offset += n_entries * hashring.HSDIR_INDEX_LEN
+            fingerprints = data[offset:offset + n_entries * hashring.FINGERPRINT_LEN]
+            offset += n_entries * hashring.FINGERPRINT_LEN
+
+            hash_rings[(srv, time_period_num)] = hashring.HashRing.from_packed(srv, time_period_num,
+                                                                               indices, fingerprints)
+    except struct.error:
+        raise ValueError("Shared consensus file is truncated")
+
+    if len(nodes) != n_nodes or offset > len(data):
+        raise ValueError("Shared consensus file is truncated")
+
+    return SharedConsensus(generation, md_consensus, nodes, hash_rings)
+
+
+def _write_atomically(path, data):
+    """
+    Write 'data' to a file next to 'path' and rename it to 'path'.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                                    prefix=os.path.basename(path) + ".")
+    try:
+        with os.fdopen(fd, 'wb') as tmp_file:
+            tmp_file.write(data)
+        # Other onionbalance processes may run as different users
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def _datetime_to_unix(timestamp):
+    if timestamp is None:
+        return 0
+
+    return int(stem.util.datetime_to_unix(timestamp))
@@ -63,6 +63,17 @@ class StemController(object):
     def get_md_consensus(self):
         return self.controller.get_info("dir/status-vote/current/consensus-microdesc")
 
+    def get_microdescriptors_by_digest(self, digests):
+        """
+        Return a dictionary { digest : microdescriptor content , ... } with the
+        microdescriptors that have 'digests' (base64 digests, like in the
+        consensus), fetched with a single GETINFO.
+
+        Raises stem.OperationFailed if Tor does not have one of them.
+        """
+        answers = self.controller.get_info(["md/d/%s" % digest for digest in digests])
+        return {digest: answers["md/d/%s" % digest] for digest in digests}
+
     def add_event_listeners(self):
         # pylint: disable=no-member
 
@@ -11,72 +11,159 @@ class Node(object):
     """
     Represents a Tor node.
 
-    A Node instance gets created for each node of a consensus. When we fetch a
-    new consensus, we create new Node instances for the routers found inside.
-
-    The 'microdescriptor' and 'routerstatus' fields of this object are
-    immutable: They are set once when we receive the consensus based on the
-    state of the network at that point, and they stay like that until we get a
-    new consensus.
+    A Node instance gets created for each node of a consensus that can be an
+    HSDir. When we fetch a new consensus, we create new Node instances for the
+    routers found inside.
+
+    A node only keeps the few fields that onionbalance needs out of the
+    microdescriptor and routerstatus of the router, so that we don't keep the
+    stem objects of the whole consensus in memory. These fields are immutable:
+    They are set once when we receive the consensus based on the state of the
+    network at that point, and they stay like that until we get a new
+    consensus.
     """
 
+    __slots__ = ('fingerprint', 'ed25519_identity', 'is_hsdir')
+
     def __init__(self, microdescriptor, routerstatus):
         assert (microdescriptor and routerstatus)
 
         logger.debug("Initializing node with fpr %s", routerstatus.fingerprint)
 
-        # The microdescriptor of this node
-        self.microdescriptor = microdescriptor
-        # The consensus routerstatus for this node
-        self.routerstatus = routerstatus
+        # The hex fingerprint of this node
+        self.fingerprint = routerstatus.fingerprint
+        # The raw 32-byte ed25519 identity of this node (None if it has none)
+        self.ed25519_identity = get_ed25519_identity(microdescriptor)
+        # True if this node can be an HSDir (it needs to be supported both in
+        # protover and in flags)
+        self.is_hsdir = can_be_hsdir(routerstatus)
+
+    @classmethod
+    def from_fields(cls, fingerprint, ed25519_identity, is_hsdir):
+        """
+        Create a Node straight from its fields, when we don't have stem
+        objects for it.
+        """
+        node = cls.__new__(cls)
+        node.fingerprint = fingerprint
+        node.ed25519_identity = ed25519_identity
+        node.is_hsdir = is_hsdir
+
+        return node
+
+    @classmethod
+    def from_routerstatus(cls, routerstatus, ed25519_identity):
+        """
+        Create a Node out of its 'routerstatus' and the 'ed25519_identity' we
+        already extracted from its microdescriptor (see
+        microdescriptor_cache.MicrodescriptorCache).
+        """
+        return cls.from_fields(routerstatus.fingerprint, ed25519_identity, can_be_hsdir(routerstatus))
 
     def get_hex_fingerprint(self):
-        return self.routerstatus.fingerprint
+        return self.fingerprint
 
-    def get_hsdir_index(self, srv, period_num):
+    def get_hsdir_index(self, srv, period_num, period_length=None):
         """
-        Get the HSDir index for this node:
+        Get the HSDir index for this node (see compute_hsdir_index()).
 
-           hsdir_index(node) = H("node-idx" | node_identity |
-                                 shared_random_value |
-                                 INT_8(period_num) |
-                                 INT_8(period_length) )
+        If 'period_length' is not set, we get it from the current consensus.
 
         Raises NoHSDir or NoEd25519Identity in case of errors.
         """
-        from onionbalance.hs_v3.onionbalance import my_onionbalance
-
-        # See if this node can be an HSDir (it needs to be supported both in
-        # protover and in flags)
-        if 'HSDir' not in self.routerstatus.protocols or \
-           2 not in self.routerstatus.protocols['HSDir'] or \
-           'HSDir' not in self.routerstatus.flags:
+        # See if this node can be an HSDir
+        if not self.is_hsdir:
             raise NoHSDir
 
         # See if ed25519 identity is supported for this node
-        if 'ed25519' not in self.microdescriptor.identifiers:
+        if self.ed25519_identity is None:
             raise NoEd25519Identity
 
-        # In stem the ed25519 identity is a base64 string and we need to add
-        # the missing padding so that the python base64 module can successfuly
-        # decode it.
-        # TODO: Abstract this into its own function...
-        ed25519_node_identity_b64 = self.microdescriptor.identifiers['ed25519']
-        missing_padding = len(ed25519_node_identity_b64) % 4
-        ed25519_node_identity_b64 += '=' * missing_padding
-        ed25519_node_identity = base64.b64decode(ed25519_node_identity_b64)
-
-        period_num_int_8 = period_num.to_bytes(8, 'big')
-        period_length = my_onionbalance.consensus.get_time_period_length()
-        period_length_int_8 = period_length.to_bytes(8, 'big')
-
-        hash_body = b"%s%s%s%s%s" % (b"node-idx",
-                                     ed25519_node_identity,
-                                     srv,
-                                     period_num_int_8, period_length_int_8)
-        hsdir_index = hashlib.sha3_256(hash_body).digest()
-
-        return hsdir_index
+        if period_length is None:
+            from onionbalance.hs_v3.onionbalance import my_onionbalance
+            period_length = my_onionbalance.consensus.get_time_period_length()
+
+        return compute_hsdir_index(self.ed25519_identity, srv, period_num, period_length)
+
+    def get_ring_identity(self):
+        """
+        Return the ed25519 identity of this node if it can be part of the
+        hash ring, or None otherwise.
+        """
+        if not self.is_hsdir:
+            return None
+
+        return self.ed25519_identity
+
+
+def compute_hsdir_index(ed25519_identity, srv, period_num, period_length):
+    """
+    Compute the HSDir index of a node with 'ed25519_identity':
+
+       hsdir_index(node) = H("node-idx" | node_identity |
+                             shared_random_value |
+                             INT_8(period_num) |
+                             INT_8(period_length) )
+    """
+    period_num_int_8 = period_num.to_bytes(8, 'big')
+    period_length_int_8 = period_length.to_bytes(8, 'big')
+
+    hash_body = b"%s%s%s%s%s" % (b"node-idx",
+                                 ed25519_identity,
+                                 srv,
+                                 period_num_int_8, period_length_int_8)
+
+    return hashlib.sha3_256(hash_body).digest()
+
+
+def compute_hsdir_indices(ed25519_identities, srv_and_time_periods, period_length):
+    """
+    Compute the HSDir indices of a list of nodes for many (SRV, time period)
+    pairs at once.
+
+    'ed25519_identities' has the identity of each node, or None for nodes that
+    can't be part of the hash ring. Return a list with the indices of all the
+    nodes for each pair in 'srv_and_time_periods', with None for the nodes
+    without an identity.
+
+    This only works with plain values so that it can run in worker processes.
+    """
+    return [[compute_hsdir_index(ed25519_identity, srv, period_num, period_length)
+             if ed25519_identity is not None else None
+             for ed25519_identity in ed25519_identities]
+            for srv, period_num in srv_and_time_periods]
+
+
+def can_be_hsdir(routerstatus):
+    """
+    Return True if the node with this 'routerstatus' can be an HSDir.
+    """
+    return 'HSDir' in routerstatus.protocols and \
+        2 in routerstatus.protocols['HSDir'] and \
+        'HSDir' in routerstatus.flags
+
+
+def get_ed25519_identity(microdescriptor):
+    """
+    Return the raw ed25519 identity from this 'microdescriptor', or None if it
+    does not have one.
+    """
+    if 'ed25519' not in microdescriptor.identifiers:
+        return None
+
+    return decode_ed25519_identity(microdescriptor.identifiers['ed25519'])
+
+
+def decode_ed25519_identity(ed25519_node_identity_b64):
+    """
+    Decode a base64 ed25519 identity like the ones found in microdescriptors.
+
+    In stem the ed25519 identity is a base64 string and we need to add the
+    missing padding so that the python base64 module can successfuly decode
+    it.
+    """
+    missing_padding = -len(ed25519_node_identity_b64) % 4
+    return base64.b64decode(ed25519_node_identity_b64 + '=' * missing_padding)
 
 
 class NoEd25519Identity(Exception):
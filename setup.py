@@ -31,6 +31,7 @@ setup(
         "console_scripts": [
             'onionbalance = onionbalance.manager:main',
             'onionbalance-config = onionbalance.config_generator.config_generator:main',
+            'onionbalance-hsdirs = onionbalance.hs_v3.hsdir_calculator:main',
         ]},
     description="Onionbalance provides load-balancing and redundancy for Tor "
                 "hidden services by distributing requests to multiple backend "
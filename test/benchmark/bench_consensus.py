@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Consensus ingest benchmark.
+
+Drives the consensus ingest pipeline through a stub controller that serves a
+microdesc consensus and its microdescriptors from memory, and reports the
+wall time and memory use of each stage:
+
+- fetch: getting the consensus string from the controller,
+- parse: parsing it with our consensus parser (and with stem, for reference),
+- microdescriptors: building the microdescriptor cache from scratch,
+- nodes: building the nodes with a warm microdescriptor cache,
+- refresh: the whole Consensus.refresh() from a cold start, after some relay
+  churn (synthetic networks only) and with an unchanged consensus.
+
+It runs on a synthetic full-size network by default, or on a consensus and
+microdescriptors recorded from a Tor DataDirectory. Recorded consensuses are
+treated as live whatever their age, so that the same files can be compared
+over time.
+
+Run it from the root of the repository:
+
+    python3 -m test.benchmark.bench_consensus --output consensus-benchmark.json
+"""
+import argparse
+import io
+import sys
+from unittest import mock
+
+import stem.descriptor
+from stem.descriptor.networkstatus import NetworkStatusDocumentV3
+
+from onionbalance.hs_v3 import consensus
+from onionbalance.hs_v3 import consensus_parser
+from onionbalance.hs_v3 import microdescriptor_cache
+from onionbalance.hs_v3 import tor_node
+
+from test.benchmark import common
+from test.benchmark import fixtures
+
+# Ratio of relays replaced between two consecutive consensuses
+CONSENSUS_CHURN_RATIO = 0.02
+
+
+class StubController(object):
+    """
+    Serves a consensus and its microdescriptors like StemController does, out
+    of memory.
+    """
+
+    def __init__(self, md_consensus, microdescriptors):
+        # The microdesc consensus as a string
+        self.md_consensus = md_consensus
+        self.set_microdescriptors(microdescriptors)
+        # Stands for the stem Controller as well (see get_microdescriptors())
+        self.controller = self
+
+    def set_microdescriptors(self, microdescriptors):
+        """
+        Serve the microdescriptors in 'microdescriptors', a string in the
+        same format as the 'md/all' GETINFO.
+        """
+        self.microdescriptors = microdescriptors
+        self.microdescriptors_by_digest = {microdescriptor.digest(): str(microdescriptor)
+                                           for microdescriptor in _parse_microdescriptors(microdescriptors)}
+
+    def get_md_consensus(self):
+        return self.md_consensus
+
+    def get_microdescriptors(self):
+        # Like stem, parse the whole 'md/all' GETINFO answer
+        return _parse_microdescriptors(self.microdescriptors)
+
+    def get_microdescriptors_by_digest(self, digests):
+        return {digest: self.microdescriptors_by_digest[digest] for digest in digests
+                if digest in self.microdescriptors_by_digest}
+
+
+def _parse_microdescriptors(microdescriptors):
+    return list(stem.descriptor.parse_file(io.BytesIO(microdescriptors.encode('utf-8')), 'microdescriptor 1.0'))
+
+
+def _measure(function, repeat, setup=None):
+    """
+    Time 'function' over 'repeat' calls, then profile its memory use over one
+    more call. Return the merged stats along with the result of the last
+    call.
+    """
+    timings, result = common.time_call(function, repeat, setup)
+
+    if setup:
+        setup_result = setup()
+        memory, result = common.profile_call(lambda: function(setup_result))
+    else:
+        memory, result = common.profile_call(function)
+
+    timings.update(memory)
+    return timings, result
+
+
+def _make_consensus():
+    return consensus.Consensus(do_refresh_consensus=False)
+
+
+def bench_stages(controller, repeat):
+    results = {}
+
+    results['fetch'], md_consensus_str = _measure(lambda: controller.get_md_consensus().encode(), repeat)
+    results['fetch']['size'] = len(md_consensus_str)
+
+    results['parse'], md_consensus = _measure(lambda: consensus_parser.parse_md_consensus(md_consensus_str), repeat)
+    results['parse']['routers'] = len(md_consensus.routers)
+    results['stem_parse'], _ = _measure(lambda: NetworkStatusDocumentV3(md_consensus_str), repeat)
+
+    digests = [routerstatus.microdescriptor_digest for routerstatus in md_consensus.routers.values()
+               if tor_node.can_be_hsdir(routerstatus)]
+
+    def build_microdescriptor_cache():
+        cache = microdescriptor_cache.MicrodescriptorCache()
+        cache.update(controller, digests)
+        return cache
+
+    results['microdescriptors'], cache = _measure(build_microdescriptor_cache, repeat)
+    results['microdescriptors']['cached'] = len(cache)
+
+    def make_warm_consensus():
+        warm_consensus = _make_consensus()
+        warm_consensus.consensus = md_consensus
+        warm_consensus.microdescriptor_cache = cache
+        return warm_consensus
+
+    results['nodes'], nodes = _measure(lambda warm_consensus: warm_consensus._initialize_nodes(),
+                                       repeat, make_warm_consensus)
+    results['nodes']['nodes'] = len(nodes)
+
+    return results
+
+
+def bench_refresh(controller, network, repeat):
+    results = {}
+
+    def refresh(refreshed_consensus):
+        refreshed_consensus.refresh()
+        return refreshed_consensus
+
+    results['refresh_cold'], refreshed_consensus = _measure(refresh, repeat, _make_consensus)
+    results['refresh_cold']['nodes'] = len(refreshed_consensus.nodes)
+
+    def make_loaded_consensus():
+        loaded_consensus = _make_consensus()
+        loaded_consensus.refresh()
+        return loaded_consensus
+
+    results['refresh_unchanged'], _ = _measure(refresh, repeat, make_loaded_consensus)
+
+    if network:
+        previous_md_consensus = controller.md_consensus
+        previous_microdescriptors = controller.microdescriptors
+        network.churn(CONSENSUS_CHURN_RATIO)
+        md_consensus = network.get_md_consensus()
+        microdescriptors = network.get_microdescriptors()
+
+        def make_churned_consensus():
+            controller.md_consensus = previous_md_consensus
+            controller.set_microdescriptors(previous_microdescriptors)
+            churned_consensus = make_loaded_consensus()
+
+            controller.md_consensus = md_consensus
+            controller.set_microdescriptors(microdescriptors)
+            return churned_consensus
+
+        results['refresh_churn'], _ = _measure(refresh, repeat, make_churned_consensus)
+        results['refresh_churn']['churn_ratio'] = CONSENSUS_CHURN_RATIO
+
+    return results
+
+
+def parse_cmd_args():
+    parser = argparse.ArgumentParser(description="Benchmark the onionbalance consensus ingest.")
+    parser.add_argument("--relays", type=int, default=fixtures.DEFAULT_N_RELAYS,
+                        help="Number of relays in the synthetic consensus (default: %(default)s).")
+    parser.add_argument("--consensus", type=str,
+                        help="Use this recorded microdesc consensus file (e.g. cached-microdesc-consensus "
+                        "from a Tor DataDirectory) instead of a synthetic network.")
+    parser.add_argument("--microdescriptors", type=str, nargs='+', default=[],
+                        help="The recorded microdescriptor files that go with --consensus (e.g. "
+                        "cached-microdescs and cached-microdescs.new).")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="How many times to run each benchmark (default: %(default)s).")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic network (default: %(default)s).")
+    parser.add_argument("-o", "--output", type=str, default="consensus-benchmark.json",
+                        help="Where to write the JSON results (default: %(default)s).")
+
+    return parser.parse_args()
+
+
+def main():
+    from onionbalance.hs_v3.onionbalance import my_onionbalance
+
+    args = parse_cmd_args()
+    common.quiet_logs()
+
+    if args.consensus:
+        network = None
+        with open(args.consensus, 'r') as consensus_file:
+            md_consensus = consensus_file.read()
+
+        microdescriptors = ""
+        for microdescriptor_path in args.microdescriptors:
+            with open(microdescriptor_path, 'r') as microdescriptor_file:
+                microdescriptors += microdescriptor_file.read()
+    else:
+        network = fixtures.SyntheticNetwork(args.relays, seed=args.seed)
+        md_consensus = network.get_md_consensus()
+        microdescriptors = network.get_microdescriptors()
+
+    controller = StubController(md_consensus, microdescriptors)
+
+    with mock.patch.object(my_onionbalance, 'controller', controller, create=True), \
+            mock.patch('onionbalance.hs_v3.params.TOR_DATA_DIRECTORY', None), \
+            mock.patch('onionbalance.hs_v3.params.SHARED_CONSENSUS_FILE', None), \
+            mock.patch('onionbalance.hs_v3.params.HASH_RING_WORKERS', 0), \
+            mock.patch.object(consensus.Consensus, 'is_live', lambda self: self.consensus is not None):
+        results = bench_stages(controller, args.repeat)
+        results.update(bench_refresh(controller, network, args.repeat))
+
+    parameters = {'relays': args.relays if network else None, 'consensus': args.consensus,
+                  'microdescriptors': args.microdescriptors, 'repeat': args.repeat, 'seed': args.seed}
+    common.write_results(args.output, 'consensus', parameters, results)
+
+    print("Wrote consensus benchmark results to %s" % args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+Hash ring benchmark.
+
+Times hash ring construction, responsible HSDir lookups and HSDir change
+detection on a synthetic full-size network, and writes the results as JSON.
+
+Run it from the root of the repository:
+
+    python3 -m test.benchmark.bench_hashring --output hashring-benchmark.json
+"""
+import argparse
+import random
+import sys
+
+from onionbalance.hs_v3 import hashring
+from onionbalance.hs_v3 import params
+
+from test.benchmark import common
+from test.benchmark import fixtures
+
+DEFAULT_SERVICE_COUNTS = [1, 100, 1000]
+
+# Ratio of relays replaced between two consecutive consensuses
+CONSENSUS_CHURN_RATIO = 0.02
+
+
+def _random_hs_indices(rng):
+    return [rng.getrandbits(256).to_bytes(32, 'big') for _ in range(params.HSDIR_N_REPLICAS)]
+
+
+def bench_ring_construction(repeat, n_workers):
+    from onionbalance.hs_v3.onionbalance import my_onionbalance
+
+    nodes = my_onionbalance.consensus.nodes
+    srv, time_period_num = hashring.get_srv_and_time_period(True)
+
+    results = {}
+    results['ring_construction'], ring = common.time_call(
+        lambda: hashring.HashRing(nodes, srv, time_period_num), repeat)
+    results['ring_construction']['ring_size'] = len(ring)
+
+    if n_workers:
+        period_length = my_onionbalance.consensus.get_time_period_length()
+
+        def build_with_workers():
+            all_indices = hashring.compute_hsdir_indices(nodes, [(srv, time_period_num)], period_length, n_workers)
+            return hashring.HashRing(nodes, srv, time_period_num, all_indices[(srv, time_period_num)])
+
+        results['ring_construction_workers'], _ = common.time_call(build_with_workers, repeat)
+        results['ring_construction_workers']['workers'] = n_workers
+
+    return results
+
+
+def bench_lookups(n_services, repeat, rng):
+    from onionbalance.hs_v3.onionbalance import my_onionbalance
+
+    blinded_keys = [rng.getrandbits(256).to_bytes(32, 'big') for _ in range(n_services)]
+    hs_indices_list = [_random_hs_indices(rng) for _ in range(n_services)]
+
+    # Build the ring outside of the timed part
+    hash_ring = hashring._get_hash_ring_for_descriptor(True)
+    assert (my_onionbalance.consensus.hash_rings)
+
+    results = {}
+    results['get_responsible_hsdirs'], _ = common.time_call(
+        lambda: [hashring.get_responsible_hsdirs(blinded_key, True) for blinded_key in blinded_keys], repeat)
+    results['batched_lookup'], _ = common.time_call(
+        lambda: hash_ring.get_responsible_hsdirs_many(hs_indices_list), repeat)
+
+    return results
+
+
+def bench_change_detection(network, n_services, repeat, rng):
+    srv, time_period_num = hashring.get_srv_and_time_period(True)
+    hs_indices_list = [_random_hs_indices(rng) for _ in range(n_services)]
+
+    previous_ring = hashring.HashRing(network.get_nodes(), srv, time_period_num)
+    lookup_results = previous_ring.lookup_many(hs_indices_list)
+
+    # Like the consensus does, make the new ring out of the previous one, so
+    # that it knows which nodes changed
+    network.churn(CONSENSUS_CHURN_RATIO)
+    new_ring = hashring.HashRing.from_previous(previous_ring, network.get_nodes())
+    if new_ring is None:
+        new_ring = hashring.HashRing(network.get_nodes(), srv, time_period_num)
+
+    def detect_changes():
+        changed_indices = new_ring.get_changed_indices(previous_ring)
+        return [hashring.arcs_have_changes(arcs, changed_indices) for _, arcs in lookup_results]
+
+    results = {}
+    results['change_detection'], changed = common.time_call(detect_changes, repeat)
+    results['change_detection']['services_changed'] = sum(changed)
+    results['change_detection']['churn_ratio'] = CONSENSUS_CHURN_RATIO
+
+    # What it costs to recompute every service instead
+    results['full_recompute'], _ = common.time_call(lambda: new_ring.lookup_many(hs_indices_list), repeat)
+
+    return results
+
+
+def parse_cmd_args():
+    parser = argparse.ArgumentParser(description="Benchmark the onionbalance hash ring on a synthetic network.")
+    parser.add_argument("--relays", type=int, default=fixtures.DEFAULT_N_RELAYS,
+                        help="Number of relays in the synthetic consensus (default: %(default)s).")
+    parser.add_argument("--services", type=int, nargs='+', default=DEFAULT_SERVICE_COUNTS,
+                        help="Numbers of services to benchmark lookups with (default: %(default)s).")
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="How many times to run each benchmark (default: %(default)s).")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Also benchmark ring construction with this many worker processes.")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed of the synthetic network (default: %(default)s).")
+    parser.add_argument("-o", "--output", type=str, default="hashring-benchmark.json",
+                        help="Where to write the JSON results (default: %(default)s).")
+
+    return parser.parse_args()
+
+
+def main():
+    from onionbalance.hs_v3.onionbalance import my_onionbalance
+
+    args = parse_cmd_args()
+    common.quiet_logs()
+    rng = random.Random(args.seed)
+
+    network = fixtures.SyntheticNetwork(args.relays, seed=args.seed)
+    my_onionbalance.consensus = common.make_consensus(network)
+
+    results = bench_ring_construction(args.repeat, args.workers)
+    for n_services in args.services:
+        results['services_%d' % n_services] = bench_lookups(n_services, args.repeat, rng)
+
+    for n_services in args.services:
+        results['services_%d' % n_services].update(
+            bench_change_detection(network, n_services, args.repeat, rng))
+
+    parameters = {'relays': args.relays, 'services': args.services, 'repeat': args.repeat,
+                  'workers': args.workers, 'seed': args.seed}
+    common.write_results(args.output, 'hashring', parameters, results)
+
+    print("Wrote hash ring benchmark results to %s" % args.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
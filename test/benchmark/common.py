@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+Helpers shared by the benchmarks.
+"""
+import base64
+import datetime
+import gc
+import json
+import logging
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+from onionbalance.common import log
+from onionbalance.hs_v3 import consensus
+
+
+def quiet_logs():
+    """
+    Only log warnings and errors, so that logging does not skew the timings.
+    """
+    log.get_logger().setLevel(logging.WARNING)
+
+
+def time_call(function, repeat, setup=None):
+    """
+    Call 'function' 'repeat' times and return a dictionary with timing stats
+    (in seconds) along with the result of the last call.
+
+    If 'setup' is set, it's called before each call, outside of the timed
+    part, and 'function' gets what it returns.
+    """
+    timings = []
+    result = None
+    for _ in range(repeat):
+        arguments = (setup(),) if setup else ()
+        start = time.perf_counter()
+        result = function(*arguments)
+        timings.append(time.perf_counter() - start)
+
+    stats = {'repeat': repeat,
+             'min': min(timings),
+             'median': statistics.median(timings),
+             'mean': statistics.mean(timings),
+             'max': max(timings)}
+
+    return stats, result
+
+
+def profile_call(function, n_top_allocations=5):
+    """
+    Call 'function' once while tracing its memory allocations, and return a
+    dictionary with memory stats (in bytes) along with its result:
+
+    - 'allocated': the memory it allocated and that is still in use after the
+      call (e.g. what it returned),
+    - 'peak_allocated': the most memory it had allocated at once,
+    - 'top_allocations': the 'n_top_allocations' source lines that allocated
+      most of the memory still in use,
+    - 'peak_rss': the peak RSS of the whole process so far (the high-water
+      mark, so it only grows from one call to the next).
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = function()
+        allocated, peak_allocated = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    top_allocations = [{'location': "%s:%d" % (stat.traceback[0].filename, stat.traceback[0].lineno),
+                        'size': stat.size, 'count': stat.count}
+                       for stat in snapshot.statistics('lineno')[:n_top_allocations]]
+
+    stats = {'allocated': allocated,
+             'peak_allocated': peak_allocated,
+             'top_allocations': top_allocations,
+             'peak_rss': get_peak_rss()}
+
+    return stats, result
+
+
+def get_peak_rss():
+    """
+    Return the peak RSS of this process in bytes, or None if we can't tell.
+    """
+    if not resource:
+        return None
+
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # It's in bytes on macOS and in kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return peak_rss
+
+    return peak_rss * 1024
+
+
+def make_consensus(network, nodes=None):
+    """
+    Return a consensus.Consensus for the synthetic 'network', without going
+    through a control port.
+    """
+    bench_consensus = consensus.Consensus(do_refresh_consensus=False)
+    bench_consensus.consensus = SimpleNamespace(
+        valid_after=network.valid_after,
+        valid_until=network.valid_after + datetime.timedelta(hours=3),
+        shared_randomness_current_value=base64.b64encode(network.shared_randomness_current_value).decode('utf-8'),
+        shared_randomness_previous_value=base64.b64encode(network.shared_randomness_previous_value).decode('utf-8'))
+    bench_consensus.nodes = nodes if nodes is not None else network.get_nodes()
+
+    return bench_consensus
+
+
+def write_results(output_path, benchmark_name, parameters, results):
+    """
+    Write the 'results' of a benchmark run as JSON to 'output_path'.
+    """
+    report = {'benchmark': benchmark_name,
+              'timestamp': datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'parameters': parameters,
+              'results': results}
+
+    with open(output_path, 'w') as handle:
+        json.dump(report, handle, indent=2, sort_keys=True)
+        handle.write("\n")
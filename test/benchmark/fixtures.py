@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic full-size network fixtures for the benchmarks.
+
+Everything here is generated offline from a seeded random generator, so that
+benchmark runs are reproducible and don't need a Tor network.
+"""
+import base64
+import datetime
+import hashlib
+import random
+
+from onionbalance.hs_v3 import tor_node
+
+# Roughly the shape of the real network
+DEFAULT_N_RELAYS = 8000
+HSDIR_FLAG_RATIO = 0.6
+HSDIR_V2_PROTOCOL_RATIO = 0.97
+ED25519_RATIO = 0.99
+MISSING_MICRODESCRIPTOR_RATIO = 0.005
+
+PROTOCOLS_HSDIR_V2 = "Conflux=1 Cons=1-2 Desc=1-3 DirCache=2 FlowCtrl=1-2 HSDir=2 HSIntro=4-5 " \
+    "HSRend=1-2 Link=1-5 LinkAuth=1,3 Microdesc=1-3 Padding=2 Relay=1-4"
+PROTOCOLS_HSDIR_V1 = "Cons=1-2 Desc=1-2 DirCache=1-2 HSDir=1 HSIntro=3-4 HSRend=1-2 Link=1-5 " \
+    "LinkAuth=1,3 Microdesc=1-2 Relay=1-2"
+
+OTHER_FLAGS = ["Exit", "Fast", "Guard", "Stable", "V2Dir"]
+
+
+def _b64(raw):
+    return base64.b64encode(raw).decode('utf-8').rstrip('=')
+
+
+class SyntheticRelay(object):
+    """
+    The fields of a single relay of a synthetic network.
+    """
+
+    def __init__(self, rng, number):
+        self.nickname = "relay%d" % number
+        self.fingerprint = rng.getrandbits(160).to_bytes(20, 'big')
+        flags = ["Running", "Valid"] + rng.sample(OTHER_FLAGS, rng.randint(0, len(OTHER_FLAGS)))
+        if rng.random() < HSDIR_FLAG_RATIO:
+            flags.append("HSDir")
+        self.flags = sorted(flags)
+        self.protocols = PROTOCOLS_HSDIR_V2 if rng.random() < HSDIR_V2_PROTOCOL_RATIO else PROTOCOLS_HSDIR_V1
+        self.ed25519_identity = rng.getrandbits(256).to_bytes(32, 'big') if rng.random() < ED25519_RATIO else None
+        self.has_microdescriptor = rng.random() >= MISSING_MICRODESCRIPTOR_RATIO
+        self.address = "%d.%d.%d.%d" % tuple(rng.randint(1, 254) for _ in range(4))
+
+        self.microdescriptor = self._make_microdescriptor(rng)
+        self.microdescriptor_digest = _b64(hashlib.sha256(self.microdescriptor.encode('utf-8')).digest())
+
+    def _make_microdescriptor(self, rng):
+        lines = ["onion-key",
+                 "ntor-onion-key %s" % _b64(rng.getrandbits(256).to_bytes(32, 'big')),
+                 "family $%s" % rng.getrandbits(160).to_bytes(20, 'big').hex().upper()]
+        if self.ed25519_identity:
+            lines.append("id ed25519 %s" % _b64(self.ed25519_identity))
+
+        return "\n".join(lines) + "\n"
+
+    def get_hex_fingerprint(self):
+        return self.fingerprint.hex().upper()
+
+    def is_hsdir(self):
+        return "HSDir" in self.flags and "HSDir=2" in self.protocols
+
+    def to_node(self):
+        return tor_node.Node.from_fields(self.get_hex_fingerprint(), self.ed25519_identity, self.is_hsdir())
+
+    def routerstatus_lines(self, published):
+        published = published.strftime("%Y-%m-%d %H:%M:%S")
+
+        return ["r %s %s %s %s 9001 0" % (self.nickname, _b64(self.fingerprint), published, self.address),
+                "m %s" % self.microdescriptor_digest,
+                "s %s" % " ".join(self.flags),
+                "v Tor 0.4.8.12",
+                "pr %s" % self.protocols,
+                "w Bandwidth=%d" % (len(self.nickname) * 1000)]
+
+
+class SyntheticNetwork(object):
+    """
+    A synthetic network of 'n_relays' relays, that can be rendered as a
+    microdesc consensus and a set of microdescriptors like the ones Tor gives
+    us over the control port.
+    """
+
+    def __init__(self, n_relays=DEFAULT_N_RELAYS, seed=0, valid_after=None):
+        self.rng = random.Random(seed)
+
+        if not valid_after:
+            valid_after = datetime.datetime.utcnow().replace(minute=0, second=0, microsecond=0)
+        self.valid_after = valid_after
+
+        self.shared_randomness_current_value = self.rng.getrandbits(256).to_bytes(32, 'big')
+        self.shared_randomness_previous_value = self.rng.getrandbits(256).to_bytes(32, 'big')
+
+        self.relays = [SyntheticRelay(self.rng, i) for i in range(n_relays)]
+
+    def get_nodes(self):
+        """
+        Return a tor_node.Node for each relay that has a microdescriptor.
+        """
+        return [relay.to_node() for relay in self.relays if relay.has_microdescriptor]
+
+    def churn(self, ratio):
+        """
+        Replace 'ratio' of the relays with new ones, like between two
+        consecutive consensuses.
+        """
+        n_replaced = int(len(self.relays) * ratio)
+        for position in self.rng.sample(range(len(self.relays)), n_replaced):
+            self.relays[position] = SyntheticRelay(self.rng, len(self.relays) + position)
+
+    def get_md_consensus(self):
+        """
+        Return the network as a microdesc consensus string.
+        """
+        valid_after = self.valid_after
+        fresh_until = valid_after + datetime.timedelta(hours=1)
+        valid_until = valid_after + datetime.timedelta(hours=3)
+        published = valid_after - datetime.timedelta(minutes=30)
+        time_format = "%Y-%m-%d %H:%M:%S"
+
+        lines = ["network-status-version 3 microdesc",
+                 "vote-status consensus",
+                 "consensus-method 33",
+                 "valid-after %s" % valid_after.strftime(time_format),
+                 "fresh-until %s" % fresh_until.strftime(time_format),
+                 "valid-until %s" % valid_until.strftime(time_format),
+                 "voting-delay 300 300",
+                 "known-flags Authority BadExit Exit Fast Guard HSDir MiddleOnly Running Stable StaleDesc V2Dir Valid",
+                 "shared-rand-previous-value 9 %s" % base64.b64encode(self.shared_randomness_previous_value).decode('utf-8'),
+                 "shared-rand-current-value 9 %s" % base64.b64encode(self.shared_randomness_current_value).decode('utf-8')]
+
+        for relay in self.relays:
+            lines.extend(relay.routerstatus_lines(published))
+
+        lines.extend(["directory-footer",
+                      "bandwidth-weights Wbd=0 Wbe=0 Wbg=4130 Wbm=10000"])
+
+        return "\n".join(lines) + "\n"
+
+    def get_microdescriptors(self):
+        """
+        Return the microdescriptors of the network, in the same format as the
+        'md/all' GETINFO.
+        """
+        return "".join(relay.microdescriptor for relay in self.relays if relay.has_microdescriptor)
@@ -0,0 +1,60 @@
+import mmap
+import tempfile
+import unittest
+
+from stem.descriptor.networkstatus import NetworkStatusDocumentV3
+
+from onionbalance.hs_v3 import consensus_parser
+from onionbalance.hs_v3 import tor_node
+
+from test.benchmark import fixtures
+
+
+class TestConsensusParser(unittest.TestCase):
+    def assert_same_as_stem(self, parsed_consensus, stem_consensus):
+        self.assertEqual(parsed_consensus.valid_after, stem_consensus.valid_after)
+        self.assertEqual(parsed_consensus.fresh_until, stem_consensus.fresh_until)
+        self.assertEqual(parsed_consensus.valid_until, stem_consensus.valid_until)
+        self.assertEqual(parsed_consensus.shared_randomness_current_value,
+                         stem_consensus.shared_randomness_current_value)
+        self.assertEqual(parsed_consensus.shared_randomness_previous_value,
+                         stem_consensus.shared_randomness_previous_value)
+
+        self.assertEqual(list(parsed_consensus.routers), list(stem_consensus.routers))
+        for fingerprint, routerstatus in parsed_consensus.routers.items():
+            stem_routerstatus = stem_consensus.routers[fingerprint]
+            self.assertEqual(routerstatus.fingerprint, stem_routerstatus.fingerprint)
+            self.assertEqual(routerstatus.flags, stem_routerstatus.flags)
+            self.assertEqual(routerstatus.protocols['HSDir'], stem_routerstatus.protocols['HSDir'])
+            self.assertEqual(routerstatus.microdescriptor_digest, stem_routerstatus.microdescriptor_digest)
+            self.assertEqual(tor_node.can_be_hsdir(routerstatus), tor_node.can_be_hsdir(stem_routerstatus))
+
+    def test_parse_md_consensus(self):
+        md_consensus = fixtures.SyntheticNetwork(200).get_md_consensus().encode()
+        stem_consensus = NetworkStatusDocumentV3(md_consensus)
+
+        parsed_consensus = consensus_parser.parse_md_consensus(md_consensus)
+        self.assertEqual(len(parsed_consensus.routers), 200)
+        self.assert_same_as_stem(parsed_consensus, stem_consensus)
+
+        # It works on an mmap of the document as well
+        with tempfile.TemporaryFile() as consensus_file:
+            consensus_file.write(md_consensus)
+            consensus_file.flush()
+            with mmap.mmap(consensus_file.fileno(), 0, access=mmap.ACCESS_READ) as md_consensus_map:
+                self.assert_same_as_stem(consensus_parser.parse_md_consensus(md_consensus_map), stem_consensus)
+
+    def test_parse_invalid_md_consensus(self):
+        md_consensus = fixtures.SyntheticNetwork(10).get_md_consensus().encode()
+
+        for invalid_consensus in [b"",
+                                  b"this is not a consensus\n",
+                                  md_consensus.replace(b" microdesc\n", b"\n", 1),
+                                  md_consensus.replace(b"valid-after", b"not-valid-after"),
+                                  md_consensus.replace(b"\nr relay3 ", b"\nr relay3\n")]:
+            with self.assertRaises(ValueError):
+                consensus_parser.parse_md_consensus(invalid_consensus)
+
+
+if __name__ == '__main__':
+    unittest.main()
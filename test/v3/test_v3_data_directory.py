@@ -0,0 +1,79 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from onionbalance.hs_v3 import consensus
+from onionbalance.hs_v3 import data_directory
+
+from test.benchmark import fixtures
+
+
+class TestDataDirectory(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.network = fixtures.SyntheticNetwork(200)
+        relays = [relay for relay in self.network.relays if relay.has_microdescriptor]
+
+        with open(os.path.join(self.tmp_dir, data_directory.CONSENSUS_FILENAME), 'w') as consensus_file:
+            consensus_file.write(self.network.get_md_consensus())
+
+        # Like Tor, annotate each microdescriptor, and keep the latest ones in
+        # the journal. The microdescriptor of the first HSDir is only
+        # available from the control port.
+        self.control_port_relay = next(relay for relay in relays if relay.is_hsdir())
+        relays.remove(self.control_port_relay)
+        microdescriptor_files = [relays[:150], relays[150:]]
+        for filename, file_relays in zip(data_directory.MICRODESCRIPTOR_FILENAMES, microdescriptor_files):
+            with open(os.path.join(self.tmp_dir, filename), 'w') as microdescriptor_file:
+                for relay in file_relays:
+                    microdescriptor_file.write("@last-listed 2024-01-01 00:00:00\n")
+                    microdescriptor_file.write(relay.microdescriptor)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_refresh_from_data_directory(self):
+        controller = mock.Mock()
+        controller.get_md_consensus.return_value = self.network.get_md_consensus()
+        controller.get_microdescriptors_by_digest.return_value = {
+            self.control_port_relay.microdescriptor_digest: self.control_port_relay.microdescriptor}
+
+        with mock.patch('onionbalance.hs_v3.params.TOR_DATA_DIRECTORY', self.tmp_dir), \
+                mock.patch('onionbalance.hs_v3.onionbalance.my_onionbalance.controller', controller, create=True):
+            test_consensus = consensus.Consensus(do_refresh_consensus=False)
+            test_consensus.refresh()
+
+            # The consensus and all the microdescriptors but one came from the
+            # DataDirectory. Only the microdescriptors of HSDirs are needed.
+            controller.get_md_consensus.assert_not_called()
+            missing_digests = [relay.microdescriptor_digest for relay in self.network.relays
+                               if relay.is_hsdir() and (relay is self.control_port_relay or not relay.has_microdescriptor)]
+            controller.get_microdescriptors_by_digest.assert_called_once_with(missing_digests)
+
+            nodes = [(node.fingerprint, node.ed25519_identity, node.is_hsdir) for node in test_consensus.nodes]
+            expected_nodes = [(node.fingerprint, node.ed25519_identity, node.is_hsdir)
+                              for node in self.network.get_nodes() if node.is_hsdir]
+            self.assertEqual(nodes, expected_nodes)
+
+            # Tor did not replace the consensus file, so the next consensus is
+            # fetched from the control port. It's the one we already have, so
+            # it's skipped.
+            nodes = test_consensus.nodes
+            test_consensus.refresh()
+            controller.get_md_consensus.assert_called_once_with()
+            self.assertEqual(test_consensus.n_skipped_refreshes, 1)
+            self.assertIs(test_consensus.nodes, nodes)
+
+        # We fall back to the control port if the DataDirectory can't be read
+        with mock.patch('onionbalance.hs_v3.params.TOR_DATA_DIRECTORY', os.path.join(self.tmp_dir, "nope")), \
+                mock.patch('onionbalance.hs_v3.onionbalance.my_onionbalance.controller', controller, create=True), \
+                mock.patch.object(consensus.Consensus, '_update_microdescriptor_cache', return_value=True):
+            test_consensus = consensus.Consensus(do_refresh_consensus=False)
+            test_consensus.refresh()
+            self.assertEqual(controller.get_md_consensus.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
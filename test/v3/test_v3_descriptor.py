@@ -1,4 +1,16 @@
+import datetime
+import mock
+import pytest
+
+import stem.util
+from stem.descriptor.hidden_service import HiddenServiceDescriptorV3, IntroductionPointV3
+
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+
 from onionbalance.hs_v3 import consensus
+from onionbalance.hs_v3 import descriptor
+from onionbalance.hs_v3 import instance
 
 def test_disaster_srv():
     """
@@ -18,5 +30,165 @@ def test_disaster_srv():
         disaster_srv = my_consensus._get_disaster_srv(i)
         assert(disaster_srv.hex().upper() == correct_srvs[i-1])
 
+def test_revision_counter():
+    """
+    Test that the revision counter matches the OPE scheme of
+    rend-spec-v3.txt section F.2 computed word by word, also when it's
+    computed from a checkpoint.
+    """
+    identity_priv_key = Ed25519PrivateKey.from_private_bytes(bytes(range(32)))
+    revision_counter = descriptor.RevisionCounter(identity_priv_key)
+
+    cipher = Cipher(algorithms.AES(revision_counter.cipher_key), modes.CTR(b'\x00' * 16))
+    encryptor = cipher.encryptor()
+    words = []
+    for _ in range(5000):
+        v = encryptor.update(b'\x00\x00')
+        words.append(v[0] + 256 * v[1] + 1)
+
+    for n_words in [1, 2, 1000, 4999, 5000, 3000]:
+        assert(revision_counter.get(1000, n_words) == sum(words[:n_words]))
+
+    # Each SRV run has its own checkpoint, and only the latest ones are kept
+    assert(revision_counter.get(2000, 10) == sum(words[:10]))
+    assert(revision_counter.get(3000, 20) == sum(words[:20]))
+    assert(sorted(revision_counter.checkpoints) == [2000, 3000])
+
+
+def test_intro_point_recertifier():
+    """
+    Test that descriptors of the same time period share their signing key,
+    and that only new intro points get recertified.
+    """
+    recertifier = descriptor.IntroPointRecertifier()
+    intro_points = [IntroductionPointV3.create_for_address('1.2.3.%d' % i, 9001) for i in range(4)]
+
+    signing_key, recertified_intro_points = recertifier.recertify_intro_points(intro_points[:3], b"tp1")
+    signing_pubkey = stem.util._pubkey_bytes(signing_key)
+    for intro_point, recertified_intro_point in zip(intro_points, recertified_intro_points):
+        assert(recertified_intro_point.auth_key_cert.key == intro_point.auth_key_cert.key)
+        assert(recertified_intro_point.enc_key_cert.key == intro_point.enc_key_cert.key)
+        assert(recertified_intro_point.auth_key_cert.signing_key() == signing_pubkey)
+
+    # Same time period, with an intro point gone and a new one
+    new_signing_key, new_recertified_intro_points = recertifier.recertify_intro_points(intro_points[1:], b"tp1")
+    assert(new_signing_key is signing_key)
+    assert(new_recertified_intro_points[0].auth_key_cert is recertified_intro_points[1].auth_key_cert)
+    assert(new_recertified_intro_points[1].enc_key_cert is recertified_intro_points[2].enc_key_cert)
+    assert(new_recertified_intro_points[2].auth_key_cert.signing_key() == signing_pubkey)
+    assert(len(recertifier.certificates[b"tp1"]) == 6)
+
+    # Other time periods get their own signing key, and only the latest two
+    # are kept
+    assert(recertifier.get_signing_key(b"tp2") is not signing_key)
+    recertifier.get_signing_key(b"tp3")
+    assert(list(recertifier.signing_keys) == [b"tp2", b"tp3"])
+    assert(b"tp1" not in recertifier.certificates)
+
+
+def test_ob_descriptor():
+    """
+    Test that a built descriptor is encoded once, and that its bytes are what
+    we check, log and upload.
+    """
+    identity_priv_key = Ed25519PrivateKey.generate()
+    intro_points = [IntroductionPointV3.create_for_address('1.2.3.%d' % i, 9001) for i in range(3)]
+
+    with mock.patch.object(descriptor.OBDescriptor, '_get_revision_counter', return_value=42):
+        desc = descriptor.OBDescriptor("test.onion", identity_priv_key, bytes(32), intro_points, True)
+
+        assert(desc.get_size() == len(desc.descriptor_bytes) == len(str(desc.v3_desc)))
+        assert(desc.get_text() == str(desc.v3_desc))
+        assert(HiddenServiceDescriptorV3.from_str(desc.get_text()).revision_counter == 42)
+        assert(desc.v3_desc.revision_counter == 42)
+        assert(desc.get_blinded_key())
+        assert(len(desc.get_intro_points()) == 3)
+
+        with mock.patch('onionbalance.hs_v3.params.MAX_DESCRIPTOR_SIZE', desc.get_size() - 1):
+            with pytest.raises(descriptor.BadDescriptor):
+                descriptor.OBDescriptor("test.onion", identity_priv_key, bytes(32), intro_points, True)
+
+
+def test_choose_within_size():
+    """
+    Test that the descriptor size estimate is what we actually encode, and
+    that we pick as many intro points as fit, across all the instances.
+    """
+    identity_priv_key = Ed25519PrivateKey.generate()
+    instances_intro_points = [[IntroductionPointV3.create_for_address('1.2.%d.%d' % (i, j), 9001) for j in range(3)]
+                              for i in range(4)]
+    intro_points = [intro_point for instance_intro_points in instances_intro_points
+                    for intro_point in instance_intro_points]
+
+    # With the longest revision counter, the estimate is exact
+    with mock.patch.object(descriptor.OBDescriptor, '_get_revision_counter', return_value=2**64 - 1), \
+            mock.patch('onionbalance.hs_v3.params.MAX_DESCRIPTOR_SIZE', 100000):
+        for n_intro_points in (1, 5, 12):
+            desc = descriptor.OBDescriptor("test.onion", identity_priv_key, bytes(32),
+                                           intro_points[:n_intro_points], True)
+            intro_points_size = sum(map(descriptor.get_intro_point_size, intro_points[:n_intro_points]))
+            assert(descriptor.estimate_descriptor_size(intro_points_size) == desc.get_size())
+
+    intro_point_size = descriptor.get_intro_point_size(intro_points[0])
+    max_size = descriptor.estimate_descriptor_size(4 * intro_point_size)
+
+    intro_set = descriptor.IntroductionPointSetV3([list(ips) for ips in instances_intro_points])
+    chosen_ips = intro_set.choose_within_size(12, max_size)
+    assert(len(chosen_ips) == 4)
+    # Each instance has an intro point in there
+    for instance_intro_points in instances_intro_points:
+        assert(len(set(chosen_ips) & set(instance_intro_points)) == 1)
+
+    # Because of the padding of the outer layer, 10 intro points make a
+    # smaller descriptor than 5 of them
+    max_size = descriptor.estimate_descriptor_size(5 * intro_point_size)
+    intro_set = descriptor.IntroductionPointSetV3([list(ips) for ips in instances_intro_points])
+    assert(len(intro_set.choose_within_size(12, max_size)) == 10)
+
+    # Everything fits in a big enough descriptor
+    intro_set = descriptor.IntroductionPointSetV3([list(ips) for ips in instances_intro_points])
+    assert(len(intro_set.choose_within_size(12, 100000)) == 12)
+
+
+def test_register_same_descriptor():
+    """
+    Test that a descriptor we already have is recognized from its header, and
+    that it only refreshes the one we have.
+    """
+    identity_priv_key = Ed25519PrivateKey.generate()
+    onion_address = HiddenServiceDescriptorV3.address_from_identity_key(identity_priv_key).replace(".onion", "")
+    intro_points = [IntroductionPointV3.create_for_address('1.2.3.%d' % i, 9001) for i in range(3)]
+
+    def make_descriptor_text(revision_counter):
+        with mock.patch.object(descriptor.OBDescriptor, '_get_revision_counter', return_value=revision_counter):
+            desc = descriptor.OBDescriptor(onion_address, identity_priv_key, bytes(32), intro_points, True)
+        return desc.descriptor_bytes
+
+    descriptor_text = make_descriptor_text(42)
+    header = descriptor.get_descriptor_header(descriptor_text)
+    assert(header[0] == 42)
+    assert(header[1].startswith(b"\ndescriptor-signing-key-cert\n-----BEGIN ED25519 CERT-----\n"))
+    assert(descriptor.get_descriptor_header(b"hs-descriptor 3\n") is None)
+
+    with mock.patch('onionbalance.hs_v3.onionbalance.my_onionbalance.controller', mock.Mock(), create=True):
+        my_instance = instance.InstanceV3(onion_address)
+
+    my_instance.register_descriptor(descriptor_text, onion_address)
+    first_descriptor = my_instance.descriptor
+    assert(first_descriptor.header == header)
+    first_descriptor.set_received_ts(datetime.datetime(2000, 1, 1))
+
+    with mock.patch.object(descriptor, 'ReceivedDescriptor') as mock_received_descriptor:
+        my_instance.register_descriptor(descriptor_text, onion_address)
+    mock_received_descriptor.assert_not_called()
+    assert(my_instance.descriptor is first_descriptor)
+    assert(first_descriptor.received_ts > datetime.datetime(2000, 1, 1))
+
+    # A new revision is parsed
+    my_instance.register_descriptor(make_descriptor_text(43), onion_address)
+    assert(my_instance.descriptor is not first_descriptor)
+    assert(my_instance.descriptor.header[0] == 43)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,12 +3,15 @@ import mock
 import datetime
 import base64
 
+from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import ed25519
 
 from onionbalance.hs_v3 import tor_node
 from onionbalance.hs_v3 import hashring
 from onionbalance.hs_v3 import consensus
 
+from test.benchmark import fixtures
+
 CORRECT_HSDIR_FPRS_FIRST_DESCRIPTOR = [
     "D1D1D1D1D1D1D1D1D1D1D1D1D1D1D1D1D1D1D1D1",
     "2F2F2F2F2F2F2F2F2F2F2F2F2F2F2F2F2F2F2F2F",
@@ -32,7 +35,47 @@ CORRECT_HSDIR_FPRS_SECOND_DESCRIPTOR = [
 
 class DummyConsensus(consensus.Consensus):
     def __init__(self):
-        self.consensus = None
+        super().__init__(do_refresh_consensus=False)
+
+
+def create_network_nodes():
+    """
+    Create 255 fake Tor nodes that will be used as part of the unittests
+    """
+    network_nodes = []
+    for i in range(1, 256):
+        microdescriptor = mock.Mock()
+        routerstatus = mock.Mock()
+
+        routerstatus.fingerprint = (bytes([i]) * 20).hex()
+        routerstatus.protocols = {'HSDir': [2]}
+        routerstatus.flags = ['HSDir']
+        node_ed25519_id_b64 = base64.b64encode(bytes([i]) * 32).decode('utf-8')
+        microdescriptor.identifiers = {'ed25519': node_ed25519_id_b64}
+        node = tor_node.Node(microdescriptor, routerstatus)
+        network_nodes.append(node)
+
+    return network_nodes
+
+
+def create_consensus(network_nodes, current_srv, previous_srv):
+    """
+    Mock a fake consensus containing 'network_nodes'
+    """
+    current_time = datetime.datetime.fromtimestamp(10101010101)
+
+    consensus = DummyConsensus()
+    consensus.consensus = mock.Mock()
+    consensus.consensus.valid_after = current_time
+    consensus.get_current_srv = mock.Mock()
+    consensus.get_current_srv.return_value = current_srv
+    consensus.get_previous_srv = mock.Mock()
+    consensus.get_previous_srv.return_value = previous_srv
+    consensus.is_live = mock.Mock()
+    consensus.is_live.return_value = True
+    consensus.nodes = network_nodes
+
+    return consensus
 
 
 class TestHashRing(unittest.TestCase):
@@ -94,5 +137,269 @@ class TestHashRing(unittest.TestCase):
             self.assertEqual(responsible_hsdir.upper(), CORRECT_HSDIR_FPRS_SECOND_DESCRIPTOR[i])
             i+=1
 
+    def test_hashring_reuse(self):
+        current_srv = bytes([41]) * 32
+        previous_srv = bytes([42]) * 32
+
+        consensus = create_consensus(create_network_nodes(), current_srv, previous_srv)
+
+        # Mock a fake Tor network
+        from onionbalance.hs_v3.onionbalance import my_onionbalance
+        my_onionbalance.consensus = consensus
+
+        # One ring per (SRV, TP) gets built, and it's reused on later lookups
+        first_ring = hashring._get_hash_ring_for_descriptor(True)
+        second_ring = hashring._get_hash_ring_for_descriptor(False)
+        self.assertEqual(len(consensus.hash_rings), 2)
+        self.assertIs(first_ring, consensus.hash_rings[(previous_srv, first_ring.time_period_num)])
+        self.assertIs(second_ring, consensus.hash_rings[(current_srv, second_ring.time_period_num)])
+        self.assertIs(first_ring, hashring._get_hash_ring_for_descriptor(True))
+
+    def test_hashring_lookups(self):
+        from onionbalance.hs_v3.onionbalance import my_onionbalance
+        my_onionbalance.consensus = DummyConsensus()
+
+        ring = hashring.HashRing(create_network_nodes(), bytes([41]) * 32, 1234)
+        self.assertEqual(len(ring), 255)
+
+        # Indices past the last node wrap around to the start of the ring
+        self.assertEqual(ring.find_positions([b'\xff' * 32, b'\x00' * 32]), [0, 0])
+        self.assertEqual(ring.find_positions([ring.get_index(7), ring.get_index(254)]), [7, 254])
+
+        self.assertEqual(ring.get_fingerprints_from(253, 4),
+                         [ring.get_fingerprint(253), ring.get_fingerprint(254),
+                          ring.get_fingerprint(0), ring.get_fingerprint(1)])
+
+        # Batched lookups give the same results as one lookup at a time
+        all_hs_indices = [[bytes([i]) * 32, bytes([255 - i]) * 32] for i in range(20)]
+        self.assertEqual(ring.get_responsible_hsdirs_many(all_hs_indices),
+                         [ring.get_responsible_hsdirs(hs_indices) for hs_indices in all_hs_indices])
+        for responsible_hsdirs in ring.get_responsible_hsdirs_many(all_hs_indices):
+            self.assertEqual(len(set(responsible_hsdirs)), 8)
+
+    def test_hashring_precomputed_indices(self):
+        from onionbalance.hs_v3.onionbalance import my_onionbalance
+        my_onionbalance.consensus = DummyConsensus()
+
+        network_nodes = create_network_nodes()
+        # Some nodes that can't be part of the ring
+        network_nodes[3].is_hsdir = False
+        network_nodes[9].ed25519_identity = None
+
+        srv_and_time_periods = [(bytes([41]) * 32, 1234), (bytes([42]) * 32, 1235)]
+        all_indices = hashring.compute_hsdir_indices(network_nodes, srv_and_time_periods,
+                                                     my_onionbalance.consensus.get_time_period_length(), 2)
+
+        for srv, time_period_num in srv_and_time_periods:
+            hsdir_indices = all_indices[(srv, time_period_num)]
+            self.assertEqual(len(hsdir_indices), len(network_nodes))
+
+            ring = hashring.HashRing(network_nodes, srv, time_period_num, hsdir_indices)
+            serial_ring = hashring.HashRing(network_nodes, srv, time_period_num)
+            self.assertEqual(len(ring), 253)
+            self.assertEqual(ring.indices, serial_ring.indices)
+            self.assertEqual(ring.fingerprints, serial_ring.fingerprints)
+
+    def test_hsdir_table(self):
+        consensus = create_consensus(create_network_nodes(), bytes([41]) * 32, bytes([42]) * 32)
+
+        # Mock a fake Tor network
+        from onionbalance.hs_v3.onionbalance import my_onionbalance
+        my_onionbalance.consensus = consensus
+
+        identity_pubkeys = [ed25519.Ed25519PrivateKey.generate().public_key().public_bytes(
+                            encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+                            for _ in range(4)]
+        other_identity_pubkey = identity_pubkeys.pop()
+        consensus.precompute_responsible_hsdirs(identity_pubkeys)
+        self.assertEqual(len(consensus.hsdir_table), 6)
+
+        # The table gives the same HSDirs as computing them one service at a time
+        for identity_pubkey in identity_pubkeys:
+            for is_first_descriptor in (True, False):
+                entry = consensus.get_hsdir_table_entry(identity_pubkey, is_first_descriptor)
+                _, time_period_num = hashring.get_srv_and_time_period(is_first_descriptor)
+                self.assertEqual(entry.blinding_param,
+                                 consensus.get_blinding_param(identity_pubkey, time_period_num))
+                self.assertEqual(entry.responsible_hsdirs,
+                                 hashring.get_responsible_hsdirs(entry.blinded_key, is_first_descriptor))
+
+        # Services missing from the table get computed on demand
+        entry = consensus.get_hsdir_table_entry(other_identity_pubkey, True)
+        self.assertIs(entry, consensus.hsdir_table[(other_identity_pubkey, True)])
+
+    def test_hsdir_table_reuse(self):
+        network_nodes = create_network_nodes()
+        consensus = create_consensus(network_nodes, bytes([41]) * 32, bytes([42]) * 32)
+
+        # Mock a fake Tor network
+        from onionbalance.hs_v3.onionbalance import my_onionbalance
+        my_onionbalance.consensus = consensus
+
+        identity_pubkey = ed25519.Ed25519PrivateKey.generate().public_key().public_bytes(
+            encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+        consensus.precompute_responsible_hsdirs([identity_pubkey])
+        old_entry = consensus.get_hsdir_table_entry(identity_pubkey, True)
+
+        # A new consensus without a node that is far away from our HSDirs
+        # keeps the same table entry
+        responsible_nodes = [node for node in network_nodes
+                             if node.get_hex_fingerprint().upper() in old_entry.responsible_hsdirs]
+        ring = hashring._get_hash_ring_for_descriptor(True)
+        far_position = ring.find_positions([old_entry.arcs[0][1]])[0] + 50
+        while hashring.arcs_have_changes(old_entry.arcs, [ring.get_index(far_position % len(ring))]):
+            far_position += 1
+        far_index = ring.get_index(far_position % len(ring))
+        self.assertFalse(hashring.arcs_have_changes(old_entry.arcs, [far_index]))
+        far_fingerprint = ring.get_fingerprint(far_position % len(ring))
+        far_node = [node for node in network_nodes if node.get_hex_fingerprint().upper() == far_fingerprint][0]
+
+        consensus._reset_derived_state()
+        consensus.nodes = [node for node in network_nodes if node is not far_node]
+        consensus.precompute_responsible_hsdirs([identity_pubkey])
+        self.assertIs(consensus.get_hsdir_table_entry(identity_pubkey, True), old_entry)
+
+        # A new consensus without one of our HSDirs gets a new entry
+        consensus._reset_derived_state()
+        consensus.nodes = [node for node in network_nodes if node is not responsible_nodes[0]]
+        consensus.precompute_responsible_hsdirs([identity_pubkey])
+        new_entry = consensus.get_hsdir_table_entry(identity_pubkey, True)
+        self.assertIsNot(new_entry, old_entry)
+        self.assertNotIn(responsible_nodes[0].get_hex_fingerprint().upper(), new_entry.responsible_hsdirs)
+        self.assertEqual(new_entry.responsible_hsdirs,
+                         hashring.get_responsible_hsdirs(new_entry.blinded_key, True))
+
+    def test_hashring_from_previous(self):
+        network = fixtures.SyntheticNetwork(500)
+        srv, time_period_num, period_length = bytes([41]) * 32, 19000, 1440
+        previous_ring = hashring.HashRing(network.get_nodes(), srv, time_period_num, period_length=period_length)
+
+        # Relays join and leave, a relay loses its HSDir flag and another one
+        # gets a new ed25519 identity
+        network.churn(0.05)
+        nodes = network.get_nodes()
+        hsdir_nodes = [node for node in nodes if node.get_ring_identity()]
+        hsdir_nodes[0].is_hsdir = False
+        hsdir_nodes[1].ed25519_identity = bytes([43]) * 32
+
+        ring = hashring.HashRing.from_previous(previous_ring, nodes, period_length)
+        full_ring = hashring.HashRing(nodes, srv, time_period_num, period_length=period_length)
+        self.assertEqual(ring.indices, full_ring.indices)
+        self.assertEqual(ring.fingerprints, full_ring.fingerprints)
+        self.assertEqual(ring.identities, full_ring.identities)
+
+        # The ring knows which nodes changed since the previous one, and it's
+        # what walking both rings finds
+        changed_indices = ring.get_changed_indices(previous_ring)
+        self.assertEqual(changed_indices, full_ring.get_changed_indices(previous_ring))
+        indices = set(full_ring.get_index(i) for i in range(len(full_ring)))
+        previous_indices = set(previous_ring.get_index(i) for i in range(len(previous_ring)))
+        self.assertEqual(changed_indices, sorted(indices.symmetric_difference(previous_indices)))
+        self.assertEqual(full_ring.get_changed_indices(full_ring), [])
+
+        # Only the nodes that joined were hashed
+        with mock.patch.object(tor_node.Node, 'get_hsdir_index') as get_hsdir_index:
+            hashring.HashRing.from_previous(full_ring, nodes, period_length)
+        get_hsdir_index.assert_not_called()
+
+        # Rings without node identities (e.g. shared by another process) are
+        # built from scratch
+        packed_ring = hashring.HashRing.from_packed(srv, time_period_num, ring.indices, ring.fingerprints)
+        self.assertIsNone(hashring.HashRing.from_previous(packed_ring, nodes, period_length))
+
+    def test_previous_only_hsdirs(self):
+        network_nodes = create_network_nodes()
+        consensus = create_consensus(network_nodes, bytes([41]) * 32, bytes([42]) * 32)
+
+        # Mock a fake Tor network
+        from onionbalance.hs_v3.onionbalance import my_onionbalance
+        my_onionbalance.consensus = consensus
+
+        identity_pubkey = ed25519.Ed25519PrivateKey.generate().public_key().public_bytes(
+            encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+        consensus.precompute_responsible_hsdirs([identity_pubkey])
+        old_entry = consensus.get_hsdir_table_entry(identity_pubkey, False)
+        gone_hsdir = old_entry.responsible_hsdirs[2]
+
+        # A new consensus without one of our HSDirs
+        consensus._reset_derived_state()
+        consensus.nodes = [node for node in network_nodes if node.get_hex_fingerprint().upper() != gone_hsdir]
+        consensus.precompute_responsible_hsdirs([identity_pubkey])
+
+        with mock.patch('onionbalance.hs_v3.params.HSDIR_SET_OVERLAP_WINDOW', 3600):
+            self.assertEqual(consensus.get_previous_only_hsdirs(identity_pubkey, False), [gone_hsdir])
+
+            # Outside of the overlap window
+            consensus.previous_consensus_replaced_ts -= datetime.timedelta(seconds=3601)
+            self.assertEqual(consensus.get_previous_only_hsdirs(identity_pubkey, False), [])
+
+        # Disabled
+        consensus.previous_consensus_replaced_ts = datetime.datetime.utcnow()
+        with mock.patch('onionbalance.hs_v3.params.HSDIR_SET_OVERLAP_WINDOW', 0):
+            self.assertEqual(consensus.get_previous_only_hsdirs(identity_pubkey, False), [])
+
+    def test_time_context(self):
+        consensus = create_consensus(create_network_nodes(), bytes([41]) * 32, bytes([42]) * 32)
+
+        time_context = consensus.get_time_context()
+        self.assertEqual(hashring.get_srv_and_time_period(True, consensus),
+                         hashring.compute_srv_and_time_period(True, consensus))
+        self.assertEqual(hashring.get_srv_and_time_period(False, consensus),
+                         hashring.compute_srv_and_time_period(False, consensus))
+        self.assertEqual(time_context.current_srv_run_start, consensus.get_start_time_of_current_srv_run())
+        self.assertEqual(time_context.time_period_length, consensus.get_time_period_length())
+
+        # The context is computed once per consensus document
+        n_srv_calls = consensus.get_previous_srv.call_count + consensus.get_current_srv.call_count
+        for is_first_descriptor in (True, False):
+            hashring.get_srv_and_time_period(is_first_descriptor, consensus)
+        self.assertIs(consensus.get_time_context(), time_context)
+        self.assertEqual(consensus.get_previous_srv.call_count + consensus.get_current_srv.call_count, n_srv_calls)
+
+        # ... and recomputed for the next one
+        consensus.consensus = mock.Mock()
+        consensus.consensus.valid_after = time_context.valid_after + datetime.timedelta(hours=13)
+        new_time_context = consensus.get_time_context()
+        self.assertIsNot(new_time_context, time_context)
+        self.assertNotEqual(new_time_context.current_srv_run_start, time_context.current_srv_run_start)
+
+    def test_arcs_have_changes(self):
+        changed_indices = [bytes([10]) * 32, bytes([200]) * 32]
+
+        self.assertFalse(hashring.arcs_have_changes([(bytes([20]) * 32, bytes([100]) * 32)], changed_indices))
+        self.assertTrue(hashring.arcs_have_changes([(bytes([5]) * 32, bytes([10]) * 32)], changed_indices))
+        self.assertTrue(hashring.arcs_have_changes([(bytes([20]) * 32, bytes([100]) * 32), None], changed_indices))
+
+        # Arcs wrapping around the end of the ring
+        self.assertTrue(hashring.arcs_have_changes([(bytes([250]) * 32, bytes([20]) * 32)], changed_indices))
+        self.assertFalse(hashring.arcs_have_changes([(bytes([250]) * 32, bytes([5]) * 32)], changed_indices))
+        self.assertFalse(hashring.arcs_have_changes([(bytes([250]) * 32, bytes([5]) * 32)], []))
+
+    def test_node(self):
+        microdescriptor = mock.Mock()
+        microdescriptor.identifiers = {'ed25519': base64.b64encode(bytes([7]) * 32).decode('utf-8').rstrip('=')}
+        routerstatus = mock.Mock()
+        routerstatus.fingerprint = "07" * 20
+        routerstatus.protocols = {'HSDir': [1, 2]}
+        routerstatus.flags = ['HSDir', 'Fast']
+
+        node = tor_node.Node(microdescriptor, routerstatus)
+        self.assertEqual(node.ed25519_identity, bytes([7]) * 32)
+        self.assertTrue(node.is_hsdir)
+        # The stem objects are not kept around
+        self.assertFalse(hasattr(node, 'microdescriptor'))
+        self.assertFalse(hasattr(node, 'routerstatus'))
+
+        routerstatus.flags = ['Fast']
+        self.assertFalse(tor_node.Node(microdescriptor, routerstatus).is_hsdir)
+        with self.assertRaises(tor_node.NoHSDir):
+            tor_node.Node(microdescriptor, routerstatus).get_hsdir_index(bytes(32), 1)
+
+        routerstatus.flags = ['HSDir']
+        microdescriptor.identifiers = {}
+        with self.assertRaises(tor_node.NoEd25519Identity):
+            tor_node.Node(microdescriptor, routerstatus).get_hsdir_index(bytes(32), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
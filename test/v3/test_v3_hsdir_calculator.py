@@ -0,0 +1,94 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import ed25519
+from stem.descriptor.hidden_service import HiddenServiceDescriptorV3
+
+from onionbalance.hs_v3 import hashring
+from onionbalance.hs_v3 import hsdir_calculator
+from onionbalance.hs_v3 import params
+
+from test.benchmark import common
+from test.benchmark import fixtures
+
+
+def create_onion_address():
+    identity_pubkey = ed25519.Ed25519PrivateKey.generate().public_key().public_bytes(
+        encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+    return HiddenServiceDescriptorV3.address_from_identity_key(identity_pubkey, suffix=False)
+
+
+class TestHSDirCalculator(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.network = fixtures.SyntheticNetwork(300)
+
+        self.consensus_path = os.path.join(self.tmp_dir, "cached-microdesc-consensus")
+        with open(self.consensus_path, 'w') as consensus_file:
+            consensus_file.write(self.network.get_md_consensus())
+
+        self.microdescriptors_path = os.path.join(self.tmp_dir, "cached-microdescs")
+        with open(self.microdescriptors_path, 'w') as microdescriptors_file:
+            microdescriptors_file.write("@last-listed 2024-01-01 00:00:00\n")
+            microdescriptors_file.write(self.network.get_microdescriptors())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_hsdir_calculator(self):
+        offline_consensus = hsdir_calculator.load_consensus(self.consensus_path, [self.microdescriptors_path])
+        hsdir_nodes = [node for node in self.network.get_nodes() if node.is_hsdir]
+        self.assertEqual(len(offline_consensus.nodes), len(hsdir_nodes))
+
+        addresses = [create_onion_address() for _ in range(5)]
+        address_file = io.StringIO("# our frontends\n%s\n\nnot-an-onion-address\n%s\n" % (
+            "\n".join(addresses[:3]), "\n".join(address + ".onion" for address in addresses[3:])))
+        output = io.StringIO()
+
+        n_assignments = hsdir_calculator.write_hsdir_assignments(offline_consensus, address_file, output,
+                                                                 batch_size=2)
+        self.assertEqual(n_assignments, 2 * len(addresses))
+
+        assignments = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(set(assignment['address'] for assignment in assignments), set(addresses))
+
+        # Each ring was built once for all the batches
+        self.assertLessEqual(len(offline_consensus.hash_rings), 2)
+
+        # The assignments are the same as the ones onionbalance computes from
+        # the same network
+        reference_consensus = common.make_consensus(self.network)
+        for assignment in assignments:
+            self.assertEqual(len(assignment['responsible_hsdirs']),
+                             params.HSDIR_N_REPLICAS * params.HSDIR_SPREAD_STORE)
+
+            identity_pubkey = HiddenServiceDescriptorV3.identity_key_from_address(assignment['address'])
+            is_first_descriptor = assignment['descriptor'] == "first"
+            entry, = hashring.get_hsdir_table_entries([identity_pubkey], is_first_descriptor,
+                                                      reference_consensus)
+            self.assertEqual(assignment['responsible_hsdirs'], entry.responsible_hsdirs)
+            self.assertEqual(assignment['time_period'], entry.time_period_num)
+
+    def test_hsdir_calculator_leaves_shared_consensus_alone(self):
+        shared_path = os.path.join(self.tmp_dir, "shared-consensus")
+
+        # The environment of a running onionbalance that publishes its
+        # consensus
+        with mock.patch('onionbalance.hs_v3.params.SHARED_CONSENSUS_FILE', shared_path), \
+                mock.patch('onionbalance.hs_v3.params.SHARED_CONSENSUS_MODE', 'publish'), \
+                mock.patch('onionbalance.hs_v3.params.TOR_DATA_DIRECTORY', self.tmp_dir):
+            offline_consensus = hsdir_calculator.load_consensus(self.consensus_path, [self.microdescriptors_path])
+
+        self.assertTrue(offline_consensus.nodes)
+        self.assertIsNone(offline_consensus.shared_consensus_file)
+        self.assertFalse(os.path.exists(shared_path))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+import unittest
+import mock
+
+import stem
+from stem.descriptor.microdescriptor import Microdescriptor
+
+from onionbalance.hs_v3 import microdescriptor_cache
+
+from test.benchmark import fixtures
+
+
+class DummyController(object):
+    """
+    Serves the microdescriptors of 'relays' like Tor does over the control port.
+    """
+
+    def __init__(self, relays):
+        self.microdescriptors = {relay.microdescriptor_digest: relay.microdescriptor for relay in relays}
+        self.requested_digests = []
+        self.controller = mock.Mock()
+        self.controller.get_microdescriptors.side_effect = lambda: [Microdescriptor(content) for content in
+                                                                    self.microdescriptors.values()]
+
+    def get_microdescriptors_by_digest(self, digests):
+        self.requested_digests.append(list(digests))
+        if any(digest not in self.microdescriptors for digest in digests):
+            raise stem.InvalidArguments("552", "Unrecognized key")
+
+        return {digest: self.microdescriptors[digest] for digest in digests}
+
+
+class TestMicrodescriptorCache(unittest.TestCase):
+    def test_microdescriptor_cache(self):
+        network = fixtures.SyntheticNetwork(100)
+        controller = DummyController(network.relays)
+        digests = [relay.microdescriptor_digest for relay in network.relays]
+
+        # Everything is missing at first, so everything is fetched at once
+        cache = microdescriptor_cache.MicrodescriptorCache()
+        self.assertEqual(cache.update(controller, digests), 100)
+        self.assertEqual(controller.controller.get_microdescriptors.call_count, 1)
+        self.assertEqual(controller.requested_digests, [])
+        for relay in network.relays:
+            self.assertEqual(cache.get_ed25519_identity(relay.microdescriptor_digest), relay.ed25519_identity)
+
+        # Nothing to fetch if nothing changed
+        self.assertEqual(cache.update(controller, digests), 0)
+
+        # After some churn, only the new microdescriptors are fetched, and Tor
+        # not having one of them does not stop us from getting the rest
+        old_digests = digests
+        network.churn(0.1)
+        controller.microdescriptors.update(DummyController(network.relays).microdescriptors)
+        digests = [relay.microdescriptor_digest for relay in network.relays]
+        new_digests = set(digests) - set(old_digests)
+        unknown_relay = [relay for relay in network.relays if relay.microdescriptor_digest in new_digests][0]
+        del controller.microdescriptors[unknown_relay.microdescriptor_digest]
+
+        with mock.patch('onionbalance.hs_v3.params.MICRODESCRIPTOR_FETCH_BATCH_SIZE', 4):
+            n_fetched = cache.update(controller, digests)
+
+        self.assertEqual(n_fetched, len(new_digests) - 1)
+        self.assertEqual(controller.controller.get_microdescriptors.call_count, 1)
+        for requested_digests in controller.requested_digests:
+            self.assertTrue(set(requested_digests) <= new_digests)
+        self.assertNotIn(unknown_relay.microdescriptor_digest, cache)
+
+        # Microdescriptors of relays that left are dropped
+        self.assertEqual(cache.evict(digests), len(new_digests))
+        self.assertEqual(len(cache), 99)
+        self.assertEqual(set(digests) - set(cache.ed25519_identities), set([unknown_relay.microdescriptor_digest]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,15 +1,29 @@
 import datetime
+import threading
+import time
 import unittest
 import mock
 from types import SimpleNamespace
 
+from stem.descriptor.hidden_service import HiddenServiceDescriptorV3, IntroductionPointV3
+from stem.descriptor.microdescriptor import Microdescriptor
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
+
 from onionbalance.hs_v3 import consensus
+from onionbalance.hs_v3 import consensus_parser
+from onionbalance.hs_v3 import consensus_worker
+from onionbalance.hs_v3 import descriptor
+from onionbalance.hs_v3 import descriptor_worker
+from onionbalance.hs_v3 import hashring
 
 from onionbalance.hs_v3.onionbalance import Onionbalance
 
+from test.benchmark import fixtures
+
 class DummyConsensus(consensus.Consensus):
     def __init__(self):
-        self.consensus = None
+        super().__init__(do_refresh_consensus=False)
 
 class OutdatedConsensus(unittest.TestCase):
     def test_outdated_consensus(self):
@@ -47,6 +61,168 @@ class OutdatedConsensus(unittest.TestCase):
             mock_datetime.utcnow.return_value = consensus.consensus.valid_after - datetime.timedelta(seconds=3600 * 24 + 1)
             self.assertFalse(consensus.is_live())
 
+class TestConsensusLoad(unittest.TestCase):
+    def setUp(self):
+        network = fixtures.SyntheticNetwork(200)
+        self.md_consensus_str = network.get_md_consensus().encode()
+        self.microdescriptors = [Microdescriptor(relay.microdescriptor) for relay in network.relays
+                                 if relay.has_microdescriptor]
+
+    def test_unchanged_consensus(self):
+        test_consensus = DummyConsensus()
+        test_consensus.load(self.md_consensus_str, self.microdescriptors)
+        self.assertTrue(test_consensus.nodes)
+        self.assertIsNotNone(test_consensus.consensus_digest)
+
+        time_context = test_consensus.get_time_context()
+        hash_ring = test_consensus.get_hash_ring(*hashring.get_srv_and_time_period(True, test_consensus))
+
+        def get_derived_state():
+            return (test_consensus.consensus, test_consensus.nodes, test_consensus.hash_rings,
+                    test_consensus.previous_hash_rings, test_consensus.hsdir_table)
+        derived_state = get_derived_state()
+
+        # The same document again is not even parsed, and everything derived
+        # from it stays as it was
+        with mock.patch.object(consensus_parser, 'parse_md_consensus') as parse_md_consensus:
+            test_consensus.load(self.md_consensus_str, self.microdescriptors)
+        parse_md_consensus.assert_not_called()
+
+        self.assertEqual(test_consensus.n_skipped_refreshes, 1)
+        for state, previous_state in zip(get_derived_state(), derived_state):
+            self.assertIs(state, previous_state)
+        self.assertIs(test_consensus.get_time_context(), time_context)
+        self.assertIs(test_consensus.get_hash_ring(hash_ring.srv, hash_ring.time_period_num), hash_ring)
+
+    def test_consensus_without_microdescriptors(self):
+        test_consensus = DummyConsensus()
+
+        # Tor can't give us the microdescriptors: the document must be loaded
+        # again next time
+        with mock.patch.object(consensus.Consensus, '_update_microdescriptor_cache', return_value=False):
+            test_consensus.load(self.md_consensus_str)
+        self.assertIsNone(test_consensus.nodes)
+        self.assertIsNone(test_consensus.consensus_digest)
+
+        test_consensus.load(self.md_consensus_str, self.microdescriptors)
+        self.assertEqual(test_consensus.n_skipped_refreshes, 0)
+        self.assertTrue(test_consensus.nodes)
+        self.assertIsNotNone(test_consensus.consensus_digest)
+
+    def test_derived_state_built_before_swap(self):
+        test_consensus = DummyConsensus()
+        identity_pubkey = Ed25519PrivateKey.generate().public_key().public_bytes(
+            encoding=serialization.Encoding.Raw, format=serialization.PublicFormat.Raw)
+
+        # The staged consensus shares our long-lived state instead of setting
+        # up its own
+        with mock.patch('onionbalance.hs_v3.params.SHARED_CONSENSUS_FILE', '/nonexistent/shared'), \
+                mock.patch('onionbalance.hs_v3.shared_consensus.SharedConsensusFile') as shared_consensus_file, \
+                mock.patch('onionbalance.hs_v3.microdescriptor_cache.MicrodescriptorCache') as cache:
+            test_consensus.load(self.md_consensus_str, self.microdescriptors, [identity_pubkey])
+        shared_consensus_file.assert_not_called()
+        cache.assert_not_called()
+
+        # Both rings and the HSDir table are there as soon as it's swapped in
+        with mock.patch.object(consensus.Consensus, '_build_hash_ring') as build_hash_ring:
+            for is_first_descriptor in (True, False):
+                test_consensus.get_hash_ring(*hashring.get_srv_and_time_period(is_first_descriptor, test_consensus))
+                self.assertIn((identity_pubkey, is_first_descriptor), test_consensus.hsdir_table)
+        build_hash_ring.assert_not_called()
+
+
+class TestConsensusIngestWorker(unittest.TestCase):
+    @mock.patch('onionbalance.hs_v3.params.CONSENSUS_INGEST_COALESCE_DELAY', 0)
+    def test_coalescing(self):
+        ingest_started = threading.Event()
+        release_ingest = threading.Event()
+        ingests = []
+
+        def ingest():
+            ingests.append(time.time())
+            ingest_started.set()
+            release_ingest.wait(5)
+
+        worker = consensus_worker.ConsensusIngestWorker(ingest)
+        worker.start()
+
+        worker.request_ingest()
+        self.assertTrue(ingest_started.wait(5))
+
+        # A burst of events during an ingest leads to a single new ingest
+        for _ in range(5):
+            worker.request_ingest()
+        release_ingest.set()
+
+        deadline = time.time() + 5
+        while worker.n_ingests < 2 and time.time() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+
+        self.assertEqual(worker.n_requests, 6)
+        self.assertEqual(worker.n_ingests, 2)
+        self.assertEqual(len(ingests), 2)
+
+        worker.stop()
+
+class TestDescriptorParseWorker(unittest.TestCase):
+    def setUp(self):
+        identity_priv_key = Ed25519PrivateKey.generate()
+        self.onion_address = HiddenServiceDescriptorV3.address_from_identity_key(identity_priv_key).replace(".onion", "")
+        intro_points = [IntroductionPointV3.create_for_address('1.2.3.%d' % i, 9001) for i in range(3)]
+
+        self.descriptor_texts = []
+        for revision_counter in (1, 2):
+            with mock.patch.object(descriptor.OBDescriptor, '_get_revision_counter', return_value=revision_counter):
+                desc = descriptor.OBDescriptor(self.onion_address, identity_priv_key, bytes(32), intro_points, True)
+            self.descriptor_texts.append(desc.descriptor_bytes)
+
+        # Tampering with the revision counter breaks the decryption
+        self.bad_descriptor_text = self.descriptor_texts[1].replace(b"revision-counter 2", b"revision-counter 3")
+
+    def run_worker(self, n_workers):
+        registered = []
+        with mock.patch('onionbalance.hs_v3.params.DESCRIPTOR_PARSE_WORKERS', n_workers):
+            worker = descriptor_worker.DescriptorParseWorker(lambda *args: registered.append(args))
+        worker.start()
+
+        first_text, second_text = self.descriptor_texts
+        for descriptor_text in (first_text, first_text, self.bad_descriptor_text, second_text):
+            worker.submit(self.onion_address, descriptor_text)
+        worker.wait()
+        self.assertEqual(worker.get_queue_depth(), 0)
+        worker.stop()
+        self.assertFalse(worker._thread.is_alive())
+
+        return worker, registered
+
+    def test_parse_on_thread(self):
+        worker, registered = self.run_worker(0)
+
+        # Everything gets registered in order, to be parsed there
+        self.assertEqual(registered, [(self.onion_address, descriptor_text, None) for descriptor_text in
+                                      (self.descriptor_texts[0], self.descriptor_texts[0],
+                                       self.bad_descriptor_text, self.descriptor_texts[1])])
+        self.assertEqual(worker.n_handled, 4)
+        self.assertEqual(worker.n_parsed_in_workers, 0)
+
+    def test_parse_in_workers(self):
+        worker, registered = self.run_worker(2)
+
+        # The bad descriptor is dropped, and the duplicate is only parsed once
+        self.assertEqual([descriptor_text for _, descriptor_text, _ in registered],
+                         [self.descriptor_texts[0], self.descriptor_texts[0], self.descriptor_texts[1]])
+        first_record, duplicate_record, second_record = [record for _, _, record in registered]
+        self.assertEqual(first_record.header, descriptor.get_descriptor_header(self.descriptor_texts[0]))
+        self.assertEqual(len(first_record.intro_points), 3)
+        self.assertIsNone(duplicate_record)
+        self.assertEqual(second_record.header[0], 2)
+
+        self.assertEqual(worker.n_submitted, 4)
+        self.assertEqual(worker.n_parsed_in_workers, 2)
+        self.assertEqual(worker.n_duplicates, 1)
+
+
 class TestReloadConfig(unittest.TestCase):
 
     @mock.patch('onionbalance.hs_v3.service.OnionbalanceService')
@@ -64,6 +240,22 @@ class TestReloadConfig(unittest.TestCase):
         mock_load_config_file.assert_called_once()
         mock_init_scheduler.assert_called_once()
 
+    @mock.patch('onionbalance.hs_v3.params.SHARED_CONSENSUS_FILE', '/tmp/onionbalance-shared-consensus')
+    @mock.patch('onionbalance.hs_v3.params.SHARED_CONSENSUS_MODE', 'publisher')
+    @mock.patch('onionbalance.hs_v3.consensus.Consensus')
+    @mock.patch('onionbalance.hs_v3.stem_controller.StemController')
+    @mock.patch('onionbalance.hs_v3.onionbalance.Onionbalance.load_config_file')
+    @mock.patch('onionbalance.hs_v3.manager.init_scheduler')
+    def test_bad_shared_consensus_mode(self, mock_init_scheduler, mock_load_config_file, mock_StemController, mock_Consensus):
+        test_onionbalance = Onionbalance()
+        test_onionbalance.args = self.create_dummy_args()
+
+        # A bad mode is a config error: we exit before setting anything up
+        with self.assertRaises(SystemExit):
+            test_onionbalance.reload_config()
+        mock_Consensus.assert_not_called()
+        mock_init_scheduler.assert_not_called()
+
     @staticmethod
     def create_dummy_args():
         return SimpleNamespace(config='config/config.yaml', ip='127.0.0.1', is_testnet=False, port=6666, socket='/var/run/tor/control', verbosity='info')
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+
+from stem.descriptor.microdescriptor import Microdescriptor
+
+from onionbalance.hs_v3 import consensus
+from onionbalance.hs_v3 import hashring
+
+from test.benchmark import fixtures
+
+
+class TestSharedConsensus(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.shared_path = os.path.join(self.tmp_dir, "shared-consensus")
+        self.network = fixtures.SyntheticNetwork(200)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def make_consensus(self, mode):
+        with mock.patch('onionbalance.hs_v3.params.SHARED_CONSENSUS_FILE', self.shared_path), \
+                mock.patch('onionbalance.hs_v3.params.SHARED_CONSENSUS_MODE', mode):
+            return consensus.Consensus(do_refresh_consensus=False, is_testnet=False)
+
+    def publish(self, publisher):
+        microdescriptors = [Microdescriptor(relay.microdescriptor) for relay in self.network.relays
+                            if relay.has_microdescriptor]
+        publisher.load(self.network.get_md_consensus().encode(), microdescriptors)
+
+    def test_shared_consensus(self):
+        publisher = self.make_consensus('publish')
+        self.publish(publisher)
+        self.assertEqual(publisher.shared_consensus_file.generation, 1)
+
+        reader = self.make_consensus('attach')
+        self.assertTrue(reader.shared_consensus_file.has_new_generation())
+        reader.refresh()
+        self.assertTrue(reader.is_shared)
+        self.assertFalse(reader.shared_consensus_file.has_new_generation())
+
+        # The reader has the same consensus state, without parsing anything
+        self.assertEqual(reader.get_time_context(), publisher.get_time_context())
+        self.assertEqual([(node.fingerprint, node.ed25519_identity, node.is_hsdir) for node in reader.nodes],
+                         [(node.fingerprint, node.ed25519_identity, node.is_hsdir) for node in publisher.nodes])
+        self.assertEqual(set(reader.hash_rings), set(publisher.hash_rings))
+        for key, ring in publisher.hash_rings.items():
+            self.assertEqual(reader.hash_rings[key].indices, ring.indices)
+            self.assertEqual(reader.hash_rings[key].fingerprints, ring.fingerprints)
+
+        blinded_pubkey = bytes(range(32))
+        for is_first_descriptor in (True, False):
+            self.assertEqual(hashring.get_responsible_hsdirs(blinded_pubkey, is_first_descriptor, reader),
+                             hashring.get_responsible_hsdirs(blinded_pubkey, is_first_descriptor, publisher))
+
+        # Nothing to do until the publisher writes a new generation
+        reader.refresh()
+        self.assertEqual(reader.n_skipped_refreshes, 1)
+
+        self.network.churn(0.1)
+        self.publish(publisher)
+        self.assertEqual(publisher.shared_consensus_file.generation, 2)
+        self.assertTrue(reader.shared_consensus_file.has_new_generation())
+        reader.refresh()
+        self.assertEqual(reader.shared_consensus_file.generation, 2)
+        self.assertEqual(len(reader.nodes), len(publisher.nodes))
+
+    def test_shared_consensus_fallback(self):
+        with open(self.shared_path, 'wb') as shared_file:
+            shared_file.write(b"OBSHCONS")
+
+        controller = mock.Mock()
+        controller.get_md_consensus.return_value = self.network.get_md_consensus()
+
+        reader = self.make_consensus('attach')
+        self.assertFalse(reader.shared_consensus_file.has_new_generation())
+
+        # A broken shared consensus file makes us load our own consensus
+        with mock.patch('onionbalance.hs_v3.onionbalance.my_onionbalance.controller', controller, create=True), \
+                mock.patch.object(consensus.Consensus, '_update_microdescriptor_cache', return_value=True):
+            reader.refresh()
+
+        controller.get_md_consensus.assert_called_once_with()
+        self.assertTrue(reader.is_live())
+        self.assertFalse(reader.is_shared)
+
+
+if __name__ == '__main__':
+    unittest.main()